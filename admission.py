@@ -0,0 +1,169 @@
+# E:\PROJECTS\voice_test\admission.py
+
+import os
+import time
+import asyncio
+from fastapi import HTTPException
+
+from metrics import Counter, Gauge, Histogram
+
+# Control de admisión por etapa: cada etapa (subida, transcripción, Gemini, PDF)
+# admite un número máximo de peticiones simultáneas y una cola de espera acotada
+# en tamaño y en tiempo. Si la cola está llena o la espera vence se responde 429
+# con Retry-After, en lugar de degradar la latencia de todas las peticiones.
+ADMISSION_STAGES = ("upload", "transcription", "gemini", "pdf")
+_DEFAULT_MAX_CONCURRENT = {
+    "upload": 16,
+    "transcription": 32,
+    "gemini": 8,
+    "pdf": os.cpu_count() or 4,
+}
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+ADMISSION_MAX_QUEUE_SECONDS = float(os.getenv("ADMISSION_MAX_QUEUE_SECONDS", "30"))
+
+ADMISSION_IN_FLIGHT = Gauge("admission_in_flight", "Peticiones dentro de cada etapa.", ("stage",))
+ADMISSION_QUEUE_DEPTH = Gauge("admission_queue_depth", "Peticiones esperando turno en cada etapa.", ("stage",))
+ADMISSION_REJECTIONS = Counter("admission_rejections_total", "Peticiones rechazadas con 429 por etapa y motivo (cola_llena, espera_agotada).",
+                               ("stage", "reason"))
+ADMISSION_WAIT_SECONDS = Histogram("admission_wait_seconds", "Tiempo de espera en la cola de cada etapa.", ("stage",),
+                                   buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60))
+
+def _env_limit(stage: str) -> int:
+    return int(os.getenv(f"ADMISSION_{stage.upper()}_MAX_CONCURRENT", str(_DEFAULT_MAX_CONCURRENT[stage])))
+
+class StageLimiter:
+    # "async with limiter" espera turno con la cola acotada (y lanza 429 si no
+    # cabe); limiter.background espera sin límite de cola ni de tiempo, para los
+    # workers de trabajos y los lotes, que ya tienen su propia cola.
+    # max_concurrent <= 0 desactiva el límite (solo se cuentan las peticiones).
+
+    def __init__(self, stage: str, max_concurrent: int, max_queue: int = ADMISSION_MAX_QUEUE,
+                 max_queue_seconds: float = ADMISSION_MAX_QUEUE_SECONDS):
+        self.stage = stage
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_queue_seconds = max_queue_seconds
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        # Media móvil de lo que dura la etapa, para estimar Retry-After
+        self.avg_hold_seconds = 1.0
+        self._slots = asyncio.Semaphore(max_concurrent) if max_concurrent > 0 else None
+        self._held_since: dict = {}
+        self.background = _BackgroundSlot(self)
+
+    def retry_after_seconds(self) -> int:
+        if self._slots is None:
+            return 1
+        turns = (self.waiting + 1) / self.max_concurrent
+        return max(1, int(turns * self.avg_hold_seconds + 0.999))
+
+    def has_capacity(self) -> bool:
+        return self._slots is None or not self._slots.locked() or self.waiting < self.max_queue
+
+    def _reject(self, reason: str, detail: str) -> HTTPException:
+        self.rejected += 1
+        ADMISSION_REJECTIONS.inc(stage=self.stage, reason=reason)
+        return HTTPException(status_code=429, detail=detail, headers={"Retry-After": str(self.retry_after_seconds())})
+
+    async def acquire(self, bounded: bool = True) -> None:
+        if self._slots is not None:
+            if self._slots.locked() and bounded and self.waiting >= self.max_queue:
+                raise self._reject("cola_llena", f"Servidor saturado: la cola de la etapa '{self.stage}' está llena.")
+            self.waiting += 1
+            ADMISSION_QUEUE_DEPTH.set(self.waiting, stage=self.stage)
+            started = time.perf_counter()
+            try:
+                if bounded:
+                    # asyncio.timeout y no wait_for: si el tiempo vence justo cuando
+                    # llega el permiso, Semaphore.acquire lo devuelve al cancelarse
+                    async with asyncio.timeout(self.max_queue_seconds):
+                        await self._slots.acquire()
+                else:
+                    await self._slots.acquire()
+            except asyncio.TimeoutError:
+                raise self._reject("espera_agotada",
+                                   f"Servidor saturado: se agotó la espera de {self.max_queue_seconds:.0f} s en la etapa '{self.stage}'.")
+            finally:
+                self.waiting -= 1
+                ADMISSION_QUEUE_DEPTH.set(self.waiting, stage=self.stage)
+                ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - started, stage=self.stage)
+        self.in_flight += 1
+        ADMISSION_IN_FLIGHT.set(self.in_flight, stage=self.stage)
+
+    def release(self, held_seconds: float) -> None:
+        self.in_flight -= 1
+        ADMISSION_IN_FLIGHT.set(self.in_flight, stage=self.stage)
+        self.avg_hold_seconds = 0.8 * self.avg_hold_seconds + 0.2 * held_seconds
+        if self._slots is not None:
+            self._slots.release()
+
+    async def __aenter__(self):
+        await self.acquire(bounded=True)
+        self._held_since[asyncio.current_task()] = time.perf_counter()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release(time.perf_counter() - self._held_since.pop(asyncio.current_task(), time.perf_counter()))
+
+    def snapshot(self) -> dict:
+        return {"max_concurrentes": self.max_concurrent, "en_curso": self.in_flight, "en_cola": self.waiting,
+                "max_cola": self.max_queue, "rechazadas": self.rejected,
+                "duracion_media_segundos": round(self.avg_hold_seconds, 3)}
+
+class _BackgroundSlot:
+    # Igual que "async with limiter" pero esperando el turno sin límite.
+
+    def __init__(self, limiter: StageLimiter):
+        self.limiter = limiter
+
+    async def __aenter__(self):
+        await self.limiter.acquire(bounded=False)
+        self.limiter._held_since[asyncio.current_task()] = time.perf_counter()
+        return self.limiter
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.limiter.__aexit__(exc_type, exc, tb)
+
+class AdmissionController:
+    # Un StageLimiter por etapa. request_limits se pasa como stage_limits al
+    # flujo de dictado (peticiones síncronas); background_limits lo usan workers
+    # y lotes.
+
+    def __init__(self, limits: dict[str, StageLimiter]):
+        self.limits = limits
+        self.background_limits = {stage: limiter.background for stage, limiter in limits.items()}
+        # Una petición síncrona solo puede recibir 429 al entrar (subida). Una vez
+        # admitida, las etapas siguientes esperan turno sin límite: un 429 tras
+        # pagar la subida y la transcripción haría repetir todo el flujo.
+        self.request_limits = {stage: limiter if stage == ADMISSION_STAGES[0] else limiter.background
+                               for stage, limiter in limits.items()}
+
+    @classmethod
+    def from_env(cls) -> "AdmissionController":
+        return cls({stage: StageLimiter(stage, _env_limit(stage)) for stage in ADMISSION_STAGES})
+
+    def ensure_capacity(self, stage: str = "upload") -> None:
+        # Rechazo inmediato, antes de leer el audio, si la primera etapa ya está saturada.
+        limiter = self.limits[stage]
+        if not limiter.has_capacity():
+            raise limiter._reject("cola_llena", f"Servidor saturado: la cola de la etapa '{stage}' está llena.")
+
+    def queue_depth(self) -> int:
+        return sum(limiter.waiting for limiter in self.limits.values())
+
+    def in_flight(self) -> int:
+        return sum(limiter.in_flight for limiter in self.limits.values())
+
+    def snapshot(self) -> dict:
+        return {"en_cola_total": self.queue_depth(), "en_curso_total": self.in_flight(),
+                "etapas": {stage: limiter.snapshot() for stage, limiter in self.limits.items()}}
+
+def merge_stage_limits(*stage_limits: dict) -> dict:
+    # Combina varios diccionarios de límites; una etapa con varios límites los
+    # adquiere en orden (p. ej. el semáforo del lote y después el global).
+    merged: dict = {}
+    for limits in stage_limits:
+        for stage, limit in limits.items():
+            merged.setdefault(stage, []).append(limit)
+    return merged
@@ -1,23 +1,46 @@
 # E:\PROJECTS\voice_test\assemblyai_service.py
 
 import os
+import time
 import asyncio
 import httpx
+from typing import AsyncIterable, Callable
 from fastapi import HTTPException
 
-# Constante para la URL base de AssemblyAI
-ASSEMBLYAI_BASE_URL = "https://api.assemblyai.com/v2"
+from http_client import stage_timeout
+from resilience import call_with_resilience, RETRY_MAX_ATTEMPTS
 
-async def upload_audio_to_assemblyai(client: httpx.AsyncClient, file_content: bytes, api_key: str) -> str:
+# Constante para la URL base de AssemblyAI (se puede apuntar a un servidor simulado)
+ASSEMBLYAI_BASE_URL = os.getenv("ASSEMBLYAI_BASE_URL", "https://api.assemblyai.com/v2")
+# Cabecera con el secreto compartido que AssemblyAI reenvía en cada webhook
+ASSEMBLYAI_WEBHOOK_AUTH_HEADER = "X-Webhook-Secret"
+
+async def upload_audio_to_assemblyai(client: httpx.AsyncClient,
+                                     file_content: bytes | AsyncIterable[bytes] | Callable[[], AsyncIterable[bytes]],
+                                     api_key: str) -> str:
+    # file_content puede ser un bytes, un generador asíncrono de bloques (httpx
+    # envía el cuerpo por partes sin cargarlo entero) o una función que crea un
+    # generador nuevo. Un generador suelto no se puede volver a leer, así que
+    # solo se reintenta la subida con bytes o con una función.
     upload_endpoint = f"{ASSEMBLYAI_BASE_URL}/upload"
     headers = {"authorization": api_key}
+    replayable = isinstance(file_content, (bytes, bytearray)) or callable(file_content)
     print("Subiendo archivo a AssemblyAI...")
-    try:
-        response = await client.post(upload_endpoint, headers=headers, content=file_content)
+
+    async def send() -> httpx.Response:
+        content = file_content() if callable(file_content) else file_content
+        response = await client.post(upload_endpoint, headers=headers, content=content, timeout=stage_timeout("upload"))
         response.raise_for_status()
+        return response
+
+    try:
+        response = await call_with_resilience("assemblyai", "upload", send, max_attempts=RETRY_MAX_ATTEMPTS if replayable else 1)
         result = response.json()
         print(f"Archivo subido exitosamente. URL: {result['upload_url']}")
         return result["upload_url"]
+    except HTTPException:
+        # Errores ya traducidos, p. ej. el límite de tamaño del generador de subida
+        raise
     except httpx.HTTPStatusError as e:
         error_detail = "No se pudo obtener detalle del error"; 
         try: error_detail = e.response.json().get("error", e.response.text)
@@ -28,7 +51,8 @@ async def upload_audio_to_assemblyai(client: httpx.AsyncClient, file_content: by
         print(f"Error inesperado al subir archivo: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error interno al subir archivo: {str(e)}")
 
-async def request_transcription(client: httpx.AsyncClient, audio_url: str, api_key: str) -> str:
+async def request_transcription(client: httpx.AsyncClient, audio_url: str, api_key: str,
+                                webhook_url: str | None = None, webhook_secret: str | None = None) -> str:
     transcript_endpoint = f"{ASSEMBLYAI_BASE_URL}/transcript"
     headers = {"authorization": api_key, "content-type": "application/json"}
     data = {
@@ -36,12 +60,26 @@ async def request_transcription(client: httpx.AsyncClient, audio_url: str, api_k
         "punctuate": True, "format_text": True, "speaker_labels": False 
     }
     print(f"Solicitando transcripción para la URL: {audio_url} con parámetros: {data}")
-    try:
-        response = await client.post(transcript_endpoint, headers=headers, json=data)
+    if webhook_url:
+        data["webhook_url"] = webhook_url
+        if webhook_secret:
+            data["webhook_auth_header_name"] = ASSEMBLYAI_WEBHOOK_AUTH_HEADER
+            data["webhook_auth_header_value"] = webhook_secret
+        print(f"Finalización notificada por webhook en: {webhook_url}")
+
+    async def send() -> httpx.Response:
+        response = await client.post(transcript_endpoint, headers=headers, json=data, timeout=stage_timeout("transcript_request"))
         response.raise_for_status()
+        return response
+
+    try:
+        # Crear una transcripción no es idempotente: solo se repite si no llegó a procesarse
+        response = await call_with_resilience("assemblyai", "transcript_request", send, idempotent=False)
         result = response.json()
         print(f"Solicitud de transcripción enviada. ID: {result['id']}")
         return result["id"]
+    except HTTPException:
+        raise
     except httpx.HTTPStatusError as e:
         error_detail = "No se pudo obtener detalle del error"; 
         try: error_detail = e.response.json().get("error", e.response.text)
@@ -52,34 +90,71 @@ async def request_transcription(client: httpx.AsyncClient, audio_url: str, api_k
         print(f"Error inesperado al solicitar transcripción: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error interno al solicitar transcripción: {str(e)}")
 
-async def poll_for_transcription_result(client: httpx.AsyncClient, transcript_id: str, api_key: str) -> dict:
+def record_poll_timings(timings: dict | None, started: float, processing_since: float | None, poll_count: int) -> None:
+    # Reparte el tiempo de espera en AssemblyAI entre cola y procesamiento según
+    # el primer sondeo que vio el estado 'processing'.
+    if timings is None:
+        return
+    now = time.perf_counter()
+    if processing_since is None:
+        processing_since = now
+    timings["assemblyai_queued"] = processing_since - started
+    timings["assemblyai_processing"] = now - processing_since
+    timings["poll_count"] = poll_count
+
+async def fetch_transcription_status(client: httpx.AsyncClient, transcript_id: str, api_key: str) -> dict:
+    # Una única consulta de estado; la usan tanto el bucle clásico como el planificador de sondeos.
     polling_endpoint = f"{ASSEMBLYAI_BASE_URL}/transcript/{transcript_id}"
     headers = {"authorization": api_key}
+
+    async def send() -> httpx.Response:
+        response = await client.get(polling_endpoint, headers=headers, timeout=stage_timeout("poll"))
+        response.raise_for_status()
+        return response
+
+    try:
+        response = await call_with_resilience("assemblyai", "poll", send)
+        return response.json()
+    except HTTPException:
+        raise
+    except httpx.HTTPStatusError as e:
+        error_detail = "No se pudo obtener detalle del error"; 
+        try: error_detail = e.response.json().get("error", e.response.text)
+        except: pass
+        print(f"Error HTTP al consultar transcripción: {e.response.status_code} - {error_detail}")
+        raise HTTPException(status_code=502, detail=f"Error de AssemblyAI al obtener resultado de transcripción ({e.response.status_code}): {error_detail}")
+    except Exception as e:
+        print(f"Error inesperado al consultar transcripción: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error interno al obtener resultado: {str(e)}")
+
+def is_transcription_complete(result: dict) -> bool:
+    # True si terminó, False si sigue en cola/procesando; lanza HTTPException si falló.
+    if result['status'] == 'completed':
+        return True
+    elif result['status'] == 'error':
+        error_msg = result.get('error', 'Error desconocido en la transcripción de AssemblyAI.')
+        print(f"Error en la transcripción de AssemblyAI: {error_msg}")
+        raise HTTPException(status_code=400, detail=f"Error de AssemblyAI en la transcripción: {error_msg}")
+    elif result['status'] in ['queued', 'processing']:
+        return False
+    print(f"Estado desconocido de AssemblyAI: {result['status']}")
+    raise HTTPException(status_code=500, detail=f"Estado de transcripción desconocido de AssemblyAI: {result['status']}")
+
+async def poll_for_transcription_result(client: httpx.AsyncClient, transcript_id: str, api_key: str, timings: dict | None = None) -> dict:
+    # Bucle de sondeo clásico (intervalo fijo de 5 s). El servidor usa
+    # TranscriptionPollScheduler; esto queda para scripts y usos sin planificador.
+    started = time.perf_counter()
+    processing_since = None
+    poll_count = 0
     while True:
         print(f"Consultando estado de la transcripción ID: {transcript_id}...")
-        try:
-            response = await client.get(polling_endpoint, headers=headers)
-            response.raise_for_status()
-            result = response.json()
-            if result['status'] == 'completed':
-                print("Transcripción completada.")
-                return result
-            elif result['status'] == 'error':
-                error_msg = result.get('error', 'Error desconocido en la transcripción de AssemblyAI.')
-                print(f"Error en la transcripción de AssemblyAI: {error_msg}")
-                raise HTTPException(status_code=400, detail=f"Error de AssemblyAI en la transcripción: {error_msg}")
-            elif result['status'] in ['queued', 'processing']:
-                print(f"Estado de la transcripción: {result['status']}. Esperando 5 segundos...")
-                await asyncio.sleep(5)
-            else:
-                print(f"Estado desconocido de AssemblyAI: {result['status']}")
-                raise HTTPException(status_code=500, detail=f"Estado de transcripción desconocido de AssemblyAI: {result['status']}")
-        except httpx.HTTPStatusError as e:
-            error_detail = "No se pudo obtener detalle del error"; 
-            try: error_detail = e.response.json().get("error", e.response.text)
-            except: pass
-            print(f"Error HTTP al consultar transcripción: {e.response.status_code} - {error_detail}")
-            raise HTTPException(status_code=502, detail=f"Error de AssemblyAI al obtener resultado de transcripción ({e.response.status_code}): {error_detail}")
-        except Exception as e:
-            print(f"Error inesperado al consultar transcripción: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Error interno al obtener resultado: {str(e)}")
\ No newline at end of file
+        result = await fetch_transcription_status(client, transcript_id, api_key)
+        poll_count += 1
+        if result['status'] == 'processing' and processing_since is None:
+            processing_since = time.perf_counter()
+        if is_transcription_complete(result):
+            print("Transcripción completada.")
+            record_poll_timings(timings, started, processing_since, poll_count)
+            return result
+        print(f"Estado de la transcripción: {result['status']}. Esperando 5 segundos...")
+        await asyncio.sleep(5)
\ No newline at end of file
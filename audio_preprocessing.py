@@ -0,0 +1,141 @@
+# E:\PROJECTS\voice_test\audio_preprocessing.py
+
+import os
+import time
+import shutil
+import asyncio
+import tempfile
+
+from metrics import Counter, Histogram
+
+# Configuración del preprocesado (ffmpeg)
+FFMPEG_BINARY = os.getenv("FFMPEG_BINARY", "ffmpeg")
+FFPROBE_BINARY = os.getenv("FFPROBE_BINARY", "ffprobe")
+AUDIO_PREPROCESS_SAMPLE_RATE = int(os.getenv("AUDIO_PREPROCESS_SAMPLE_RATE", "16000"))
+AUDIO_PREPROCESS_BITRATE = os.getenv("AUDIO_PREPROCESS_BITRATE", "24k")
+AUDIO_PREPROCESS_SILENCE_DB = float(os.getenv("AUDIO_PREPROCESS_SILENCE_DB", "-45"))
+AUDIO_PREPROCESS_MAX_PAUSE = float(os.getenv("AUDIO_PREPROCESS_MAX_PAUSE", "1.0"))
+# Ajustes que cambian el audio que se transcribe: forman parte de la clave de la caché de resultados
+AUDIO_PREPROCESS_SETTINGS = (f"{AUDIO_PREPROCESS_SAMPLE_RATE}-{AUDIO_PREPROCESS_BITRATE}-{AUDIO_PREPROCESS_SILENCE_DB:g}"
+                             f"-{AUDIO_PREPROCESS_MAX_PAUSE:g}")
+AUDIO_PREPROCESS_TIMEOUT = float(os.getenv("AUDIO_PREPROCESS_TIMEOUT", "120"))
+AUDIO_PREPROCESS_MAX_CONCURRENT = int(os.getenv("AUDIO_PREPROCESS_MAX_CONCURRENT", str(os.cpu_count() or 2)))
+
+PREPROCESS_BYTES_SAVED = Counter("audio_preprocess_bytes_saved_total", "Bytes de audio ahorrados por el preprocesado antes de subir a AssemblyAI.")
+PREPROCESS_RESULTS = Counter("audio_preprocess_total", "Ejecuciones del preprocesado de audio por resultado.", ("outcome",))
+PREPROCESS_RATIO = Histogram("audio_preprocess_size_ratio", "Tamaño procesado / tamaño original.",
+                             buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5))
+
+_preprocess_slots: asyncio.Semaphore | None = None
+
+def _slots() -> asyncio.Semaphore:
+    global _preprocess_slots
+    if _preprocess_slots is None:
+        _preprocess_slots = asyncio.Semaphore(max(1, AUDIO_PREPROCESS_MAX_CONCURRENT))
+    return _preprocess_slots
+
+def ffmpeg_available() -> bool:
+    return shutil.which(FFMPEG_BINARY) is not None
+
+def _ffmpeg_args(src_path: str, dest_path: str) -> list[str]:
+    # mono + 16 kHz, recorte del silencio inicial/final y de las pausas largas
+    # (se conservan como mucho AUDIO_PREPROCESS_MAX_PAUSE segundos), y Opus de voz.
+    silence_filter = (
+        f"silenceremove=start_periods=1:start_duration=0.2:start_threshold={AUDIO_PREPROCESS_SILENCE_DB}dB"
+        f":stop_periods=-1:stop_duration={AUDIO_PREPROCESS_MAX_PAUSE}:stop_threshold={AUDIO_PREPROCESS_SILENCE_DB}dB"
+        f":stop_silence={AUDIO_PREPROCESS_MAX_PAUSE / 2}"
+    )
+    return [
+        "-loglevel", "error", "-y",
+        "-i", src_path,
+        "-vn", "-ac", "1", "-ar", str(AUDIO_PREPROCESS_SAMPLE_RATE),
+        "-af", silence_filter,
+        "-c:a", "libopus", "-b:a", AUDIO_PREPROCESS_BITRATE, "-application", "voip",
+        dest_path,
+    ]
+
+async def probe_audio_duration(path: str) -> float | None:
+    if shutil.which(FFPROBE_BINARY) is None:
+        return None
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            FFPROBE_BINARY, "-v", "error", "-show_entries", "format=duration", "-of", "default=nw=1:nk=1", path,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+        )
+        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=30)
+        return float(stdout.decode().strip())
+    except Exception:
+        return None
+
+async def run_ffmpeg(args: list[str], timeout: float = AUDIO_PREPROCESS_TIMEOUT) -> str:
+    # Lanza ffmpeg como subproceso (acotado por AUDIO_PREPROCESS_MAX_CONCURRENT) y
+    # devuelve su stderr. Lanza RuntimeError si falla o supera el tiempo máximo.
+    async with _slots():
+        proc = await asyncio.create_subprocess_exec(
+            FFMPEG_BINARY, "-nostdin", "-hide_banner", *args,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            _, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise RuntimeError(f"ffmpeg superó el tiempo máximo de {timeout} s")
+        except asyncio.CancelledError:
+            proc.kill()
+            await proc.wait()
+            raise
+    output = stderr.decode(errors="replace")
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg terminó con código {proc.returncode}: {output[-500:]}")
+    return output
+
+async def preprocess_audio_file(src_path: str) -> dict | None:
+    # Ejecuta ffmpeg en un proceso aparte (no bloquea el event loop). Devuelve
+    # None si no se pudo preprocesar; en ese caso se sube el audio original.
+    # El llamador debe borrar result["work_dir"] cuando termine la subida.
+    if not ffmpeg_available():
+        print(f"Advertencia: '{FFMPEG_BINARY}' no está disponible; se sube el audio sin preprocesar.")
+        PREPROCESS_RESULTS.inc(outcome="sin_ffmpeg")
+        return None
+
+    work_dir = tempfile.mkdtemp(prefix="preproc_")
+    dest_path = os.path.join(work_dir, "audio.ogg")
+    started = time.perf_counter()
+    try:
+        await run_ffmpeg(_ffmpeg_args(src_path, dest_path))
+        original_bytes = os.path.getsize(src_path)
+        processed_bytes = os.path.getsize(dest_path)
+    except asyncio.CancelledError:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+    except Exception as e:
+        print(f"Error en el preprocesado de audio, se usará el original: {e}")
+        PREPROCESS_RESULTS.inc(outcome="error")
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return None
+
+    if processed_bytes == 0 or processed_bytes >= original_bytes:
+        # Nada que ganar (audio ya compacto o recorte vacío): se sube el original.
+        print(f"Preprocesado descartado: {original_bytes} -> {processed_bytes} bytes.")
+        PREPROCESS_RESULTS.inc(outcome="descartado")
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return None
+
+    duration = await probe_audio_duration(dest_path)
+    seconds = time.perf_counter() - started
+    saved = original_bytes - processed_bytes
+    PREPROCESS_RESULTS.inc(outcome="ok")
+    PREPROCESS_BYTES_SAVED.inc(saved)
+    PREPROCESS_RATIO.observe(processed_bytes / original_bytes)
+    print(f"Audio preprocesado en {seconds:.2f} s: {original_bytes} -> {processed_bytes} bytes "
+          f"({saved} ahorrados, duración {duration if duration is not None else '?'} s).")
+    return {
+        "path": dest_path,
+        "work_dir": work_dir,
+        "original_bytes": original_bytes,
+        "processed_bytes": processed_bytes,
+        "bytes_saved": saved,
+        "duration_seconds": duration,
+        "seconds": seconds,
+    }
\ No newline at end of file
@@ -0,0 +1,200 @@
+# E:\PROJECTS\voice_test\batch_cli.py
+#
+# Procesa sin servidor HTTP un directorio de grabaciones archivadas: cada audio
+# pasa por el mismo flujo que la API (AssemblyAI -> Gemini -> PDF) y se escriben
+# <audio>.pdf y <audio>.json (transcripción y datos extraídos) en el directorio
+# de salida. Las llamadas a AssemblyAI y Gemini corren en asyncio con límites de
+# concurrencia y los PDF se generan en un pool de procesos.
+# manifiesto.json registra cada archivo terminado (con su hash): si la ejecución
+# se interrumpe, al repetirla se saltan los ya completados. Uso:
+#   python batch_cli.py grabaciones/ [--salida pdf/] [--recursivo] [--preprocesar]
+
+import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+from datetime import datetime
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+from http_client import build_http_client
+from pipeline import run_dictation_pipeline, use_pdf_process_pool, shutdown_pdf_executor
+from gemini_service import configure_gemini, shutdown_gemini
+from transcription_scheduler import TranscriptionPollScheduler
+
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".m4a", ".ogg", ".opus", ".flac", ".webm", ".aac", ".mp4")
+MANIFEST_FILENAME = "manifiesto.json"
+
+class BatchManifest:
+    # Estado por archivo (ruta relativa): hash, estado, salidas, tiempos y error.
+    # Se reescribe de forma atómica tras cada archivo.
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.entries = json.load(f).get("archivos", {})
+
+    def is_completed(self, relative_path: str, audio_sha256: str, output_dir: str) -> bool:
+        entry = self.entries.get(relative_path)
+        return (entry is not None and entry.get("estado") == "completado" and entry.get("sha256") == audio_sha256
+                and os.path.exists(os.path.join(output_dir, entry["pdf"])))
+
+    def record(self, relative_path: str, entry: dict) -> None:
+        self.entries[relative_path] = entry
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"actualizado": datetime.utcnow().isoformat() + "Z", "archivos": self.entries}, f, ensure_ascii=False,
+                      indent=2)
+        os.replace(tmp_path, self.path)
+
+def find_audio_files(input_dir: str, recursive: bool) -> list[str]:
+    # Rutas relativas a input_dir, ordenadas para que el orden sea estable entre ejecuciones
+    found = []
+    for root, dirs, files in os.walk(input_dir):
+        if not recursive:
+            dirs.clear()
+        for name in files:
+            if name.lower().endswith(AUDIO_EXTENSIONS):
+                found.append(os.path.relpath(os.path.join(root, name), input_dir))
+    return sorted(found)
+
+def _sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _write_outputs(output_dir: str, relative_path: str, result: dict) -> tuple[str, str]:
+    base = os.path.splitext(relative_path)[0]
+    pdf_relative, json_relative = f"{base}.pdf", f"{base}.json"
+    os.makedirs(os.path.dirname(os.path.join(output_dir, pdf_relative)), exist_ok=True)
+    with open(os.path.join(output_dir, pdf_relative), "wb") as f:
+        f.write(result["pdf_bytes"])
+    with open(os.path.join(output_dir, json_relative), "w", encoding="utf-8") as f:
+        json.dump({"transcript_id": result["transcript_id"], "pdf_filename": result["pdf_filename"],
+                   "transcribed_text": result["transcribed_text"], "extracted_json_data": result["extracted_json_data"]},
+                  f, ensure_ascii=False, indent=2)
+    return pdf_relative, json_relative
+
+async def process_file(relative_path: str, args, client, poll_scheduler, stage_limits: dict, manifest: BatchManifest,
+                       stats: dict) -> None:
+    loop = asyncio.get_running_loop()
+    audio_path = os.path.join(args.directorio, relative_path)
+    audio_sha256 = await loop.run_in_executor(None, _sha256_file, audio_path)
+    if manifest.is_completed(relative_path, audio_sha256, args.salida):
+        stats["saltados"] += 1
+        return
+
+    started = time.perf_counter()
+    try:
+        result = await run_dictation_pipeline(client, None, args.assemblyai_key, args.gemini_key, stage_limits=stage_limits,
+                                              poll_scheduler=poll_scheduler, audio_path=audio_path,
+                                              preprocess=args.preprocesar)
+        pdf_relative, json_relative = await loop.run_in_executor(None, _write_outputs, args.salida, relative_path, result)
+    except HTTPException as e:
+        stats["fallidos"] += 1
+        print(f"[fallo] {relative_path} ({e.status_code}): {e.detail}")
+        manifest.record(relative_path, {"estado": "fallido", "sha256": audio_sha256, "status_code": e.status_code,
+                                        "error": str(e.detail)})
+        return
+    except Exception as e:
+        stats["fallidos"] += 1
+        print(f"[fallo] {relative_path}: {type(e).__name__} - {e}")
+        manifest.record(relative_path, {"estado": "fallido", "sha256": audio_sha256, "status_code": 500, "error": str(e)})
+        return
+
+    elapsed = time.perf_counter() - started
+    stats["completados"] += 1
+    stats["timings"].append(result["timings"])
+    manifest.record(relative_path, {"estado": "completado", "sha256": audio_sha256, "transcript_id": result["transcript_id"],
+                                    "pdf": pdf_relative, "json": json_relative, "segundos": round(elapsed, 3),
+                                    "timings": {k: round(v, 4) for k, v in result["timings"].items()}})
+    print(f"[{stats['completados'] + stats['fallidos']}/{stats['pendientes']}] {relative_path} -> {pdf_relative} ({elapsed:.1f} s)")
+
+def _percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def print_summary(stats: dict, wall_seconds: float) -> None:
+    print("\n--- Resumen ---")
+    print(f"Completados: {stats['completados']}, fallidos: {stats['fallidos']}, "
+          f"saltados (ya en el manifiesto): {stats['saltados']}")
+    minutes = wall_seconds / 60
+    throughput = stats["completados"] / minutes if minutes else 0.0
+    print(f"Tiempo total: {wall_seconds:.1f} s; rendimiento: {throughput:.2f} archivos/min")
+    stages: dict[str, list[float]] = {}
+    for timings in stats["timings"]:
+        for stage, seconds in timings.items():
+            if stage not in ("pdf_bytes", "poll_count"):
+                stages.setdefault(stage, []).append(seconds)
+    if stages:
+        print(f"{'Etapa':<26}{'media (s)':>12}{'p50 (s)':>10}{'p95 (s)':>10}")
+        for stage, values in stages.items():
+            print(f"{stage:<26}{sum(values) / len(values):>12.2f}{_percentile(values, 0.5):>10.2f}"
+                  f"{_percentile(values, 0.95):>10.2f}")
+
+async def run_batch(args) -> dict:
+    os.makedirs(args.salida, exist_ok=True)
+    manifest = BatchManifest(os.path.join(args.salida, MANIFEST_FILENAME))
+    files = find_audio_files(args.directorio, args.recursivo)
+    stats = {"completados": 0, "fallidos": 0, "saltados": 0, "pendientes": len(files), "timings": []}
+    print(f"{len(files)} audios en {args.directorio}; salida en {args.salida}")
+
+    configure_gemini(args.gemini_key)
+    pdf_engine = use_pdf_process_pool(args.procesos_pdf)
+    await pdf_engine.start()
+    # Los PDF esperan turno aquí en lugar de desbordar la cola acotada del motor
+    stage_limits = {"assemblyai": asyncio.Semaphore(args.concurrencia_assemblyai),
+                    "gemini": asyncio.Semaphore(args.concurrencia_gemini),
+                    "pdf": asyncio.Semaphore(pdf_engine.max_pending)}
+    client = build_http_client()
+    poll_scheduler = TranscriptionPollScheduler(client, args.assemblyai_key)
+    poll_scheduler.start()
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(process_file(relative_path, args, client, poll_scheduler, stage_limits, manifest, stats)
+                               for relative_path in files))
+    finally:
+        print_summary(stats, time.perf_counter() - started)
+        await poll_scheduler.stop()
+        await client.aclose()
+        shutdown_gemini()
+        shutdown_pdf_executor()
+    return stats
+
+def parse_args(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description="Genera las historias en PDF de un directorio de grabaciones.")
+    parser.add_argument("directorio", help="Directorio con los audios.")
+    parser.add_argument("--salida", help="Directorio de salida (por defecto <directorio>/pdf).")
+    parser.add_argument("--recursivo", action="store_true", help="Incluir subdirectorios.")
+    parser.add_argument("--preprocesar", action="store_true", help="Preprocesar el audio con ffmpeg antes de subirlo.")
+    parser.add_argument("--concurrencia-assemblyai", type=int, default=int(os.getenv("BATCH_ASSEMBLYAI_CONCURRENCY", "8")),
+                        help="Archivos transcribiéndose a la vez (8).")
+    parser.add_argument("--concurrencia-gemini", type=int, default=int(os.getenv("BATCH_GEMINI_CONCURRENCY", "4")),
+                        help="Llamadas simultáneas a Gemini (4).")
+    parser.add_argument("--procesos-pdf", type=int, default=os.cpu_count() or 1,
+                        help="Procesos para generar los PDF (número de núcleos).")
+    args = parser.parse_args(argv)
+    args.salida = args.salida or os.path.join(args.directorio, "pdf")
+    return args
+
+if __name__ == "__main__":
+    load_dotenv()
+    args = parse_args()
+    args.assemblyai_key = os.getenv("ASSEMBLYAI_API_KEY")
+    args.gemini_key = os.getenv("GEMINI_API_KEY")
+    if not args.assemblyai_key or not args.gemini_key:
+        sys.exit("Error: ASSEMBLYAI_API_KEY y GEMINI_API_KEY deben estar configuradas (archivo .env o variables de entorno).")
+    if not os.path.isdir(args.directorio):
+        sys.exit(f"Error: '{args.directorio}' no es un directorio.")
+    try:
+        stats = asyncio.run(run_batch(args))
+    except KeyboardInterrupt:
+        sys.exit("\nInterrumpido. Vuelve a ejecutar el mismo comando para continuar: los archivos terminados se saltarán.")
+    sys.exit(1 if stats["fallidos"] else 0)
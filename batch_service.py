@@ -0,0 +1,120 @@
+# E:\PROJECTS\voice_test\batch_service.py
+
+import os
+import json
+import time
+import shutil
+import asyncio
+import zipfile
+from datetime import datetime
+from typing import AsyncIterator
+import httpx
+from fastapi import HTTPException
+
+from pipeline import run_dictation_pipeline
+from result_cache import ResultCache
+from record_store import RecordStore
+from transcription_scheduler import TranscriptionPollScheduler
+
+class _ZipChunkBuffer:
+    # Destino de escritura sin seek para zipfile: acumula lo escrito y se vacía
+    # tras cada entrada, de modo que el ZIP se envía mientras se construye.
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+def _unique_name(name: str, used_names: set) -> str:
+    if name not in used_names:
+        used_names.add(name)
+        return name
+    base, ext = os.path.splitext(name)
+    i = 2
+    while f"{base}_{i}{ext}" in used_names:
+        i += 1
+    unique = f"{base}_{i}{ext}"
+    used_names.add(unique)
+    return unique
+
+async def _process_batch_item(index: int, item: dict, client: httpx.AsyncClient, assemblyai_api_key: str, gemini_api_key: str,
+                              stage_limits: dict, cache: ResultCache | None,
+                              poll_scheduler: TranscriptionPollScheduler | None, preprocess: bool,
+                              records: RecordStore | None = None) -> dict:
+    started = time.perf_counter()
+    try:
+        result = await run_dictation_pipeline(client, None, assemblyai_api_key, gemini_api_key,
+                                              cache=cache, audio_sha256=item["audio_sha256"], stage_limits=stage_limits,
+                                              poll_scheduler=poll_scheduler, audio_path=item["audio_path"], preprocess=preprocess,
+                                              records=records)
+        return {"index": index, "ok": True, "result": result, "elapsed": time.perf_counter() - started}
+    except HTTPException as e:
+        print(f"Lote: el archivo '{item['original_filename']}' falló ({e.status_code}): {e.detail}")
+        return {"index": index, "ok": False, "status_code": e.status_code, "detail": str(e.detail),
+                "elapsed": time.perf_counter() - started}
+    except Exception as e:
+        print(f"Lote: error inesperado con '{item['original_filename']}': {type(e).__name__} - {e}")
+        return {"index": index, "ok": False, "status_code": 500,
+                "detail": f"Ocurrió un error interno inesperado en el servidor: {str(e)}", "elapsed": time.perf_counter() - started}
+
+async def stream_batch_zip(items: list[dict], work_dir: str, client: httpx.AsyncClient, assemblyai_api_key: str, gemini_api_key: str,
+                           stage_limits: dict, cache: ResultCache | None = None,
+                           poll_scheduler: TranscriptionPollScheduler | None = None,
+                           preprocess: bool = False, records: RecordStore | None = None) -> AsyncIterator[bytes]:
+    # Procesa todos los audios del lote en paralelo (acotado por stage_limits) y
+    # emite cada PDF dentro del ZIP en cuanto termina. Los fallos no abortan el
+    # lote: se anotan en errores/<audio>.json y en manifiesto.json al final.
+    buffer = _ZipChunkBuffer()
+    used_names: set = set()
+    manifest_items: list[dict | None] = [None] * len(items)
+    batch_started = time.perf_counter()
+    tasks = [asyncio.create_task(_process_batch_item(i, item, client, assemblyai_api_key, gemini_api_key, stage_limits, cache,
+                                                     poll_scheduler, preprocess, records))
+             for i, item in enumerate(items)]
+    try:
+        with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for next_done in asyncio.as_completed(tasks):
+                outcome = await next_done
+                item = items[outcome["index"]]
+                entry = {"archivo_audio": item["original_filename"], "tiempo_segundos": round(outcome["elapsed"], 3)}
+                if outcome["ok"]:
+                    result = outcome["result"]
+                    pdf_name = _unique_name(result["pdf_filename"], used_names)
+                    zf.writestr(pdf_name, result["pdf_bytes"])
+                    entry.update({"estado": "ok", "pdf": pdf_name, "transcript_id": result["transcript_id"],
+                                  "cache_hit": result["cache_hit"]})
+                else:
+                    error_name = _unique_name(f"errores/{os.path.splitext(item['original_filename'] or 'audio')[0]}.json", used_names)
+                    entry.update({"estado": "error", "status_code": outcome["status_code"], "detalle": outcome["detail"],
+                                  "archivo_error": error_name})
+                    zf.writestr(error_name, json.dumps(entry, ensure_ascii=False, indent=2))
+                manifest_items[outcome["index"]] = entry
+                yield buffer.drain()
+
+            manifest = {
+                "generado": datetime.utcnow().isoformat() + "Z",
+                "total": len(items),
+                "correctos": sum(1 for e in manifest_items if e and e["estado"] == "ok"),
+                "fallidos": sum(1 for e in manifest_items if e and e["estado"] == "error"),
+                "tiempo_total_segundos": round(time.perf_counter() - batch_started, 3),
+                "archivos": manifest_items,
+            }
+            zf.writestr("manifiesto.json", json.dumps(manifest, ensure_ascii=False, indent=2))
+            print(f"Lote terminado: {manifest['correctos']} correctos, {manifest['fallidos']} fallidos en {manifest['tiempo_total_segundos']} s.")
+        yield buffer.drain()
+    finally:
+        # Si el cliente corta la descarga se cancelan los archivos pendientes.
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        shutil.rmtree(work_dir, ignore_errors=True)
\ No newline at end of file
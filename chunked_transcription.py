@@ -0,0 +1,151 @@
+# E:\PROJECTS\voice_test\chunked_transcription.py
+
+import os
+import re
+import shutil
+import asyncio
+import difflib
+import tempfile
+import unicodedata
+
+from metrics import Counter, Histogram
+from audio_preprocessing import ffmpeg_available, probe_audio_duration, run_ffmpeg, AUDIO_PREPROCESS_SAMPLE_RATE, AUDIO_PREPROCESS_BITRATE
+
+# Transcripción por fragmentos: los dictados largos se cortan en silencios en
+# segmentos solapados que se transcriben en paralelo y luego se vuelven a unir.
+CHUNKED_TRANSCRIPTION_ENABLED = os.getenv("CHUNKED_TRANSCRIPTION_ENABLED", "false").lower() in ("1", "true", "yes")
+CHUNKED_TRANSCRIPTION_MIN_SECONDS = float(os.getenv("CHUNKED_TRANSCRIPTION_MIN_SECONDS", "300"))
+CHUNKED_TRANSCRIPTION_SEGMENT_SECONDS = float(os.getenv("CHUNKED_TRANSCRIPTION_SEGMENT_SECONDS", "120"))
+CHUNKED_TRANSCRIPTION_OVERLAP_SECONDS = float(os.getenv("CHUNKED_TRANSCRIPTION_OVERLAP_SECONDS", "2"))
+CHUNKED_TRANSCRIPTION_SEARCH_SECONDS = float(os.getenv("CHUNKED_TRANSCRIPTION_SEARCH_SECONDS", "20"))
+CHUNKED_TRANSCRIPTION_SILENCE_DB = float(os.getenv("CHUNKED_TRANSCRIPTION_SILENCE_DB", "-40"))
+CHUNKED_TRANSCRIPTION_MIN_SILENCE = float(os.getenv("CHUNKED_TRANSCRIPTION_MIN_SILENCE", "0.4"))
+# Ajustes que cambian los cortes y la unión del texto: forman parte de la clave de la caché de resultados
+CHUNKED_TRANSCRIPTION_SETTINGS = (f"{CHUNKED_TRANSCRIPTION_MIN_SECONDS:g}-{CHUNKED_TRANSCRIPTION_SEGMENT_SECONDS:g}"
+                                  f"-{CHUNKED_TRANSCRIPTION_OVERLAP_SECONDS:g}-{CHUNKED_TRANSCRIPTION_SEARCH_SECONDS:g}"
+                                  f"-{CHUNKED_TRANSCRIPTION_SILENCE_DB:g}-{CHUNKED_TRANSCRIPTION_MIN_SILENCE:g}")
+
+CHUNKED_SEGMENTS = Histogram("chunked_transcription_segments", "Segmentos por dictado transcrito en paralelo.",
+                             buckets=(2, 3, 4, 6, 8, 12, 16, 24))
+CHUNKED_SECONDS_SAVED = Counter("chunked_transcription_seconds_saved_total",
+                                "Segundos de reloj ahorrados (estimados) frente a transcribir el archivo completo.")
+CHUNKED_RESULTS = Counter("chunked_transcription_total", "Dictados largos por resultado del troceado.", ("outcome",))
+
+_SILENCE_RE = re.compile(r"silence_(start|end): (-?[0-9.]+)")
+
+async def detect_silences(path: str) -> list[tuple[float, float]]:
+    # Intervalos de silencio (inicio, fin) según el filtro silencedetect de ffmpeg.
+    output = await run_ffmpeg([
+        "-loglevel", "info", "-i", path, "-vn",
+        "-af", f"silencedetect=noise={CHUNKED_TRANSCRIPTION_SILENCE_DB}dB:d={CHUNKED_TRANSCRIPTION_MIN_SILENCE}",
+        "-f", "null", "-",
+    ])
+    silences = []
+    current_start = None
+    for kind, value in _SILENCE_RE.findall(output):
+        if kind == "start":
+            current_start = max(0.0, float(value))
+        elif current_start is not None:
+            silences.append((current_start, float(value)))
+            current_start = None
+    return silences
+
+def plan_segments(duration: float, silences: list[tuple[float, float]], segment_seconds: float = CHUNKED_TRANSCRIPTION_SEGMENT_SECONDS,
+                  overlap_seconds: float = CHUNKED_TRANSCRIPTION_OVERLAP_SECONDS,
+                  search_seconds: float = CHUNKED_TRANSCRIPTION_SEARCH_SECONDS) -> list[tuple[float, float]]:
+    # Corta cerca de cada múltiplo de segment_seconds, en el silencio más largo
+    # dentro de ±search_seconds (o en el punto exacto si no hay ninguno), y
+    # extiende cada segmento overlap_seconds por ambos lados.
+    cuts = []
+    position = 0.0
+    while duration - position > segment_seconds * 1.25:
+        target = position + segment_seconds
+        candidates = [(end - start, (start + end) / 2) for start, end in silences
+                      if abs((start + end) / 2 - target) <= search_seconds and (start + end) / 2 > position + segment_seconds / 2]
+        cut = max(candidates)[1] if candidates else target
+        cuts.append(cut)
+        position = cut
+
+    bounds = [0.0] + cuts + [duration]
+    return [(max(0.0, bounds[i] - overlap_seconds), min(duration, bounds[i + 1] + overlap_seconds))
+            for i in range(len(bounds) - 1)]
+
+async def split_audio(path: str, segments: list[tuple[float, float]], work_dir: str) -> list[str]:
+    # Extrae los segmentos en paralelo (mono, 16 kHz, Opus) dentro de work_dir.
+    async def extract(index: int, start: float, end: float) -> str:
+        dest_path = os.path.join(work_dir, f"segmento_{index:03d}.ogg")
+        await run_ffmpeg([
+            "-loglevel", "error", "-y", "-ss", f"{start:.3f}", "-t", f"{end - start:.3f}", "-i", path,
+            "-vn", "-ac", "1", "-ar", str(AUDIO_PREPROCESS_SAMPLE_RATE),
+            "-c:a", "libopus", "-b:a", AUDIO_PREPROCESS_BITRATE, "-application", "voip", dest_path,
+        ])
+        return dest_path
+
+    return list(await asyncio.gather(*(extract(i, start, end) for i, (start, end) in enumerate(segments))))
+
+async def prepare_segments(path: str, duration_hint: float | None = None) -> dict | None:
+    # Devuelve el plan de troceado o None si el audio debe transcribirse entero
+    # (modo desactivado, sin ffmpeg, por debajo del umbral o error al cortar).
+    # El llamador debe borrar result["work_dir"] al terminar.
+    if not CHUNKED_TRANSCRIPTION_ENABLED or not ffmpeg_available():
+        return None
+    duration = duration_hint if duration_hint is not None else await probe_audio_duration(path)
+    if duration is None or duration < CHUNKED_TRANSCRIPTION_MIN_SECONDS:
+        return None
+
+    work_dir = tempfile.mkdtemp(prefix="segmentos_")
+    try:
+        silences = await detect_silences(path)
+        segments = plan_segments(duration, silences)
+        if len(segments) < 2:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            return None
+        paths = await split_audio(path, segments, work_dir)
+    except asyncio.CancelledError:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+    except Exception as e:
+        print(f"Error al trocear el audio, se transcribirá entero: {e}")
+        CHUNKED_RESULTS.inc(outcome="error_troceado")
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return None
+
+    print(f"Audio de {duration:.0f} s troceado en {len(segments)} segmentos ({len(silences)} silencios detectados).")
+    return {"duration_seconds": duration, "segments": segments, "paths": paths, "work_dir": work_dir}
+
+def _normalize_word(word: str) -> str:
+    word = unicodedata.normalize("NFKD", word.lower())
+    return "".join(c for c in word if c.isalnum())
+
+def stitch_transcripts(texts: list[str], max_overlap_words: int = 40, min_match_words: int = 2) -> str:
+    # Une los textos de segmentos consecutivos eliminando las palabras repetidas
+    # por el solapamiento: se busca la coincidencia más larga (sin mayúsculas,
+    # tildes ni puntuación) entre el final de uno y el principio del siguiente.
+    words: list[str] = []
+    for text in texts:
+        next_words = (text or "").split()
+        if not words:
+            words = next_words
+            continue
+        tail = words[-max_overlap_words:]
+        head = next_words[:max_overlap_words]
+        matcher = difflib.SequenceMatcher(None, [_normalize_word(w) for w in tail], [_normalize_word(w) for w in head],
+                                          autojunk=False)
+        match = matcher.find_longest_match(0, len(tail), 0, len(head))
+        if match.size >= min_match_words:
+            cut = len(words) - len(tail) + match.a
+            words = words[:cut] + next_words[match.b:]
+        else:
+            words = words + next_words
+    return " ".join(words)
+
+def estimate_time_saved(segment_durations: list[float], segment_seconds: list[float], total_duration: float,
+                        wall_seconds: float) -> dict:
+    # Línea base: un único archivo tarda lo mismo por segundo de audio que los
+    # segmentos (media ponderada, sin contar el solapamiento), en serie.
+    audio_seconds = sum(segment_durations)
+    rate = sum(segment_seconds) / audio_seconds if audio_seconds else 0.0
+    baseline = rate * total_duration
+    saved = max(0.0, baseline - wall_seconds)
+    return {"estimated_single_file_seconds": round(baseline, 3), "wall_seconds": round(wall_seconds, 3),
+            "seconds_saved": round(saved, 3)}
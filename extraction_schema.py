@@ -0,0 +1,251 @@
+# E:\PROJECTS\voice_test\extraction_schema.py
+
+# Instrucciones de sistema y esquema de respuesta para la extracción con Gemini.
+# Las instrucciones no cambian entre dictados, así que van como system
+# instruction (y en la caché de contexto si está disponible); en el contenido de
+# usuario solo viajan la fecha y la transcripción. El esquema obliga a Gemini a
+# devolver JSON válido con las mismas claves que espera create_pdf_from_json.
+#
+# Hay dos modos (GEMINI_EXTRACTION_MODE):
+# - "completo" (por defecto): el esquema completo con los nombres de campo originales.
+# - "compacto" (opcional): Gemini no repite la transcripción ni la fecha,
+#   omite los campos vacíos y usa claves cortas; expand_compact_extraction
+#   reconstruye en el servidor el diccionario completo. Menos tokens de salida,
+#   que son la parte más lenta de la llamada.
+
+import os
+
+EXTRACTION_MODE_COMPACT = "compacto"
+EXTRACTION_MODE_FULL = "completo"
+GEMINI_EXTRACTION_MODE = os.getenv("GEMINI_EXTRACTION_MODE", EXTRACTION_MODE_FULL)
+
+GEMINI_SYSTEM_INSTRUCTION = """Eres un asistente experto en extraer información de dictados de consultas odontológicas y formatearla en JSON.
+Recibirás la fecha y hora del dictado y el texto transcrito de una consulta odontológica. Extrae la información relevante siguiendo el esquema de respuesta.
+
+Instrucciones específicas:
+- "paciente_identificador_mencionado_opcional": nombre o ID del paciente si el dentista lo menciona; si no, string vacío.
+- "fecha_hora_dictado_aproximada": copia la fecha y hora del dictado que se te proporciona.
+- "texto_transcrito_original": el texto transcrito completo que se te proporciona.
+- "odontograma_completo": una entrada por cada pieza dental (número FDI, p. ej. "16", "48") mencionada explícitamente con algún hallazgo, diagnóstico o plan. Solo las piezas mencionadas; lista vacía si no se menciona ninguna. Para cada pieza:
+    - "pieza": número de la pieza.
+    - "diagnostico_hallazgo": qué se encontró o diagnosticó en esa pieza.
+    - "plan_tratamiento_sugerido": qué se planea hacer para esa pieza.
+    - "notas_adicionales": cualquier otra nota específica para esa pieza.
+  Ejemplo: pieza 16 con caries mesial profunda, plan endodoncia y corona; pieza 48 retenida, plan exodoncia profiláctica.
+- "procedimientos_realizados_sesion_detectados": procedimientos hechos en esta sesión, con pieza o región, descripción, anestesia, materiales y complicaciones mencionados.
+- Los demás campos (queja principal, historia de la enfermedad actual, antecedentes, hallazgos extraorales e intraorales, diagnósticos sugeridos, indicaciones postoperatorias, medicación, próxima cita y observaciones) se llenan con lo que diga el dictado.
+- Si alguna información no está presente en el texto, usa un string vacío "" para campos de texto y una lista vacía para campos de lista. No inventes datos."""
+
+def _string() -> dict:
+    return {"type": "STRING"}
+
+def _string_list() -> dict:
+    return {"type": "ARRAY", "items": _string()}
+
+def _object(properties: dict) -> dict:
+    return {"type": "OBJECT", "properties": properties, "required": list(properties)}
+
+# El odontograma es un objeto con los números de pieza como claves, pero el
+# esquema de Gemini no admite claves dinámicas: se pide como lista con "pieza"
+# y se convierte de vuelta en normalize_extraction.
+TOOTH_SCHEMA = _object({
+    "pieza": _string(),
+    "diagnostico_hallazgo": _string(),
+    "plan_tratamiento_sugerido": _string(),
+    "notas_adicionales": _string(),
+})
+_PROCEDURE_SCHEMA = _object({
+    "pieza_o_region_tratada": _string(),
+    "descripcion_procedimiento": _string(),
+    "anestesia_mencionada": _string(),
+    "materiales_mencionados": _string(),
+    "complicaciones_mencionadas": _string(),
+})
+
+GEMINI_RESPONSE_SCHEMA = _object({
+    "paciente_identificador_mencionado_opcional": _string(),
+    "fecha_hora_dictado_aproximada": _string(),
+    "texto_transcrito_original": _string(),
+    "queja_principal_detectada": _string(),
+    "historia_enfermedad_actual_detectada": _string(),
+    "antecedentes_medicos_relevantes_detectados": _string_list(),
+    "hallazgos_examen_extraoral_detectados": _string(),
+    "hallazgos_examen_intraoral_general_detectados": _string(),
+    "odontograma_completo": {"type": "ARRAY", "items": TOOTH_SCHEMA},
+    "diagnosticos_sugeridos_ia": _string_list(),
+    "procedimientos_realizados_sesion_detectados": {"type": "ARRAY", "items": _PROCEDURE_SCHEMA},
+    "indicaciones_postoperatorias_detectadas": _string(),
+    "medicacion_recetada_detectada": _string(),
+    "plan_proxima_cita_detectado": _string(),
+    "observaciones_generales_dictadas": _string(),
+})
+
+# --- Modo compacto ---
+GEMINI_COMPACT_SYSTEM_INSTRUCTION = """Eres un asistente experto en extraer información de dictados de consultas odontológicas y formatearla en JSON.
+Recibirás el texto transcrito de una consulta odontológica. Extrae la información relevante siguiendo el esquema de respuesta, que usa claves cortas:
+- "p": nombre o ID del paciente si el dentista lo menciona.
+- "q": queja principal. "h": historia de la enfermedad actual. "a": antecedentes médicos relevantes (lista).
+- "eo": hallazgos del examen extraoral. "io": hallazgos del examen intraoral general.
+- "o": una entrada por cada pieza dental (número FDI, p. ej. "16", "48") mencionada explícitamente con algún hallazgo, diagnóstico o plan, con "n" (número de pieza), "d" (diagnóstico o hallazgo), "t" (plan de tratamiento sugerido) y "x" (otras notas de esa pieza).
+  Ejemplo: pieza 16 con caries mesial profunda, plan endodoncia y corona; pieza 48 retenida, plan exodoncia profiláctica.
+- "dx": diagnósticos sugeridos (lista).
+- "pr": procedimientos realizados en esta sesión, con "r" (pieza o región), "d" (descripción), "an" (anestesia), "m" (materiales) y "c" (complicaciones).
+- "ip": indicaciones postoperatorias. "med": medicación recetada. "pc": plan para la próxima cita. "obs": observaciones generales.
+Reglas:
+- Omite cualquier campo o subcampo sin información en el dictado: no escribas strings vacíos ni listas vacías.
+- No repitas la transcripción. Sé literal y conciso. No inventes datos."""
+
+# clave corta -> (clave completa, valor por defecto)
+_COMPACT_FIELDS = {
+    "p": ("paciente_identificador_mencionado_opcional", ""),
+    "q": ("queja_principal_detectada", ""),
+    "h": ("historia_enfermedad_actual_detectada", ""),
+    "a": ("antecedentes_medicos_relevantes_detectados", []),
+    "eo": ("hallazgos_examen_extraoral_detectados", ""),
+    "io": ("hallazgos_examen_intraoral_general_detectados", ""),
+    "o": ("odontograma_completo", {}),
+    "dx": ("diagnosticos_sugeridos_ia", []),
+    "pr": ("procedimientos_realizados_sesion_detectados", []),
+    "ip": ("indicaciones_postoperatorias_detectadas", ""),
+    "med": ("medicacion_recetada_detectada", ""),
+    "pc": ("plan_proxima_cita_detectado", ""),
+    "obs": ("observaciones_generales_dictadas", ""),
+}
+_COMPACT_TOOTH_FIELDS = {"d": "diagnostico_hallazgo", "t": "plan_tratamiento_sugerido", "x": "notas_adicionales"}
+_COMPACT_PROCEDURE_FIELDS = {
+    "r": "pieza_o_region_tratada",
+    "d": "descripcion_procedimiento",
+    "an": "anestesia_mencionada",
+    "m": "materiales_mencionados",
+    "c": "complicaciones_mencionadas",
+}
+
+def _optional_object(properties: dict, required: tuple = ()) -> dict:
+    return {"type": "OBJECT", "properties": properties, "required": list(required)}
+
+GEMINI_COMPACT_RESPONSE_SCHEMA = _optional_object({
+    "p": _string(),
+    "q": _string(),
+    "h": _string(),
+    "a": _string_list(),
+    "eo": _string(),
+    "io": _string(),
+    "o": {"type": "ARRAY", "items": _optional_object({"n": _string(), "d": _string(), "t": _string(), "x": _string()},
+                                                     required=("n",))},
+    "dx": _string_list(),
+    "pr": {"type": "ARRAY", "items": _optional_object({k: _string() for k in _COMPACT_PROCEDURE_FIELDS})},
+    "ip": _string(),
+    "med": _string(),
+    "pc": _string(),
+    "obs": _string(),
+})
+
+def expand_compact_extraction(data: dict, current_timestamp: str) -> dict:
+    # Reconstruye el diccionario completo (mismas claves y tipos que el modo
+    # completo) a partir de la salida compacta. La fecha la pone el servidor y
+    # texto_transcrito_original lo rellena el flujo con la transcripción local.
+    if not isinstance(data, dict):
+        return data
+    expanded = {"fecha_hora_dictado_aproximada": current_timestamp, "texto_transcrito_original": ""}
+    for short_key, (full_key, default) in _COMPACT_FIELDS.items():
+        value = data.get(short_key)
+        expanded[full_key] = value if value is not None else (default.copy() if isinstance(default, (list, dict)) else default)
+
+    odontogram = {}
+    for entry in data.get("o") or []:
+        if isinstance(entry, dict) and str(entry.get("n", "")).strip():
+            odontogram[str(entry["n"]).strip()] = {full: entry.get(short, "") for short, full in _COMPACT_TOOTH_FIELDS.items()}
+    expanded["odontograma_completo"] = odontogram
+
+    expanded["procedimientos_realizados_sesion_detectados"] = [
+        {full: entry.get(short, "") for short, full in _COMPACT_PROCEDURE_FIELDS.items()}
+        for entry in data.get("pr") or [] if isinstance(entry, dict)
+    ]
+    return expanded
+
+def system_instruction_for(mode: str) -> str:
+    return GEMINI_COMPACT_SYSTEM_INSTRUCTION if mode == EXTRACTION_MODE_COMPACT else GEMINI_SYSTEM_INSTRUCTION
+
+def response_schema_for(mode: str) -> dict:
+    return GEMINI_COMPACT_RESPONSE_SCHEMA if mode == EXTRACTION_MODE_COMPACT else GEMINI_RESPONSE_SCHEMA
+
+def build_user_content(transcribed_text: str, current_timestamp: str, mode: str = EXTRACTION_MODE_FULL,
+                       segment: tuple[int, int] | None = None) -> str:
+    # segment=(n, total) en la extracción map-reduce de transcripciones largas
+    transcript_block = f"--- INICIO TEXTO TRANSCRITO ---\n{transcribed_text}\n--- FIN TEXTO TRANSCRITO ---"
+    if segment is not None:
+        transcript_block = (f"Fragmento {segment[0]} de {segment[1]} de un dictado más largo: extrae solo la información "
+                            f"que aparece en este fragmento.\n\n{transcript_block}")
+    if mode == EXTRACTION_MODE_COMPACT:
+        # La fecha la pone el servidor
+        return transcript_block
+    return f"Fecha y hora del dictado: {current_timestamp}\n\n{transcript_block}"
+
+def normalize_extraction(data: dict, mode: str = EXTRACTION_MODE_FULL, current_timestamp: str = "") -> dict:
+    # Devuelve el diccionario con la forma de siempre: odontograma_completo como
+    # objeto {pieza: {...}}. Acepta también el formato antiguo (ya objeto).
+    if mode == EXTRACTION_MODE_COMPACT:
+        return expand_compact_extraction(data, current_timestamp)
+    if not isinstance(data, dict):
+        return data
+    odontogram = data.get("odontograma_completo")
+    if isinstance(odontogram, list):
+        converted = {}
+        for entry in odontogram:
+            if not isinstance(entry, dict):
+                continue
+            tooth = str(entry.get("pieza", "")).strip()
+            if tooth:
+                converted[tooth] = {k: v for k, v in entry.items() if k != "pieza"}
+        data["odontograma_completo"] = converted
+    elif odontogram is None:
+        data["odontograma_completo"] = {}
+    return data
+
+# --- Secciones para el progreso en streaming ---
+# Eventos ("seccion" | "odontograma" | "procedimiento", datos) con los nombres
+# de campo completos, tanto para la salida en streaming como para un resultado
+# ya completo (p. ej. en caché).
+_ODONTOGRAM_KEYS = {EXTRACTION_MODE_COMPACT: "o", EXTRACTION_MODE_FULL: "odontograma_completo"}
+_PROCEDURE_KEYS = {EXTRACTION_MODE_COMPACT: "pr", EXTRACTION_MODE_FULL: "procedimientos_realizados_sesion_detectados"}
+# No se envían como sección: la transcripción ya la tiene el cliente y la fecha es del servidor
+_SECTION_EXCLUDED_FIELDS = frozenset({"texto_transcrito_original", "fecha_hora_dictado_aproximada"})
+
+def stream_item_keys(mode: str) -> tuple:
+    # Listas cuyos elementos se envían uno a uno según llegan
+    return _ODONTOGRAM_KEYS[mode], _PROCEDURE_KEYS[mode]
+
+def section_from_stream(mode: str, kind: str, key: str, value) -> tuple[str, dict] | None:
+    # Traduce un evento de IncrementalObjectParser ("campo" o "elemento") a una
+    # sección con nombres completos, o None si no se envía.
+    compact = mode == EXTRACTION_MODE_COMPACT
+    if kind == "elemento":
+        if not isinstance(value, dict):
+            return None
+        if key == _ODONTOGRAM_KEYS[mode]:
+            if compact:
+                return "odontograma", dict({"pieza": str(value.get("n", "")).strip()},
+                                           **{full: value.get(short, "") for short, full in _COMPACT_TOOTH_FIELDS.items()})
+            return "odontograma", value
+        if compact:
+            return "procedimiento", {full: value.get(short, "") for short, full in _COMPACT_PROCEDURE_FIELDS.items()}
+        return "procedimiento", value
+    full_key = _COMPACT_FIELDS.get(key, (key,))[0] if compact else key
+    if full_key in _SECTION_EXCLUDED_FIELDS or value in ("", [], {}, None):
+        return None
+    return "seccion", {"campo": full_key, "valor": value}
+
+def sections_from_extraction(data: dict) -> list[tuple[str, dict]]:
+    # Las mismas secciones a partir del diccionario completo ya normalizado.
+    sections = []
+    for key, value in data.items():
+        if key == "odontograma_completo" and isinstance(value, dict):
+            sections.extend(("odontograma", dict({"pieza": tooth}, **entry)) for tooth, entry in value.items()
+                            if isinstance(entry, dict))
+        elif key == "procedimientos_realizados_sesion_detectados" and isinstance(value, list):
+            sections.extend(("procedimiento", entry) for entry in value if isinstance(entry, dict))
+        else:
+            section = section_from_stream(EXTRACTION_MODE_FULL, "campo", key, value)
+            if section is not None:
+                sections.append(section)
+    return sections
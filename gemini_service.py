@@ -2,12 +2,59 @@
 
 import os
 import json
+import time
 import asyncio
-from datetime import datetime
+import hashlib
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable
 from fastapi import HTTPException
 import google.generativeai as genai
 
+from resilience import call_with_resilience, hedged, GEMINI_HEDGE_AFTER_SECONDS
+from metrics import Counter, Gauge, Histogram
+from extraction_schema import (GEMINI_EXTRACTION_MODE, system_instruction_for, response_schema_for, build_user_content,
+                               normalize_extraction, stream_item_keys, section_from_stream, sections_from_extraction)
+from map_reduce_extraction import should_map_reduce, split_transcript, run_map_reduce
+from incremental_json import IncrementalObjectParser
+
+GEMINI_MODEL_NAME = 'models/gemini-1.5-flash-latest'
+# Súbelo a mano cuando cambie la forma de interpretar la respuesta aunque el
+# texto del prompt siga igual.
+GEMINI_PROMPT_REVISION = "2"
+# Endpoint alternativo (p. ej. el Gemini simulado de mock_gemini.py); usa transporte REST
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT")
+# Ruta asíncrona nativa del SDK (gRPC asyncio). Con transporte REST (GEMINI_API_ENDPOINT)
+# no existe, y las llamadas van a un executor propio de GEMINI_EXECUTOR_WORKERS hilos.
+GEMINI_USE_ASYNC = os.getenv("GEMINI_USE_ASYNC", "true").lower() in ("1", "true", "yes")
+GEMINI_EXECUTOR_WORKERS = int(os.getenv("GEMINI_EXECUTOR_WORKERS", "8"))
+# Caché de contexto de Gemini para las instrucciones de sistema. Gemini exige un
+# mínimo de tokens y un modelo con versión fija; si no se cumple, se sigue sin caché.
+GEMINI_CONTEXT_CACHE_ENABLED = os.getenv("GEMINI_CONTEXT_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+GEMINI_CONTEXT_CACHE_TTL_SECONDS = float(os.getenv("GEMINI_CONTEXT_CACHE_TTL_SECONDS", "3600"))
+
+GEMINI_IN_FLIGHT = Gauge("gemini_requests_in_flight", "Llamadas a Gemini en curso por modo (async, executor).", ("mode",))
+GEMINI_REQUESTS = Counter("gemini_requests_total", "Llamadas a Gemini por modo y resultado.", ("mode", "outcome"))
+GEMINI_TOKENS = Counter("gemini_tokens_total", "Tokens de Gemini por tipo (prompt, cached, output).", ("kind",))
+GEMINI_STREAM_FIRST_SECTION_SECONDS = Histogram("gemini_stream_first_section_seconds",
+                                                "Segundos desde la petición en streaming hasta la primera sección completa.",
+                                                buckets=(0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30))
+GEMINI_OUTPUT_TOKENS = Histogram("gemini_output_tokens", "Tokens de salida por llamada a Gemini y modo de extracción.",
+                                 ("extraction_mode",), buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192))
+
+_gemini_model: genai.GenerativeModel | None = None
+_gemini_model_key: str | None = None
+_gemini_executor: ThreadPoolExecutor | None = None
+# Momento (time.time()) en que caduca la caché de contexto del modelo actual
+_gemini_cache_expires_at: float | None = None
+_context_cache_unavailable = False
+_configure_lock = threading.Lock()
+
 def build_gemini_prompt(transcribed_text: str, assemblyai_id: str, current_timestamp: str) -> str:
+    # Formato anterior (instrucciones y ejemplo en cada petición). Ya no se envía;
+    # se conserva para comparar tokens con gemini_token_report.py.
     json_structure_example = """
 {
   "paciente_identificador_mencionado_opcional": "string",
@@ -72,26 +119,246 @@ No incluyas NINGÚN texto explicativo antes o después del JSON. La respuesta de
 """
     return prompt
 
-async def analyze_text_with_gemini(transcribed_text: str, assemblyai_id: str, api_key: str) -> dict:
+def _compute_prompt_version() -> str:
+    # Huella de las instrucciones, el esquema, el contenido de usuario (sin
+    # transcripción ni marcas variables) y el modelo. Cambia automáticamente al
+    # editarlos, lo que invalida la caché de resultados.
+    template = "\n".join([GEMINI_EXTRACTION_MODE, system_instruction_for(GEMINI_EXTRACTION_MODE),
+                          json.dumps(response_schema_for(GEMINI_EXTRACTION_MODE), sort_keys=True),
+                          build_user_content("", "", GEMINI_EXTRACTION_MODE)])
+    fingerprint = hashlib.sha256(f"{GEMINI_MODEL_NAME}\n{template}".encode("utf-8")).hexdigest()[:12]
+    return f"{GEMINI_PROMPT_REVISION}-{fingerprint}"
+
+PROMPT_VERSION = _compute_prompt_version()
+
+def _generation_config() -> genai.types.GenerationConfig:
+    return genai.types.GenerationConfig(response_mime_type="application/json",
+                                        response_schema=response_schema_for(GEMINI_EXTRACTION_MODE), temperature=0.2)
+
+def _build_cached_model() -> genai.GenerativeModel | None:
+    # Crea una caché de contexto con las instrucciones de sistema. Devuelve None
+    # (y no se vuelve a intentar) si Gemini la rechaza, p. ej. por no llegar al
+    # mínimo de tokens o por usar un alias de modelo sin versión.
+    global _gemini_cache_expires_at, _context_cache_unavailable
+    try:
+        from google.generativeai import caching
+        cached_content = caching.CachedContent.create(
+            model=GEMINI_MODEL_NAME, system_instruction=system_instruction_for(GEMINI_EXTRACTION_MODE),
+            ttl=timedelta(seconds=GEMINI_CONTEXT_CACHE_TTL_SECONDS), display_name=f"dictado-{PROMPT_VERSION}",
+        )
+        model = genai.GenerativeModel.from_cached_content(cached_content=cached_content, generation_config=_generation_config())
+    except Exception as e:
+        print(f"Caché de contexto de Gemini no disponible, se envían las instrucciones en cada petición: {type(e).__name__} - {e}")
+        _context_cache_unavailable = True
+        return None
+    _gemini_cache_expires_at = time.time() + GEMINI_CONTEXT_CACHE_TTL_SECONDS
+    print(f"Caché de contexto de Gemini creada: {cached_content.name} (TTL {GEMINI_CONTEXT_CACHE_TTL_SECONDS:.0f} s).")
+    return model
+
+def _model_needs_refresh(api_key: str) -> bool:
+    if _gemini_model is None or _gemini_model_key != api_key:
+        return True
+    # Se renueva la caché de contexto un minuto antes de que caduque
+    return _gemini_cache_expires_at is not None and time.time() >= _gemini_cache_expires_at - 60
+
+def configure_gemini(api_key: str) -> genai.GenerativeModel:
+    # Configura el SDK y crea el modelo una sola vez (se llama al arrancar el
+    # servidor; si no, en la primera petición). Solo se recrea si cambia la clave
+    # o si caduca la caché de contexto. Hace llamadas de red bloqueantes al crear
+    # la caché: desde el event loop, usar get_gemini_model.
+    global _gemini_model, _gemini_model_key, _gemini_cache_expires_at
+    with _configure_lock:
+        if not _model_needs_refresh(api_key):
+            return _gemini_model
+        if GEMINI_API_ENDPOINT:
+            genai.configure(api_key=api_key, transport="rest", client_options={"api_endpoint": GEMINI_API_ENDPOINT})
+        else:
+            genai.configure(api_key=api_key)
+        _gemini_cache_expires_at = None
+        model = None
+        if GEMINI_CONTEXT_CACHE_ENABLED and not GEMINI_API_ENDPOINT and not _context_cache_unavailable:
+            model = _build_cached_model()
+        if model is None:
+            model = genai.GenerativeModel(model_name=GEMINI_MODEL_NAME,
+                                          system_instruction=system_instruction_for(GEMINI_EXTRACTION_MODE),
+                                          generation_config=_generation_config())
+        _gemini_model = model
+        _gemini_model_key = api_key
+        print(f"Modelo Gemini configurado: {GEMINI_MODEL_NAME} (modo {_generation_mode()}, extracción {GEMINI_EXTRACTION_MODE}).")
+        return _gemini_model
+
+async def get_gemini_model(api_key: str) -> genai.GenerativeModel:
+    if not _model_needs_refresh(api_key):
+        return _gemini_model
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor(), configure_gemini, api_key)
+
+def _record_token_usage(response, assemblyai_id: str) -> dict:
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return {}
+    tokens = {
+        "prompt": getattr(usage, "prompt_token_count", 0) or 0,
+        "cached": getattr(usage, "cached_content_token_count", 0) or 0,
+        "output": getattr(usage, "candidates_token_count", 0) or 0,
+    }
+    for kind, count in tokens.items():
+        GEMINI_TOKENS.inc(count, kind=kind)
+    GEMINI_OUTPUT_TOKENS.observe(tokens["output"], extraction_mode=GEMINI_EXTRACTION_MODE)
+    print(f"Tokens de Gemini para {assemblyai_id}: prompt={tokens['prompt']} (en caché {tokens['cached']}), "
+          f"salida={tokens['output']} (extracción {GEMINI_EXTRACTION_MODE})")
+    return tokens
+
+def _generation_mode() -> str:
+    return "async" if GEMINI_USE_ASYNC and not GEMINI_API_ENDPOINT else "executor"
+
+def _executor() -> ThreadPoolExecutor:
+    # Hilos propios para Gemini: no compiten con el renderizado de PDF ni con el executor por defecto.
+    global _gemini_executor
+    if _gemini_executor is None:
+        _gemini_executor = ThreadPoolExecutor(max_workers=max(1, GEMINI_EXECUTOR_WORKERS), thread_name_prefix="gemini")
+    return _gemini_executor
+
+def shutdown_gemini() -> None:
+    global _gemini_executor
+    if _gemini_executor is not None:
+        _gemini_executor.shutdown(wait=False, cancel_futures=True)
+        _gemini_executor = None
+
+async def _generate_content(model: genai.GenerativeModel, prompt_content: str):
+    mode = _generation_mode()
+    with GEMINI_IN_FLIGHT.track_inprogress(mode=mode):
+        try:
+            if mode == "async":
+                response = await model.generate_content_async(prompt_content)
+            else:
+                loop = asyncio.get_running_loop()
+                response = await loop.run_in_executor(_executor(), model.generate_content, prompt_content)
+        except asyncio.CancelledError:
+            GEMINI_REQUESTS.inc(mode=mode, outcome="cancelada")
+            raise
+        except Exception:
+            GEMINI_REQUESTS.inc(mode=mode, outcome="error")
+            raise
+    GEMINI_REQUESTS.inc(mode=mode, outcome="ok")
+    return response
+
+def _chunk_text(chunk) -> str:
+    # Los fragmentos finales (solo finish_reason o uso de tokens) no traen texto
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+async def _generate_content_stream(model: genai.GenerativeModel, prompt_content: str,
+                                   on_section: Callable[[str, dict], Awaitable[None]], timings: dict | None, started: float):
+    # Pide la respuesta en streaming y va pasando el JSON por el parser
+    # incremental; cada sección completa se envía a on_section. Solo se reintenta
+    # la apertura del stream: una vez enviadas secciones, un fallo es definitivo.
+    mode = _generation_mode()
+    loop = asyncio.get_running_loop()
+    parser = IncrementalObjectParser(stream_item_keys(GEMINI_EXTRACTION_MODE))
+    first_section_at = None
+
+    async def open_stream():
+        if mode == "async":
+            return await model.generate_content_async(prompt_content, stream=True)
+        return await loop.run_in_executor(_executor(), functools.partial(model.generate_content, prompt_content, stream=True))
+
+    with GEMINI_IN_FLIGHT.track_inprogress(mode=f"{mode}_stream"):
+        try:
+            response = await call_with_resilience("gemini", "generate_content_stream", open_stream)
+            if mode == "async":
+                chunks = response.__aiter__()
+                next_chunk = chunks.__anext__
+            else:
+                chunks = iter(response)
+                next_chunk = lambda: loop.run_in_executor(_executor(), next, chunks, None)
+            while True:
+                try:
+                    chunk = await next_chunk()
+                except StopAsyncIteration:
+                    break
+                if chunk is None:
+                    break
+                for kind, key, value in parser.feed(_chunk_text(chunk)):
+                    section = section_from_stream(GEMINI_EXTRACTION_MODE, kind, key, value)
+                    if section is None:
+                        continue
+                    if first_section_at is None:
+                        first_section_at = time.perf_counter() - started
+                        GEMINI_STREAM_FIRST_SECTION_SECONDS.observe(first_section_at)
+                        if timings is not None:
+                            timings["gemini_first_section"] = first_section_at
+                    await on_section(*section)
+        except asyncio.CancelledError:
+            GEMINI_REQUESTS.inc(mode=f"{mode}_stream", outcome="cancelada")
+            raise
+        except Exception:
+            GEMINI_REQUESTS.inc(mode=f"{mode}_stream", outcome="error")
+            raise
+    GEMINI_REQUESTS.inc(mode=f"{mode}_stream", outcome="ok")
+    return response
+
+async def analyze_text_with_gemini(transcribed_text: str, assemblyai_id: str, api_key: str, timings: dict | None = None,
+                                   on_section: Callable[[str, dict], Awaitable[None]] | None = None) -> dict:
+    # Con on_section la respuesta se pide en streaming y cada sección completa
+    # (campo, pieza del odontograma o procedimiento) se notifica según llega; el
+    # diccionario devuelto es el mismo en ambos casos.
+    # Por encima de GEMINI_MAP_REDUCE_THRESHOLD_CHARS la transcripción se divide
+    # en fragmentos que se extraen en paralelo y se combinan (map-reduce).
     if not api_key:
         raise HTTPException(status_code=500, detail="La API Key de Gemini no está configurada en el servidor.")
+    if not should_map_reduce(transcribed_text):
+        return await _analyze_segment(transcribed_text, assemblyai_id, api_key, timings, on_section)
+
+    segments = split_transcript(transcribed_text)
+    print(f"Transcripción de {len(transcribed_text)} caracteres: extracción map-reduce en {len(segments)} fragmentos.")
+    current_timestamp_iso = datetime.utcnow().isoformat() + "Z"
+    segment_timings: list[dict] = []
+
+    async def extract_segment(segment: str, index: int, total: int) -> dict:
+        own_timings: dict = {}
+        segment_timings.append(own_timings)
+        return await _analyze_segment(segment, f"{assemblyai_id}#{index + 1}", api_key, own_timings, None,
+                                      segment=(index + 1, total), current_timestamp_iso=current_timestamp_iso)
+
+    started = time.perf_counter()
+    merged = await run_map_reduce(segments, extract_segment)
+    # Cada fragmento solo conoce su parte del texto
+    merged["texto_transcrito_original"] = transcribed_text
+    if timings is not None:
+        timings["gemini"] = time.perf_counter() - started
+        timings["json_parse"] = sum(t.get("json_parse", 0.0) for t in segment_timings)
+    if on_section is not None:
+        for section in sections_from_extraction(merged):
+            await on_section(*section)
+    return merged
+
+async def _analyze_segment(transcribed_text: str, assemblyai_id: str, api_key: str, timings: dict | None,
+                           on_section: Callable[[str, dict], Awaitable[None]] | None, segment: tuple[int, int] | None = None,
+                           current_timestamp_iso: str | None = None) -> dict:
     try:
-        target_model_name = 'models/gemini-1.5-flash-latest' 
-        print(f"Intentando usar el modelo Gemini: {target_model_name}")
-        
-        current_timestamp_iso = datetime.utcnow().isoformat() + "Z"
+        target_model_name = GEMINI_MODEL_NAME
+        current_timestamp_iso = current_timestamp_iso or datetime.utcnow().isoformat() + "Z"
 
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel(
-            model_name=target_model_name,
-            generation_config=genai.types.GenerationConfig(response_mime_type="application/json", temperature=0.2),
-        )
-        prompt_content = build_gemini_prompt(transcribed_text, assemblyai_id, current_timestamp_iso)
+        model = await get_gemini_model(api_key)
+        prompt_content = build_user_content(transcribed_text, current_timestamp_iso, GEMINI_EXTRACTION_MODE, segment=segment)
         print("Enviando solicitud a Gemini...")
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(None, model.generate_content, prompt_content)
+        gemini_started = time.perf_counter()
+
+        if on_section is not None:
+            response = await _generate_content_stream(model, prompt_content, on_section, timings, gemini_started)
+        else:
+            # Reintentos, circuit breaker y, si se configura, una segunda petición tras GEMINI_HEDGE_AFTER_SECONDS
+            response = await call_with_resilience("gemini", "generate_content",
+                                                  lambda: hedged("gemini", lambda: _generate_content(model, prompt_content),
+                                                                 GEMINI_HEDGE_AFTER_SECONDS))
+        if timings is not None:
+            timings["gemini"] = time.perf_counter() - gemini_started
         print("Respuesta recibida de Gemini.")
-        
+        _record_token_usage(response, assemblyai_id)
+
         if not response.parts:
             error_message = "Respuesta inesperada de Gemini (sin partes)."
             if hasattr(response, 'prompt_feedback') and response.prompt_feedback and response.prompt_feedback.block_reason:
@@ -102,22 +369,20 @@ async def analyze_text_with_gemini(transcribed_text: str, assemblyai_id: str, ap
             print("Respuesta completa de Gemini (si falló):", response)
             raise HTTPException(status_code=400 if "bloqueada" in error_message else 502, detail=error_message)
 
+        # Con response_schema la salida es JSON sin envoltorio de markdown
         json_output_str = response.text
-        
-        if json_output_str.startswith("```json"):
-            json_output_str = json_output_str.split("```json", 1)[-1]
-        if json_output_str.startswith("```"):
-            json_output_str = json_output_str[3:]
-        if json_output_str.endswith("```"):
-            json_output_str = json_output_str[:-3]
-        json_output_str = json_output_str.strip()
 
         print(f"Texto JSON recibido de Gemini (antes de parsear, primeros 500 chars): {json_output_str[:500]}...")
         
-        parsed_json = json.loads(json_output_str)
+        parse_started = time.perf_counter()
+        parsed_json = normalize_extraction(json.loads(json_output_str), GEMINI_EXTRACTION_MODE, current_timestamp_iso)
+        if timings is not None:
+            timings["json_parse"] = time.perf_counter() - parse_started
         print("JSON de Gemini parseado exitosamente.")
         return parsed_json
 
+    except HTTPException:
+        raise
     except json.JSONDecodeError as e:
         print(f"Error al parsear JSON de Gemini: {e}")
         print(f"String que falló al parsear:\n{json_output_str}")
@@ -0,0 +1,59 @@
+# E:\PROJECTS\voice_test\gemini_token_report.py
+#
+# Compara los tokens de entrada por dictado entre el prompt anterior (todas las
+# instrucciones y el ejemplo de JSON en cada petición) y el formato actual
+# (instrucciones de sistema + esquema de respuesta + solo fecha y transcripción
+# como contenido de usuario), y estima los tokens de salida que ahorra el modo
+# compacto al no devolver la transcripción. Usa count_tokens de la API, que no consume cuota
+# de generación. Uso:
+#   python gemini_token_report.py [transcripcion.txt]
+
+import os
+import sys
+from datetime import datetime
+from dotenv import load_dotenv
+import google.generativeai as genai
+
+from gemini_service import GEMINI_MODEL_NAME, build_gemini_prompt
+from extraction_schema import (GEMINI_EXTRACTION_MODE, EXTRACTION_MODE_COMPACT, system_instruction_for,
+                               build_user_content)
+
+SAMPLE_TRANSCRIPT = (
+    "Paciente Carlos López. Acude por dolor en la pieza dieciséis al masticar. "
+    "Caries mesial profunda en la dieciséis, se planifica endodoncia y corona. "
+    "La cuarenta y ocho está retenida, se indica exodoncia profiláctica. "
+    "Se realiza profilaxis completa. Control en dos semanas."
+)
+
+load_dotenv()
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+
+if not GEMINI_API_KEY:
+    print("Error: GEMINI_API_KEY no está configurada. Por favor, configúrala en tu archivo .env o como variable de entorno.")
+else:
+    genai.configure(api_key=GEMINI_API_KEY)
+    transcript = SAMPLE_TRANSCRIPT
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], encoding="utf-8") as f:
+            transcript = f.read()
+    timestamp = datetime.utcnow().isoformat() + "Z"
+
+    legacy_model = genai.GenerativeModel(model_name=GEMINI_MODEL_NAME)
+    legacy_tokens = legacy_model.count_tokens(build_gemini_prompt(transcript, "", timestamp)).total_tokens
+
+    system_tokens = legacy_model.count_tokens(system_instruction_for(GEMINI_EXTRACTION_MODE)).total_tokens
+    user_tokens = legacy_model.count_tokens(build_user_content(transcript, timestamp, GEMINI_EXTRACTION_MODE)).total_tokens
+    transcript_tokens = legacy_model.count_tokens(transcript).total_tokens
+
+    print(f"Modelo: {GEMINI_MODEL_NAME} (extracción {GEMINI_EXTRACTION_MODE})")
+    print(f"Transcripción: {len(transcript)} caracteres, {transcript_tokens} tokens\n")
+    print(f"Antes  (prompt completo como contenido de usuario): {legacy_tokens} tokens")
+    print(f"Ahora  (instrucciones de sistema + contenido):       {system_tokens + user_tokens} tokens "
+          f"({system_tokens} de sistema + {user_tokens} de usuario)")
+    print(f"Ahora con caché de contexto (solo contenido):        {user_tokens} tokens facturados a precio completo")
+    saved = legacy_tokens - user_tokens
+    print(f"\nAhorro por dictado con caché: {saved} tokens ({saved / legacy_tokens:.0%}); "
+          f"sin caché: {legacy_tokens - system_tokens - user_tokens} tokens")
+    if GEMINI_EXTRACTION_MODE == EXTRACTION_MODE_COMPACT:
+        print(f"Tokens de salida ahorrados al no devolver la transcripción: ~{transcript_tokens} por dictado "
+              f"(más las claves cortas y los campos vacíos omitidos)")
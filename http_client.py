@@ -0,0 +1,50 @@
+# E:\PROJECTS\voice_test\http_client.py
+
+import os
+import httpx
+
+# Configuración del pool de conexiones compartido (valores por defecto pensados
+# para el volumen actual; se pueden ajustar por variables de entorno).
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_ENABLE_HTTP2 = os.getenv("HTTP_ENABLE_HTTP2", "true").lower() in ("1", "true", "yes")
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "20"))
+HTTP_POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", "30"))
+
+# Timeouts de lectura/escritura por etapa
+_STAGE_TIMEOUTS = {
+    "upload": float(os.getenv("HTTP_TIMEOUT_UPLOAD", "120")),
+    "transcript_request": float(os.getenv("HTTP_TIMEOUT_TRANSCRIPT_REQUEST", "30")),
+    "poll": float(os.getenv("HTTP_TIMEOUT_POLL", "15")),
+}
+_DEFAULT_STAGE_TIMEOUT = 120.0
+
+def stage_timeout(stage: str) -> httpx.Timeout:
+    return httpx.Timeout(_STAGE_TIMEOUTS.get(stage, _DEFAULT_STAGE_TIMEOUT), connect=HTTP_CONNECT_TIMEOUT, pool=HTTP_POOL_TIMEOUT)
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401  (httpx necesita el paquete 'h2' para HTTP/2)
+        return True
+    except ImportError:
+        return False
+
+def build_http_client() -> httpx.AsyncClient:
+    # Cliente único para toda la vida de la aplicación: reutiliza conexiones TCP/TLS
+    # hacia AssemblyAI entre subida, solicitud de transcripción y consultas.
+    use_http2 = HTTP_ENABLE_HTTP2 and _http2_available()
+    if HTTP_ENABLE_HTTP2 and not use_http2:
+        print("Advertencia: HTTP/2 solicitado pero el paquete 'h2' no está instalado. Usando HTTP/1.1.")
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+    print(f"Cliente HTTP compartido: max_connections={HTTP_MAX_CONNECTIONS}, keepalive={HTTP_MAX_KEEPALIVE_CONNECTIONS} "
+          f"({HTTP_KEEPALIVE_EXPIRY}s), http2={use_http2}")
+    return httpx.AsyncClient(
+        limits=limits,
+        http2=use_http2,
+        timeout=httpx.Timeout(_DEFAULT_STAGE_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT, pool=HTTP_POOL_TIMEOUT),
+    )
\ No newline at end of file
@@ -0,0 +1,104 @@
+# E:\PROJECTS\voice_test\incremental_json.py
+
+import json
+
+# Parser incremental del objeto JSON que devuelve Gemini en streaming. Se le
+# pasan los fragmentos de texto según llegan y devuelve lo que ya está completo:
+# ("campo", clave, valor) por cada valor de primer nivel cerrado y, para las
+# claves de item_keys (listas), ("elemento", clave, valor) por cada elemento de
+# la lista en cuanto se cierra, sin esperar al final de la lista.
+# Solo sigue la estructura (profundidad, strings y escapes); cada valor completo
+# se decodifica con json.loads.
+
+class IncrementalObjectParser:
+
+    def __init__(self, item_keys: tuple = ()):
+        self.item_keys = frozenset(item_keys)
+        self.text = ""
+        self.done = False
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        # Estado en el primer nivel: "clave", "dos_puntos", "valor", "coma"
+        self._state = "clave"
+        self._key: str | None = None
+        self._value_start: int | None = None
+        self._item_array = False
+        self._item_start: int | None = None
+
+    def feed(self, chunk: str) -> list[tuple[str, str, object]]:
+        self.text += chunk
+        events = []
+        text = self.text
+        for i in range(self._pos, len(text)):
+            c = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    self._close_string(i, events)
+                continue
+            if self.done:
+                break
+
+            if c == '"':
+                self._in_string = True
+                self._string_start = i
+                if self._depth == 1 and self._state == "valor":
+                    self._value_start = i
+                elif self._depth == 2 and self._item_array:
+                    self._item_start = i
+            elif c in "{[":
+                if self._depth == 1 and self._state == "valor":
+                    self._value_start = i
+                    self._item_array = c == "[" and self._key in self.item_keys
+                elif self._depth == 2 and self._item_array:
+                    self._item_start = i
+                self._depth += 1
+            elif c in "}]":
+                if self._depth == 1 and self._state == "valor" and self._value_start is not None:
+                    # Número, booleano o null como último valor del objeto
+                    self._emit_field(text[self._value_start:i], events)
+                self._depth -= 1
+                if self._depth == 2 and self._item_array and self._item_start is not None:
+                    events.append(("elemento", self._key, json.loads(text[self._item_start:i + 1])))
+                    self._item_start = None
+                elif self._depth == 1 and self._state == "valor":
+                    if not self._item_array:
+                        self._emit_field(text[self._value_start:i + 1], events)
+                    self._item_array = False
+                    self._state = "coma"
+                elif self._depth == 0:
+                    self.done = True
+            elif self._depth == 1:
+                if c == ":" and self._state == "dos_puntos":
+                    self._state = "valor"
+                    self._value_start = None
+                elif c == ",":
+                    if self._state == "valor" and self._value_start is not None:
+                        self._emit_field(text[self._value_start:i], events)
+                    self._state = "clave"
+                elif not c.isspace() and self._state == "valor" and self._value_start is None:
+                    self._value_start = i
+        self._pos = len(text)
+        return events
+
+    def _close_string(self, end: int, events: list) -> None:
+        if self._depth == 1 and self._state == "clave":
+            self._key = json.loads(self.text[self._string_start:end + 1])
+            self._state = "dos_puntos"
+        elif self._depth == 1 and self._state == "valor":
+            self._emit_field(self.text[self._value_start:end + 1], events)
+            self._state = "coma"
+        elif self._depth == 2 and self._item_array and self._item_start is not None:
+            events.append(("elemento", self._key, json.loads(self.text[self._item_start:end + 1])))
+            self._item_start = None
+
+    def _emit_field(self, raw: str, events: list) -> None:
+        events.append(("campo", self._key, json.loads(raw)))
+        self._value_start = None
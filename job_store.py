@@ -0,0 +1,268 @@
+# E:\PROJECTS\voice_test\job_store.py
+
+import os
+import uuid
+import time
+import sqlite3
+
+# Estados posibles de un trabajo
+JOB_STATUS_QUEUED = "queued"
+JOB_STATUS_PROCESSING = "processing"
+JOB_STATUS_COMPLETED = "completed"
+JOB_STATUS_FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    stage TEXT,
+    original_filename TEXT,
+    content_type TEXT,
+    audio_path TEXT,
+    audio_sha256 TEXT,
+    preprocess INTEGER NOT NULL DEFAULT 0,
+    pdf_path TEXT,
+    pdf_filename TEXT,
+    transcript_id TEXT,
+    error_status_code INTEGER,
+    error_detail TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker_id TEXT,
+    lease_expires_at REAL,
+    available_at REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created_at);
+"""
+
+class JobStore:
+    # Almacén durable de trabajos en SQLite (modo WAL). Varios procesos de uvicorn
+    # comparten el mismo fichero, así que la cola sobrevive a reinicios y la
+    # reclamación de trabajos es atómica entre workers.
+
+    def __init__(self, data_dir: str, lease_seconds: float = 900.0, max_attempts: int = 3):
+        self.data_dir = data_dir
+        self.audio_dir = os.path.join(data_dir, "audio")
+        self.pdf_dir = os.path.join(data_dir, "pdf")
+        self.db_path = os.path.join(data_dir, "jobs.sqlite3")
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        os.makedirs(self.audio_dir, exist_ok=True)
+        os.makedirs(self.pdf_dir, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            self._migrate(conn)
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30.0, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _migrate(self, conn: sqlite3.Connection) -> None:
+        # Columnas añadidas después de la primera versión del esquema
+        existing = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+        for column, ddl in (("audio_sha256", "TEXT"), ("preprocess", "INTEGER NOT NULL DEFAULT 0"), ("available_at", "REAL")):
+            if column not in existing:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {ddl}")
+
+    def new_job_id(self) -> str:
+        return uuid.uuid4().hex
+
+    def audio_path_for(self, job_id: str) -> str:
+        return os.path.join(self.audio_dir, job_id)
+
+    def create_job(self, job_id: str, original_filename: str, content_type: str, audio_sha256: str | None = None,
+                   preprocess: bool = False) -> str:
+        # El audio debe haberse escrito antes en audio_path_for(job_id).
+        audio_path = self.audio_path_for(job_id)
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute(
+                "INSERT INTO jobs (id, status, stage, original_filename, content_type, audio_path, audio_sha256, preprocess, "
+                "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, JOB_STATUS_QUEUED, "en_cola", original_filename, content_type, audio_path, audio_sha256,
+                 int(preprocess), now, now),
+            )
+        finally:
+            conn.close()
+        return job_id
+
+    def claim_next_job(self, worker_id: str) -> dict | None:
+        # Toma el trabajo más antiguo en cola (y ya disponible, si espera un
+        # reintento), o uno en proceso cuyo lease haya expirado (el worker que
+        # lo tenía murió o el proceso se reinició). Los que ya agotaron sus
+        # intentos se marcan como fallidos y se sigue buscando.
+        now = time.time()
+        exhausted_audio = []
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            while True:
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE (status = ? AND (available_at IS NULL OR available_at <= ?)) "
+                    "OR (status = ? AND lease_expires_at < ?) ORDER BY created_at LIMIT 1",
+                    (JOB_STATUS_QUEUED, now, JOB_STATUS_PROCESSING, now),
+                ).fetchone()
+                if row is None or row["attempts"] < self.max_attempts:
+                    break
+                conn.execute(
+                    "UPDATE jobs SET status = ?, stage = ?, error_status_code = ?, error_detail = ?, lease_expires_at = NULL, "
+                    "updated_at = ? WHERE id = ?",
+                    (JOB_STATUS_FAILED, "fallido", row["error_status_code"] or 500,
+                     "Se superó el número máximo de intentos para el trabajo."
+                     + (f" Último error: {row['error_detail']}" if row["error_detail"] else ""), now, row["id"]),
+                )
+                exhausted_audio.append(row["audio_path"])
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = ?, stage = ?, worker_id = ?, attempts = attempts + 1, "
+                "lease_expires_at = ?, updated_at = ? WHERE id = ?",
+                (JOB_STATUS_PROCESSING, "iniciando", worker_id, now + self.lease_seconds, now, row["id"]),
+            )
+            conn.execute("COMMIT")
+            job = dict(row)
+            job["status"] = JOB_STATUS_PROCESSING
+            job["worker_id"] = worker_id
+            job["attempts"] += 1
+            return job
+        except Exception:
+            conn.execute("ROLLBACK")
+            exhausted_audio = []
+            raise
+        finally:
+            conn.close()
+            for audio_path in exhausted_audio:
+                self._remove_audio(audio_path)
+
+    def update_stage(self, job_id: str, worker_id: str, stage: str) -> None:
+        # Cada cambio de etapa renueva el lease del trabajo.
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute(
+                "UPDATE jobs SET stage = ?, lease_expires_at = ?, updated_at = ? WHERE id = ? AND worker_id = ?",
+                (stage, now + self.lease_seconds, now, job_id, worker_id),
+            )
+        finally:
+            conn.close()
+
+    def renew_lease(self, job_id: str, worker_id: str) -> bool:
+        # Latido del worker mientras procesa (esperas largas de transcripción,
+        # Gemini o colas de admisión). Devuelve False si el trabajo ya no es suyo.
+        now = time.time()
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND worker_id = ? AND status = ?",
+                (now + self.lease_seconds, job_id, worker_id, JOB_STATUS_PROCESSING),
+            )
+        finally:
+            conn.close()
+        return cursor.rowcount == 1
+
+    def _lost_job(self, job_id: str, worker_id: str, action: str) -> None:
+        print(f"Advertencia: el trabajo {job_id} ya no pertenece a {worker_id} (lease expirado y reclamado); "
+              f"no se {action}.")
+
+    def complete_job(self, job_id: str, worker_id: str, pdf_bytes: bytes, pdf_filename: str, transcript_id: str) -> bool:
+        # Solo el worker que tiene el trabajo lo completa; si lo perdió, el PDF
+        # recién escrito se descarta y el audio queda para el nuevo dueño.
+        # Archivo propio del worker: el nuevo dueño puede estar escribiendo el suyo.
+        pdf_path = os.path.join(self.pdf_dir, f"{job_id}.{uuid.uuid4().hex[:8]}.pdf")
+        with open(pdf_path, "wb") as f:
+            f.write(pdf_bytes)
+        now = time.time()
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, stage = ?, pdf_path = ?, pdf_filename = ?, transcript_id = ?, "
+                "lease_expires_at = NULL, updated_at = ? WHERE id = ? AND worker_id = ? AND status = ?",
+                (JOB_STATUS_COMPLETED, "completado", pdf_path, pdf_filename, transcript_id, now, job_id, worker_id,
+                 JOB_STATUS_PROCESSING),
+            )
+            row = conn.execute("SELECT audio_path FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+        if cursor.rowcount != 1:
+            self._lost_job(job_id, worker_id, "guarda su PDF")
+            try:
+                os.remove(pdf_path)
+            except FileNotFoundError:
+                pass
+            return False
+        self._remove_audio(row["audio_path"] if row else None)
+        return True
+
+    def retry_job(self, job_id: str, worker_id: str, status_code: int, detail: str, delay_seconds: float) -> bool:
+        # Error transitorio: el trabajo vuelve a la cola y no se reclama hasta
+        # pasados delay_seconds. Devuelve False, sin tocarlo, si ya agotó sus
+        # intentos o ya no es de este worker (el worker llama entonces a fail_job).
+        job = self.get_job(job_id)
+        if job is None or job["attempts"] >= self.max_attempts:
+            return False
+        now = time.time()
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, stage = ?, error_status_code = ?, error_detail = ?, worker_id = NULL, "
+                "lease_expires_at = NULL, available_at = ?, updated_at = ? WHERE id = ? AND worker_id = ? AND status = ?",
+                (JOB_STATUS_QUEUED, "reintento_pendiente", status_code, detail, now + delay_seconds, now, job_id, worker_id,
+                 JOB_STATUS_PROCESSING),
+            )
+        finally:
+            conn.close()
+        # 0 filas: el trabajo ya no es suyo (fail_job tampoco lo tocará)
+        return cursor.rowcount == 1
+
+    def fail_job(self, job_id: str, worker_id: str, status_code: int, detail: str) -> bool:
+        now = time.time()
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, stage = ?, error_status_code = ?, error_detail = ?, "
+                "lease_expires_at = NULL, updated_at = ? WHERE id = ? AND worker_id = ? AND status = ?",
+                (JOB_STATUS_FAILED, "fallido", status_code, detail, now, job_id, worker_id, JOB_STATUS_PROCESSING),
+            )
+            row = conn.execute("SELECT audio_path FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+        if cursor.rowcount != 1:
+            self._lost_job(job_id, worker_id, "marca como fallido")
+            return False
+        self._remove_audio(row["audio_path"] if row else None)
+        return True
+
+    def get_job(self, job_id: str) -> dict | None:
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+        return dict(row) if row else None
+
+    def count_by_status(self) -> dict:
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT status, COUNT(*) AS total FROM jobs GROUP BY status").fetchall()
+        finally:
+            conn.close()
+        return {row["status"]: row["total"] for row in rows}
+
+    def _remove_audio(self, audio_path: str | None) -> None:
+        if not audio_path:
+            return
+        try:
+            os.remove(audio_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Advertencia: no se pudo eliminar el audio temporal '{audio_path}': {e}")
\ No newline at end of file
@@ -0,0 +1,153 @@
+# E:\PROJECTS\voice_test\job_worker.py
+
+import os
+import uuid
+import random
+import asyncio
+import httpx
+from fastapi import HTTPException
+
+from job_store import JobStore
+from result_cache import ResultCache
+from record_store import RecordStore
+from transcription_scheduler import TranscriptionPollScheduler
+from pipeline import run_dictation_pipeline
+
+# Errores transitorios (servicio externo caído o saturado, circuito abierto,
+# servidor deteniéndose): el trabajo vuelve a la cola con espera exponencial
+# en lugar de fallar definitivamente.
+JOB_RETRYABLE_STATUS_CODES = frozenset({429, 502, 503})
+
+class JobWorkerPool:
+    # Pool acotado de workers asyncio que procesa los trabajos de la cola durable.
+    # Cada proceso de uvicorn arranca su propio pool; la reclamación en SQLite
+    # garantiza que un trabajo solo lo procese un worker a la vez.
+
+    def __init__(self, store: JobStore, num_workers: int, client: httpx.AsyncClient, assemblyai_api_key: str, gemini_api_key: str,
+                 idle_poll_interval: float = 2.0, cache: ResultCache | None = None,
+                 poll_scheduler: TranscriptionPollScheduler | None = None, stage_limits: dict | None = None,
+                 records: RecordStore | None = None, retry_base_seconds: float = 30.0, retry_max_seconds: float = 600.0):
+        self.store = store
+        self.client = client
+        self.cache = cache
+        self.records = records
+        self.poll_scheduler = poll_scheduler
+        self.stage_limits = stage_limits
+        self.num_workers = max(1, num_workers)
+        self.assemblyai_api_key = assemblyai_api_key
+        self.gemini_api_key = gemini_api_key
+        self.idle_poll_interval = idle_poll_interval
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.pool_id = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._tasks: list[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+
+    def start(self) -> None:
+        print(f"Iniciando pool de trabajos '{self.pool_id}' con {self.num_workers} workers.")
+        self._stopping = False
+        for i in range(self.num_workers):
+            worker_id = f"{self.pool_id}-w{i}"
+            self._tasks.append(asyncio.create_task(self._worker_loop(worker_id), name=worker_id))
+
+    async def stop(self) -> None:
+        # Los trabajos interrumpidos quedan en 'processing' y se reclaman de nuevo
+        # cuando expira su lease.
+        self._stopping = True
+        self._wakeup.set()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        print(f"Pool de trabajos '{self.pool_id}' detenido.")
+
+    def notify_new_job(self) -> None:
+        self._wakeup.set()
+
+    async def _worker_loop(self, worker_id: str) -> None:
+        loop = asyncio.get_event_loop()
+        while not self._stopping:
+            try:
+                job = await loop.run_in_executor(None, self.store.claim_next_job, worker_id)
+            except Exception as e:
+                print(f"Error al reclamar trabajo en {worker_id}: {type(e).__name__} - {e}")
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.idle_poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._process_job(job, worker_id)
+
+    async def _process_job(self, job: dict, worker_id: str) -> None:
+        loop = asyncio.get_event_loop()
+        job_id = job["id"]
+        print(f"[{worker_id}] Procesando trabajo {job_id} (intento {job['attempts']}).")
+
+        async def on_stage(stage: str) -> None:
+            await loop.run_in_executor(None, self.store.update_stage, job_id, worker_id, stage)
+
+        if not job["audio_path"] or not os.path.exists(job["audio_path"]):
+            print(f"[{worker_id}] No se encontró el audio del trabajo {job_id}: {job['audio_path']}")
+            await loop.run_in_executor(None, self.store.fail_job, job_id, worker_id, 500, "El audio del trabajo no está disponible.")
+            return
+
+        heartbeat = asyncio.create_task(self._heartbeat(job_id, worker_id))
+        try:
+            result = await run_dictation_pipeline(self.client, None, self.assemblyai_api_key, self.gemini_api_key, on_stage=on_stage,
+                                                 cache=self.cache, audio_sha256=job["audio_sha256"], stage_limits=self.stage_limits,
+                                                 poll_scheduler=self.poll_scheduler, audio_path=job["audio_path"],
+                                                 preprocess=bool(job["preprocess"]), records=self.records)
+            completed = await loop.run_in_executor(None, self.store.complete_job, job_id, worker_id,
+                                                   result["pdf_bytes"], result["pdf_filename"], result["transcript_id"])
+            if completed:
+                print(f"[{worker_id}] Trabajo {job_id} completado: {result['pdf_filename']}")
+        except HTTPException as e:
+            if e.status_code in JOB_RETRYABLE_STATUS_CODES:
+                delay = self._retry_delay(job["attempts"], e)
+                requeued = await loop.run_in_executor(None, self.store.retry_job, job_id, worker_id, e.status_code,
+                                                      str(e.detail), delay)
+                if requeued:
+                    print(f"[{worker_id}] Trabajo {job_id}: error transitorio ({e.status_code}), se reintentará en {delay:.0f} s.")
+                    return
+            print(f"[{worker_id}] Trabajo {job_id} fallido ({e.status_code}): {e.detail}")
+            await loop.run_in_executor(None, self.store.fail_job, job_id, worker_id, e.status_code, str(e.detail))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[{worker_id}] Error inesperado en trabajo {job_id}: {str(e)}")
+            import traceback; traceback.print_exc()
+            await loop.run_in_executor(None, self.store.fail_job, job_id, worker_id, 500,
+                                       f"Ocurrió un error interno inesperado en el servidor: {str(e)}")
+        finally:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+
+    async def _heartbeat(self, job_id: str, worker_id: str) -> None:
+        # Renueva el lease cada lease_seconds/3 mientras el trabajo está en
+        # proceso: las esperas largas (transcripción, Gemini, colas de admisión)
+        # no cambian de etapa y sin latido otro worker reclamaría el trabajo.
+        loop = asyncio.get_event_loop()
+        interval = max(1.0, self.store.lease_seconds / 3)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                owned = await loop.run_in_executor(None, self.store.renew_lease, job_id, worker_id)
+            except Exception as e:
+                print(f"[{worker_id}] No se pudo renovar el lease del trabajo {job_id}: {type(e).__name__} - {e}")
+                continue
+            if not owned:
+                print(f"[{worker_id}] El trabajo {job_id} ya no es de este worker; se deja de renovar su lease.")
+                return
+
+    def _retry_delay(self, attempts: int, error: HTTPException) -> float:
+        # Espera exponencial con jitter, nunca menor que el Retry-After del error
+        delay = min(self.retry_max_seconds, self.retry_base_seconds * 2 ** max(0, attempts - 1))
+        delay *= random.uniform(0.8, 1.2)
+        retry_after = (getattr(error, "headers", None) or {}).get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        return delay
@@ -0,0 +1,356 @@
+# E:\PROJECTS\voice_test\local_extraction.py
+
+import os
+import re
+import unicodedata
+
+from metrics import Counter
+from extraction_schema import expand_compact_extraction
+
+# Extracción local por reglas, sin LLM, de las piezas dentales (notación FDI) y
+# de los hallazgos y tratamientos más comunes de cada una. Sirve para
+# prerrellenar y contrastar el odontograma de Gemini y, en dictados cortos donde
+# todo el texto queda explicado por las reglas, para no llamar a Gemini.
+# Desactivada por defecto hasta validar las reglas con dictados reales.
+LOCAL_EXTRACTION_ENABLED = os.getenv("LOCAL_EXTRACTION_ENABLED", "false").lower() in ("1", "true", "yes")
+LOCAL_EXTRACTION_SKIP_LLM = os.getenv("LOCAL_EXTRACTION_SKIP_LLM", "false").lower() in ("1", "true", "yes")
+LOCAL_EXTRACTION_SKIP_MAX_WORDS = int(os.getenv("LOCAL_EXTRACTION_SKIP_MAX_WORDS", "60"))
+# Súbelo cuando cambien las reglas: forma parte de la versión de la caché de resultados
+LOCAL_EXTRACTION_REVISION = "2"
+LOCAL_EXTRACTION_VERSION = (f"{LOCAL_EXTRACTION_REVISION}-{int(LOCAL_EXTRACTION_ENABLED)}{int(LOCAL_EXTRACTION_SKIP_LLM)}"
+                            f"-{LOCAL_EXTRACTION_SKIP_MAX_WORDS}")
+
+LOCAL_EXTRACTION_RESULTS = Counter("local_extraction_total",
+                                   "Dictados analizados con las reglas locales por resultado (sin_llm, contrastado, sin_piezas).",
+                                   ("outcome",))
+LOCAL_EXTRACTION_DISCREPANCIES = Counter("local_extraction_discrepancies_total",
+                                         "Piezas en las que reglas locales y Gemini no coinciden (solo_local, solo_gemini).",
+                                         ("kind",))
+
+# --- Números en español -> códigos FDI ---
+_UNITS = {"uno": 1, "un": 1, "una": 1, "dos": 2, "tres": 3, "cuatro": 4, "cinco": 5, "seis": 6, "siete": 7, "ocho": 8,
+          "nueve": 9}
+_COMPOUNDS = {"once": 11, "doce": 12, "trece": 13, "catorce": 14, "quince": 15, "dieciseis": 16, "diecisiete": 17,
+              "dieciocho": 18, "diecinueve": 19, "veinte": 20, "veintiuno": 21, "veintiun": 21, "veintidos": 22,
+              "veintitres": 23, "veinticuatro": 24, "veinticinco": 25, "veintiseis": 26, "veintisiete": 27,
+              "veintiocho": 28, "veintinueve": 29}
+_TENS = {"diez": 10, "treinta": 30, "cuarenta": 40, "cincuenta": 50, "sesenta": 60, "setenta": 70, "ochenta": 80}
+
+# Palabras que introducen una pieza ("pieza dieciséis", "la cuarenta y ocho")
+_TOOTH_TRIGGERS = frozenset({"pieza", "piezas", "diente", "dientes", "muela", "muelas", "molar", "molares", "premolar",
+                             "premolares", "canino", "caninos", "incisivo", "incisivos", "organo", "od"})
+# Con artículo solo se aceptan números de dos cifras, para no confundir "la una" (hora) con una pieza,
+# y la pieza solo cuenta si en el mismo fragmento hay un hallazgo o tratamiento ("los doce meses" no es una pieza)
+_ARTICLE_TRIGGERS = frozenset({"la", "el", "las", "los"})
+# Tras un número, indican que no es una pieza: "el 45 por ciento", "los doce meses", "las once horas"
+_NON_TOOTH_UNITS = frozenset({"meses", "mes", "anos", "ano", "semanas", "semana", "dias", "dia", "horas", "hora", "minutos",
+                              "minuto", "%", "mg", "ml", "grados", "euros"})
+_LIST_CONNECTORS = frozenset({",", "y", "e"})
+_LIST_FILLERS = frozenset({"la", "el", "pieza", "diente"})
+# "el 15 de marzo" es una fecha, no una pieza
+_MONTHS = frozenset({"enero", "febrero", "marzo", "abril", "mayo", "junio", "julio", "agosto", "septiembre", "setiembre",
+                     "octubre", "noviembre", "diciembre"})
+
+def is_valid_fdi(code: int) -> bool:
+    # Permanentes: cuadrantes 1-4, piezas 1-8. Temporales: cuadrantes 5-8, piezas 1-5.
+    quadrant, tooth = divmod(code, 10)
+    return (1 <= quadrant <= 4 and 1 <= tooth <= 8) or (5 <= quadrant <= 8 and 1 <= tooth <= 5)
+
+def _fold(ch: str) -> str:
+    # Un carácter en minúsculas y sin tilde; siempre de longitud 1 para que las
+    # posiciones del texto normalizado coincidan con las del original.
+    folded = unicodedata.normalize("NFKD", ch.lower())
+    return folded[0] if folded else ch
+
+def normalize_text(text: str) -> str:
+    return "".join(_fold(ch) for ch in text)
+
+_TOKEN_RE = re.compile(r"\d+|\w+|[^\w\s]")
+
+def _tokenize(normalized: str) -> list[tuple[str, int, int]]:
+    return [(m.group(), m.start(), m.end()) for m in _TOKEN_RE.finditer(normalized)]
+
+def _token(tokens: list, i: int) -> str:
+    return tokens[i][0] if i < len(tokens) else ""
+
+def parse_tooth_number(tokens: list, i: int) -> tuple[int, int, bool] | None:
+    # Interpreta el número que empieza en tokens[i]: "16", "1.6", "dieciseis",
+    # "cuarenta y ocho", "uno seis" (cifra a cifra). Devuelve (número, índice
+    # siguiente, de_dos_cifras) o None.
+    word = _token(tokens, i)
+    if word.isdigit():
+        if len(word) == 2:
+            return int(word), i + 1, True
+        if len(word) == 1 and _token(tokens, i + 1) in (".", "-") and _token(tokens, i + 2).isdigit() \
+                and len(_token(tokens, i + 2)) == 1:
+            return int(word) * 10 + int(_token(tokens, i + 2)), i + 3, True
+        return int(word), i + 1, False
+    if word in _COMPOUNDS:
+        return _COMPOUNDS[word], i + 1, True
+    if word in _TENS:
+        if _token(tokens, i + 1) == "y" and _token(tokens, i + 2) in _UNITS:
+            return _TENS[word] + _UNITS[_token(tokens, i + 2)], i + 3, True
+        return _TENS[word], i + 1, True
+    if word in _UNITS:
+        # "uno seis" / "cuatro-ocho": la pieza dictada cifra a cifra
+        j = i + 2 if _token(tokens, i + 1) == "-" else i + 1
+        if _token(tokens, j) in _UNITS:
+            return _UNITS[word] * 10 + _UNITS[_token(tokens, j)], j + 1, True
+        return _UNITS[word], i + 1, False
+    return None
+
+def spanish_number_to_fdi(text: str) -> str | None:
+    # "cuarenta y ocho" -> "48"; None si no es un código FDI válido. El código
+    # es el mismo string que usa el odontograma (compatible con fdi_sort_key).
+    tokens = _tokenize(normalize_text(text.strip()))
+    parsed = parse_tooth_number(tokens, 0)
+    if parsed is None or parsed[1] != len(tokens) or not is_valid_fdi(parsed[0]):
+        return None
+    return str(parsed[0])
+
+def find_tooth_mentions(normalized: str, tokens: list | None = None) -> tuple[list[dict], list[str]]:
+    # Menciones de piezas en el texto normalizado: [{"piezas": [...], "start", "end"}],
+    # agrupando listas ("piezas 16, 17 y 18"), y los números tras "pieza" que no
+    # son FDI válidos.
+    tokens = tokens if tokens is not None else _tokenize(normalized)
+    mentions, unresolved = [], []
+    i = 0
+    while i < len(tokens):
+        word = tokens[i][0]
+        is_trigger = word in _TOOTH_TRIGGERS
+        if not is_trigger and word not in _ARTICLE_TRIGGERS:
+            i += 1
+            continue
+        j = i + 1
+        if word == "organo" and _token(tokens, j) == "dental":
+            j += 1
+        parsed = parse_tooth_number(tokens, j)
+        if parsed is None or (not is_trigger and not parsed[2]):
+            i += 1
+            continue
+        code, j, _ = parsed
+        if _token(tokens, j) == "de" and _token(tokens, j + 1) in _MONTHS:
+            i = j
+            continue
+        if not is_trigger and (_token(tokens, j) in _NON_TOOTH_UNITS
+                               or (_token(tokens, j) == "por" and _token(tokens, j + 1) == "ciento")
+                               or (word in ("la", "las") and i > 0 and tokens[i - 1][0] == "a")):
+            # Cantidades y horas ("a las once"), no piezas
+            i = j
+            continue
+        if not is_valid_fdi(code):
+            if is_trigger:
+                unresolved.append(str(code))
+            i = j
+            continue
+        codes = [str(code)]
+        # Continuación de la lista: ", 17 y la 18"
+        while _token(tokens, j) in _LIST_CONNECTORS:
+            k = j + 1
+            while _token(tokens, k) in _LIST_FILLERS:
+                k += 1
+            parsed = parse_tooth_number(tokens, k)
+            if parsed is None or not is_valid_fdi(parsed[0]):
+                break
+            codes.append(str(parsed[0]))
+            j = parsed[1]
+        mentions.append({"piezas": codes, "start": tokens[i][1], "end": tokens[j - 1][2], "articulo": not is_trigger})
+        i = j
+    return mentions, unresolved
+
+# --- Diccionario de hallazgos y tratamientos ---
+_SURFACES = {"mesial": "mesial", "distal": "distal", "oclusal": "oclusal", "vestibular": "vestibular",
+             "lingual": "lingual", "palatina": "palatina", "palatino": "palatino", "incisal": "incisal",
+             "cervical": "cervical", "interproximal": "interproximal", "mesiooclusal": "mesiooclusal",
+             "distooclusal": "distooclusal", "profunda": "profunda", "superficial": "superficial",
+             "incipiente": "incipiente", "extensa": "extensa", "penetrante": "penetrante", "recidivante": "recidivante"}
+
+# (patrón sobre texto normalizado, tipo, etiqueta). Tipo "hallazgo" o "tratamiento".
+# Los patrones más largos van primero para que "obturacion defectuosa" gane a "obturacion".
+_TERMS = [
+    (r"obturacion(?:es)? (?:defectuosa|filtrada|fracturada)s?", "hallazgo", "Obturación defectuosa"),
+    (r"lesion(?:es)? periapical(?:es)?", "hallazgo", "Lesión periapical"),
+    (r"necrosis pulpar", "hallazgo", "Necrosis pulpar"),
+    (r"pulpitis irreversible", "hallazgo", "Pulpitis irreversible"),
+    (r"pulpitis reversible", "hallazgo", "Pulpitis reversible"),
+    (r"pulpitis", "hallazgo", "Pulpitis"),
+    (r"resto(?:s)? radicular(?:es)?", "hallazgo", "Resto radicular"),
+    (r"bolsa(?:s)? periodontal(?:es)?", "hallazgo", "Bolsa periodontal"),
+    (r"semi ?erupcionad[oa]s?|erupcion parcial", "hallazgo", "Semierupcionada"),
+    (r"retenid[oa]s?", "hallazgo", "Retenida"),
+    (r"incluid[oa]s?", "hallazgo", "Incluida"),
+    (r"impactad[oa]s?", "hallazgo", "Impactada"),
+    (r"ausente(?:s)?|ausencia", "hallazgo", "Ausente"),
+    (r"fractura(?:d[oa]s?)?", "hallazgo", "Fractura"),
+    (r"movilidad(?: grado (?:1|2|3|uno|dos|tres|i{1,3}))?", "hallazgo", "Movilidad"),
+    (r"absceso(?:s)?", "hallazgo", "Absceso"),
+    (r"sensibilidad", "hallazgo", "Sensibilidad"),
+    (r"abfraccion(?:es)?", "hallazgo", "Abfracción"),
+    (r"abrasion(?:es)?|desgaste", "hallazgo", "Desgaste"),
+    (r"caries", "hallazgo", "Caries"),
+    (r"tratamiento de conductos?|endodoncia", "tratamiento", "Endodoncia"),
+    (r"exodoncia profilactica|extraccion profilactica", "tratamiento", "Exodoncia profiláctica"),
+    (r"exodoncia quirurgica|extraccion quirurgica", "tratamiento", "Exodoncia quirúrgica"),
+    (r"exodoncia|extraccion", "tratamiento", "Exodoncia"),
+    (r"raspado y alisado(?: radicular)?", "tratamiento", "Raspado y alisado radicular"),
+    (r"pulpotomia", "tratamiento", "Pulpotomía"),
+    (r"apicectomia", "tratamiento", "Apicectomía"),
+    (r"incrustacion", "tratamiento", "Incrustación"),
+    (r"corona(?:s)?", "tratamiento", "Corona"),
+    (r"perno(?: munon)?", "tratamiento", "Perno"),
+    (r"implante(?:s)?", "tratamiento", "Implante"),
+    (r"puente", "tratamiento", "Puente"),
+    (r"sellante(?:s)?|sellador(?:es)? de fosas(?: y fisuras)?", "tratamiento", "Sellante"),
+    (r"obturacion(?:es)?|restauracion(?:es)?|resina(?:s)?", "tratamiento", "Obturación"),
+    (r"profilaxis|limpieza", "tratamiento", "Profilaxis"),
+]
+_TERM_LABELS = [(kind, label) for _, kind, label in _TERMS]
+_TERMS_RE = re.compile(r"\b(?:" + "|".join(f"({pattern})" for pattern, _, _ in _TERMS) + r")\b")
+_SURFACES_RE = re.compile(r"\s+(" + "|".join(sorted(_SURFACES, key=len, reverse=True)) + r")\b")
+# Indicios de que el tratamiento se hizo en esta sesión (si no, es un plan)
+_DONE_RE = re.compile(r"\b(?:se realiz[ao]|realizamos|realice|se hizo|se hace|hicimos|se efectu[ao]|se coloc[ao]|colocamos|"
+                      r"se termin[ao]|terminamos|se obtur[ao]|obturamos|se extra(?:e|jo)|extrajimos)\b")
+_SENTENCE_RE = re.compile(r"[^.;!?\n]+")
+_CLAUSE_BREAK_RE = re.compile(r"[,:]")
+
+def match_terms(normalized_segment: str) -> dict:
+    # Hallazgos y tratamientos de un fragmento de texto normalizado.
+    found = {"hallazgos": [], "planes": [], "realizados": []}
+    done = bool(_DONE_RE.search(normalized_segment))
+    for match in _TERMS_RE.finditer(normalized_segment):
+        kind, label = _TERM_LABELS[match.lastindex - 1]
+        if label == "Caries":
+            # Superficies y gravedad que siguen a "caries": "caries mesial profunda"
+            modifiers, position = [], match.end()
+            while (surface := _SURFACES_RE.match(normalized_segment, position)) is not None:
+                modifiers.append(_SURFACES[surface.group(1)])
+                position = surface.end()
+            label = " ".join(["Caries"] + modifiers)
+        bucket = found["hallazgos"] if kind == "hallazgo" else found["realizados" if done else "planes"]
+        if label not in bucket:
+            bucket.append(label)
+    return found
+
+def segment_by_tooth(text: str) -> list[dict]:
+    # Divide la transcripción en fragmentos por pieza. Cada frase se asigna a
+    # las piezas que menciona; si menciona varios grupos de piezas, se corta en
+    # la última coma entre un grupo y el siguiente ("caries en la 16, endodoncia
+    # en la 17"). Devuelve [{"piezas", "texto" (normalizado), "frase",
+    # "articulo" (mención solo con artículo, sin "pieza", "diente"...)}].
+    normalized = normalize_text(text)
+    mentions, _ = find_tooth_mentions(normalized)
+    segments = []
+    mention_index = 0
+    for sentence_number, sentence in enumerate(_SENTENCE_RE.finditer(normalized)):
+        in_sentence = []
+        while mention_index < len(mentions) and mentions[mention_index]["start"] < sentence.end():
+            if mentions[mention_index]["start"] >= sentence.start():
+                in_sentence.append(mentions[mention_index])
+            mention_index += 1
+        start = sentence.start()
+        for k, mention in enumerate(in_sentence):
+            if k + 1 < len(in_sentence):
+                gap = normalized[mention["end"]:in_sentence[k + 1]["start"]]
+                breaks = list(_CLAUSE_BREAK_RE.finditer(gap))
+                end = mention["end"] + breaks[-1].start() if breaks else mention["end"]
+            else:
+                end = sentence.end()
+            segments.append({"piezas": mention["piezas"], "texto": normalized[start:end], "frase": sentence_number,
+                             "articulo": mention["articulo"]})
+            start = end
+    return segments
+
+def extract_dental_findings(text: str) -> dict:
+    # Resultado de las reglas locales:
+    # - odontograma: {pieza: {"diagnostico_hallazgo", "plan_tratamiento_sugerido", "notas_adicionales"}}
+    # - realizados: [(pieza, tratamiento)] hechos en la sesión
+    # - frases / frases_explicadas: frases del dictado y cuántas quedan cubiertas por las reglas
+    # - menciones_sin_resolver: números tras "pieza" que no son FDI
+    # - confiable: todas las frases explicadas, sin menciones dudosas y dictado corto
+    normalized = normalize_text(text)
+    segments = segment_by_tooth(text)
+    _, unresolved = find_tooth_mentions(normalized)
+    per_tooth: dict[str, dict] = {}
+    realizados = []
+    explained_sentences, unexplained_sentences = set(), set()
+    for segment in segments:
+        terms = match_terms(segment["texto"])
+        if any(terms.values()):
+            explained_sentences.add(segment["frase"])
+        else:
+            unexplained_sentences.add(segment["frase"])
+            if segment["articulo"]:
+                continue  # "cita a las once", "los doce meses": un número con artículo sin término dental
+        for tooth in segment["piezas"]:
+            entry = per_tooth.setdefault(tooth, {"hallazgos": [], "planes": [], "realizados": []})
+            for key, labels in terms.items():
+                entry[key].extend(label for label in labels if label not in entry[key])
+    odontograma = {}
+    for tooth, entry in per_tooth.items():
+        odontograma[tooth] = {
+            "diagnostico_hallazgo": ", ".join(entry["hallazgos"]),
+            "plan_tratamiento_sugerido": ", ".join(entry["planes"]),
+            "notas_adicionales": f"Realizado: {', '.join(entry['realizados'])}" if entry["realizados"] else "",
+        }
+        realizados.extend((tooth, label) for label in entry["realizados"])
+
+    sentence_count = sum(1 for sentence in _SENTENCE_RE.finditer(normalized) if sentence.group().strip())
+    explained = len(explained_sentences - unexplained_sentences)
+    word_count = len(normalized.split())
+    return {
+        "odontograma": odontograma,
+        "realizados": realizados,
+        "frases": sentence_count,
+        "frases_explicadas": explained,
+        "menciones_sin_resolver": unresolved,
+        "palabras": word_count,
+        "confiable": bool(odontograma) and not unresolved and explained == sentence_count
+                     and word_count <= LOCAL_EXTRACTION_SKIP_MAX_WORDS,
+    }
+
+def should_skip_llm(local_result: dict) -> bool:
+    return LOCAL_EXTRACTION_SKIP_LLM and local_result["confiable"]
+
+def local_result_to_extraction(local_result: dict, transcribed_text: str, current_timestamp: str) -> dict:
+    # Diccionario completo (la misma forma que devuelve Gemini tras normalizar)
+    # solo con lo que han encontrado las reglas locales.
+    extraction = expand_compact_extraction({}, current_timestamp)
+    extraction["texto_transcrito_original"] = transcribed_text
+    extraction["odontograma_completo"] = {tooth: dict(entry) for tooth, entry in local_result["odontograma"].items()}
+    extraction["procedimientos_realizados_sesion_detectados"] = [
+        {"pieza_o_region_tratada": tooth, "descripcion_procedimiento": label, "anestesia_mencionada": "",
+         "materiales_mencionados": "", "complicaciones_mencionadas": ""}
+        for tooth, label in local_result["realizados"]
+    ]
+    return extraction
+
+def merge_local_findings(extracted: dict, local_result: dict, transcript_id: str = "") -> list[str]:
+    # Contrasta el odontograma de Gemini con el local: las piezas que solo
+    # encuentran las reglas se añaden si tienen algún hallazgo o tratamiento,
+    # y en las comunes se rellenan los campos que Gemini dejó vacíos. Las
+    # discrepancias se registran en el log y en métricas. Devuelve las piezas
+    # añadidas.
+    odontograma = extracted.get("odontograma_completo")
+    if not isinstance(odontograma, dict):
+        odontograma = extracted["odontograma_completo"] = {}
+    # Una pieza mencionada sin hallazgo ni tratamiento no aporta nada al odontograma
+    local_odontograma = {tooth: entry for tooth, entry in local_result["odontograma"].items() if any(entry.values())}
+    local_teeth = set(local_odontograma)
+    gemini_teeth = {str(tooth) for tooth in odontograma}
+    only_local = sorted(local_teeth - gemini_teeth)
+    only_gemini = sorted(gemini_teeth - local_teeth)
+    for tooth, local_entry in local_odontograma.items():
+        entry = odontograma.get(tooth)
+        if not isinstance(entry, dict):
+            odontograma[tooth] = dict(local_entry)
+            continue
+        for field, value in local_entry.items():
+            if value and not entry.get(field):
+                entry[field] = value
+    if only_local:
+        LOCAL_EXTRACTION_DISCREPANCIES.inc(len(only_local), kind="solo_local")
+    if only_gemini:
+        LOCAL_EXTRACTION_DISCREPANCIES.inc(len(only_gemini), kind="solo_gemini")
+    if only_local or only_gemini:
+        print(f"Odontograma {transcript_id}: piezas solo en reglas locales {only_local}, solo en Gemini {only_gemini}.")
+    return only_local
@@ -0,0 +1,166 @@
+# E:\PROJECTS\voice_test\local_extraction_benchmark.py
+#
+# Benchmark de las reglas locales (local_extraction.py) con dos corpus:
+# - dictados sintéticos con la respuesta conocida. El generador usa el mismo
+#   vocabulario que las reglas, así que su precisión y exhaustividad salen
+#   casi perfectas por construcción: sirven para velocidad y regresiones.
+# - dictados escritos a mano con el estilo de los reales, que no salen del
+#   generador (local_extraction_dictados.json): horas, dosis, fechas,
+#   porcentajes, piezas descritas sin número y términos fuera del
+#   diccionario. Las métricas de calidad son las de este corpus.
+# Para cada uno: precisión y exhaustividad de las piezas detectadas, aciertos
+# de hallazgos, planes y tratamientos realizados por pieza, porcentaje de
+# dictados que serían concluyentes (se omitiría Gemini) y velocidad. Uso:
+#   python local_extraction_benchmark.py [--dictados 2000] [--semilla 7] [--detalle]
+
+import os
+import json
+import time
+import random
+import argparse
+
+from local_extraction import extract_dental_findings, is_valid_fdi, LOCAL_EXTRACTION_SKIP_MAX_WORDS
+
+_UNIT_WORDS = ["", "uno", "dos", "tres", "cuatro", "cinco", "seis", "siete", "ocho", "nueve"]
+_SPECIAL_WORDS = {11: "once", 12: "doce", 13: "trece", 14: "catorce", 15: "quince", 16: "dieciséis", 17: "diecisiete",
+                  18: "dieciocho", 21: "veintiuno", 22: "veintidós", 23: "veintitrés", 24: "veinticuatro",
+                  25: "veinticinco", 26: "veintiséis", 27: "veintisiete", 28: "veintiocho"}
+_TENS_WORDS = {3: "treinta", 4: "cuarenta", 5: "cincuenta", 6: "sesenta", 7: "setenta", 8: "ochenta"}
+
+# (texto dictado, etiqueta esperada)
+_FINDINGS = [("caries mesial profunda", "Caries mesial profunda"), ("caries oclusal", "Caries oclusal"),
+             ("caries distal", "Caries distal"), ("una fractura", "Fractura"), ("movilidad grado dos", "Movilidad"),
+             ("pulpitis irreversible", "Pulpitis irreversible"), ("un absceso", "Absceso"),
+             ("una lesión periapical", "Lesión periapical"), ("un resto radicular", "Resto radicular"),
+             ("una obturación defectuosa", "Obturación defectuosa"), ("sensibilidad", "Sensibilidad")]
+_POSITIONAL_FINDINGS = [("está retenida", "Retenida"), ("está incluida", "Incluida"), ("está ausente", "Ausente")]
+_PLANS = [("endodoncia", "Endodoncia"), ("exodoncia profiláctica", "Exodoncia profiláctica"), ("exodoncia", "Exodoncia"),
+          ("corona", "Corona"), ("obturación con resina", "Obturación"), ("implante", "Implante"),
+          ("incrustación", "Incrustación"), ("sellante", "Sellante")]
+_PLAN_VERBS = ["se planifica", "se indica", "se propone", "requiere"]
+# (campo de la respuesta esperada, campo del odontograma local, nombre en el informe)
+_FIELDS = (("hallazgo", "diagnostico_hallazgo", "Hallazgos"), ("plan", "plan_tratamiento_sugerido", "Planes"),
+           ("realizado", "notas_adicionales", "Realizados"))
+HELD_OUT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "local_extraction_dictados.json")
+_FILLER_SENTENCES = ["El paciente refiere dolor al masticar desde hace una semana.",
+                     "Sin antecedentes médicos de interés.", "Higiene oral deficiente.",
+                     "Se recomienda control en dos semanas."]
+
+def tooth_to_words(code: int, rng: random.Random) -> str:
+    # Distintas formas de dictar una pieza: palabras, cifras o cifra a cifra
+    style = rng.random()
+    if style < 0.2:
+        return str(code)
+    if style < 0.35:
+        return f"{_UNIT_WORDS[code // 10]} {_UNIT_WORDS[code % 10]}"
+    if code in _SPECIAL_WORDS:
+        return _SPECIAL_WORDS[code]
+    return f"{_TENS_WORDS[code // 10]} y {_UNIT_WORDS[code % 10]}"
+
+def _random_tooth(rng: random.Random) -> int:
+    while True:
+        code = rng.choice([rng.randint(11, 48), rng.randint(51, 85)]) if rng.random() < 0.15 else rng.randint(11, 48)
+        if is_valid_fdi(code):
+            return code
+
+def synthetic_dictation(rng: random.Random, filler_probability: float = 0.3) -> tuple[str, dict]:
+    # Un dictado con 1-4 piezas y la respuesta esperada {pieza: {"hallazgo", "plan"}}
+    expected: dict[str, dict] = {}
+    sentences = []
+    for _ in range(rng.randint(1, 4)):
+        code = _random_tooth(rng)
+        if str(code) in expected:
+            continue
+        tooth = tooth_to_words(code, rng)
+        plan_text, plan_label = rng.choice(_PLANS)
+        if rng.random() < 0.3:
+            finding_text, finding_label = rng.choice(_POSITIONAL_FINDINGS)
+            sentence = f"La pieza {tooth} {finding_text}, {rng.choice(_PLAN_VERBS)} {plan_text}."
+        else:
+            finding_text, finding_label = rng.choice(_FINDINGS)
+            article = rng.choice(["la pieza", "la", "el diente"])
+            sentence = f"{finding_text.capitalize()} en {article} {tooth}, {rng.choice(_PLAN_VERBS)} {plan_text}."
+        expected[str(code)] = {"hallazgo": finding_label, "plan": plan_label}
+        sentences.append(sentence)
+    if rng.random() < filler_probability:
+        sentences.insert(rng.randint(0, len(sentences)), rng.choice(_FILLER_SENTENCES))
+    return " ".join(sentences), expected
+
+def load_held_out(path: str = HELD_OUT_PATH) -> list[tuple[str, dict]]:
+    # [(texto, {pieza: {"hallazgo", "plan", "realizado"}})]; los campos que no se dictan se omiten
+    with open(path, encoding="utf-8") as f:
+        return [(item["texto"], item["piezas"]) for item in json.load(f)]
+
+def evaluate(corpus: list[tuple[str, dict]]) -> dict:
+    started = time.perf_counter()
+    results = [extract_dental_findings(text) for text, _ in corpus]
+    elapsed = time.perf_counter() - started
+
+    true_positive = false_positive = false_negative = 0
+    fields_expected = dict.fromkeys((name for name, _, _ in _FIELDS), 0)
+    fields_ok = dict(fields_expected)
+    confident = confident_wrong = 0
+    errors = []
+    for number, ((_, expected), result) in enumerate(zip(corpus, results), 1):
+        found = result["odontograma"]
+        true_positive += len(set(found) & set(expected))
+        false_positive += len(set(found) - set(expected))
+        false_negative += len(set(expected) - set(found))
+        if set(found) != set(expected):
+            errors.append((number, sorted(set(found) - set(expected)), sorted(set(expected) - set(found))))
+        for tooth, answer in expected.items():
+            entry = found.get(tooth, {})
+            for name, field, _ in _FIELDS:
+                if answer.get(name):
+                    fields_expected[name] += 1
+                    fields_ok[name] += answer[name] in entry.get(field, "")
+        if result["confiable"]:
+            confident += 1
+            if set(found) != set(expected):
+                confident_wrong += 1
+    expected_teeth = true_positive + false_negative
+    count = len(corpus)
+    return {
+        "dictados": count,
+        "piezas_esperadas": expected_teeth,
+        "precision_piezas": true_positive / max(1, true_positive + false_positive),
+        "exhaustividad_piezas": true_positive / max(1, expected_teeth),
+        "campos_esperados": fields_expected,
+        "aciertos": {name: fields_ok[name] / max(1, fields_expected[name]) for name in fields_ok},
+        "concluyentes": confident / max(1, count),
+        "concluyentes_erroneos": confident_wrong,
+        "errores_piezas": errors,
+        "ms_por_dictado": elapsed * 1000 / max(1, count),
+        "dictados_por_segundo": count / elapsed if elapsed else float("inf"),
+    }
+
+def run_benchmark(dictation_count: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    return evaluate([synthetic_dictation(rng) for _ in range(dictation_count)])
+
+def print_report(report: dict, detail: bool = False) -> None:
+    print(f"  Piezas:    precisión {report['precision_piezas']:.1%}, exhaustividad {report['exhaustividad_piezas']:.1%}")
+    print("  " + "   ".join(f"{title}: {report['aciertos'][name]:.1%} correctos ({report['campos_esperados'][name]})"
+                            for name, _, title in _FIELDS if report["campos_esperados"][name]))
+    print(f"  Concluyentes (se omitiría Gemini, máx. {LOCAL_EXTRACTION_SKIP_MAX_WORDS} palabras): {report['concluyentes']:.1%} "
+          f"({report['concluyentes_erroneos']} con piezas erróneas)")
+    print(f"  Velocidad: {report['ms_por_dictado']:.3f} ms por dictado ({report['dictados_por_segundo']:.0f} dictados/s)")
+    if detail:
+        for number, extra, missing in report["errores_piezas"]:
+            print(f"    dictado {number}: de más {extra or '-'}, no detectadas {missing or '-'}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark de la extracción local de piezas y hallazgos.")
+    parser.add_argument("--dictados", type=int, default=2000, help="Número de dictados sintéticos (2000).")
+    parser.add_argument("--semilla", type=int, default=7, help="Semilla del generador, para repetir el corpus (7).")
+    parser.add_argument("--detalle", action="store_true", help="Lista las piezas de más o no detectadas de cada dictado.")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.dictados, args.semilla)
+    print(f"Dictados sintéticos: {report['dictados']} ({report['piezas_esperadas']} piezas), semilla {args.semilla}. "
+          "Mismo vocabulario que las reglas: no mide la calidad real.")
+    print_report(report)
+    report = evaluate(load_held_out())
+    print(f"Dictados escritos a mano ({os.path.basename(HELD_OUT_PATH)}): {report['dictados']} "
+          f"({report['piezas_esperadas']} piezas)")
+    print_report(report, args.detalle)
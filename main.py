@@ -4,16 +4,40 @@ import os
 import asyncio
 import json
 import io
+import hmac
+import base64
+import functools
+import time
+import shutil
+import tempfile
 from datetime import datetime
-from fastapi import FastAPI, File, UploadFile, HTTPException
-import httpx
-from fastapi.responses import StreamingResponse
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, FileResponse, Response, JSONResponse
 from dotenv import load_dotenv
 
 # Importar los módulos refactorizados
-from assemblyai_service import upload_audio_to_assemblyai, request_transcription, poll_for_transcription_result
-from gemini_service import analyze_text_with_gemini
-from pdf_generator import create_pdf_from_json
+from http_client import build_http_client
+from pipeline import (run_dictation_pipeline, run_transcript_pipeline, use_pdf_process_pool, shutdown_pdf_executor, render_pdf,
+    build_pdf_filename)
+from pdf_generator import preload_pdf_fonts
+from pdf_render_engine import PDF_ENGINE_ENABLED
+from job_store import JobStore, JOB_STATUS_COMPLETED, JOB_STATUS_FAILED
+from job_worker import JobWorkerPool
+from upload_streaming import iter_upload_file, hash_upload_file, save_upload_file, MaxBodySizeMiddleware, MAX_AUDIO_UPLOAD_BYTES
+from result_cache import ResultCache
+from record_store import RecordStore, RecordEditError, apply_record_edits, RECORD_EDITS
+from gemini_service import PROMPT_VERSION, configure_gemini, shutdown_gemini
+from local_extraction import LOCAL_EXTRACTION_VERSION
+from batch_service import stream_batch_zip
+from transcription_scheduler import TranscriptionPollScheduler, WEBHOOKS_RECEIVED
+from webhook_inbox import WebhookInbox
+from assemblyai_service import ASSEMBLYAI_WEBHOOK_AUTH_HEADER
+from chunked_transcription import CHUNKED_TRANSCRIPTION_ENABLED
+from admission import AdmissionController, merge_stage_limits
+from realtime_transcription import RealtimeTranscriber, REALTIME_SAMPLE_RATE, REALTIME_UNAVAILABLE_DETAIL, realtime_available
+from sse_events import format_sse_event, StreamedPdfStore, SSE_KEEPALIVE_SECONDS, SSE_KEEPALIVE_COMMENT
+from metrics import render_prometheus, server_timing_header, stage_timer, PROMETHEUS_CONTENT_TYPE
 
 # Cargar variables de entorno del archivo .env
 load_dotenv()
@@ -26,89 +50,626 @@ if not ASSEMBLYAI_API_KEY:
 if not GEMINI_API_KEY:
     print("ADVERTENCIA: GEMINI_API_KEY no encontrada. El análisis de texto fallará.")
 
+# Configuración de la cola de trabajos asíncronos
+JOBS_DATA_DIR = os.getenv("JOBS_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "trabajos"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "900"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Espera antes de reintentar un trabajo tras un error transitorio (502, 503, 429): exponencial desde la base
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "30"))
+JOB_RETRY_MAX_SECONDS = float(os.getenv("JOB_RETRY_MAX_SECONDS", "600"))
+
+# Configuración de la caché de resultados por hash de audio
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "cache"))
+RESULT_CACHE_MEMORY_MAX_BYTES = int(os.getenv("RESULT_CACHE_MEMORY_MAX_BYTES", str(64 * 1024 * 1024)))
+RESULT_CACHE_TTL_SECONDS = float(os.getenv("RESULT_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+
+# Registros editables: diccionario final y PDF de cada dictado, corregibles con PATCH
+RECORDS_ENABLED = os.getenv("RECORDS_ENABLED", "true").lower() in ("1", "true", "yes")
+RECORDS_DATA_DIR = os.getenv("RECORDS_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "registros"))
+
+# Configuración del procesamiento por lotes
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "50"))
+BATCH_ASSEMBLYAI_CONCURRENCY = int(os.getenv("BATCH_ASSEMBLYAI_CONCURRENCY", "8"))
+BATCH_GEMINI_CONCURRENCY = int(os.getenv("BATCH_GEMINI_CONCURRENCY", "4"))
+
+# Configuración del planificador de sondeos a AssemblyAI
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "1"))
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "15"))
+POLL_BACKOFF = float(os.getenv("POLL_BACKOFF", "1.5"))
+POLL_JITTER = float(os.getenv("POLL_JITTER", "0.2"))
+POLL_MAX_CONCURRENT = int(os.getenv("POLL_MAX_CONCURRENT", "20"))
+TRANSCRIPTION_DEADLINE_SECONDS = float(os.getenv("TRANSCRIPTION_DEADLINE_SECONDS", "900"))
+
+# Preprocesado de audio con ffmpeg (se puede forzar por petición con ?preprocesar=true|false)
+AUDIO_PREPROCESS_ENABLED = os.getenv("AUDIO_PREPROCESS_ENABLED", "false").lower() in ("1", "true", "yes")
+
+# Dictado en tiempo real por WebSocket
+REALTIME_MAX_SESSIONS = int(os.getenv("REALTIME_MAX_SESSIONS", "20"))
+
+# Modo webhook: URL pública de /webhooks/assemblyai y secreto compartido
+ASSEMBLYAI_WEBHOOK_URL = os.getenv("ASSEMBLYAI_WEBHOOK_URL")
+ASSEMBLYAI_WEBHOOK_SECRET = os.getenv("ASSEMBLYAI_WEBHOOK_SECRET")
+WEBHOOK_FALLBACK_POLL_INTERVAL = float(os.getenv("WEBHOOK_FALLBACK_POLL_INTERVAL", "30"))
+WEBHOOK_DATA_DIR = os.getenv("WEBHOOK_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "webhooks"))
+
+if ASSEMBLYAI_WEBHOOK_URL and not ASSEMBLYAI_WEBHOOK_SECRET:
+    print("ADVERTENCIA: ASSEMBLYAI_WEBHOOK_URL configurada sin ASSEMBLYAI_WEBHOOK_SECRET. Los webhooks no se verificarán.")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.http_client = build_http_client()
+    if PDF_ENGINE_ENABLED:
+        # PDF en procesos precalentados (imports y fuentes), fuera del GIL del servidor
+        await use_pdf_process_pool().start()
+    else:
+        # Las fuentes DejaVu se analizan una vez por proceso; se cargan ya para que no las pague el primer PDF
+        preload_pdf_fonts()
+    if GEMINI_API_KEY:
+        configure_gemini(GEMINI_API_KEY)
+    app.state.webhook_inbox = WebhookInbox(WEBHOOK_DATA_DIR) if ASSEMBLYAI_WEBHOOK_URL else None
+    app.state.poll_scheduler = TranscriptionPollScheduler(
+        app.state.http_client, ASSEMBLYAI_API_KEY, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL,
+        backoff=POLL_BACKOFF, jitter=POLL_JITTER, deadline_seconds=TRANSCRIPTION_DEADLINE_SECONDS,
+        max_concurrent_polls=POLL_MAX_CONCURRENT, webhook_url=ASSEMBLYAI_WEBHOOK_URL,
+        webhook_secret=ASSEMBLYAI_WEBHOOK_SECRET, webhook_inbox=app.state.webhook_inbox,
+        webhook_fallback_interval=WEBHOOK_FALLBACK_POLL_INTERVAL,
+    )
+    app.state.poll_scheduler.start()
+    app.state.result_cache = None
+    if RESULT_CACHE_ENABLED:
+        # Las reglas locales también cambian el resultado: forman parte de la versión
+        analysis_version = f"{PROMPT_VERSION}-l{LOCAL_EXTRACTION_VERSION}"
+        app.state.result_cache = ResultCache(RESULT_CACHE_DIR, analysis_version, memory_max_bytes=RESULT_CACHE_MEMORY_MAX_BYTES,
+                                             ttl_seconds=RESULT_CACHE_TTL_SECONDS)
+        purged = app.state.result_cache.purge_expired()
+        print(f"Caché de resultados activa (versión de análisis {analysis_version}, {purged} entradas obsoletas eliminadas).")
+    app.state.record_store = RecordStore(RECORDS_DATA_DIR) if RECORDS_ENABLED else None
+    # Control de admisión por etapa (429 con Retry-After si la cola se satura)
+    app.state.admission = AdmissionController.from_env()
+    app.state.realtime_sessions = 0
+    # PDF del dictado con progreso SSE, descargables por enlace durante un tiempo
+    app.state.streamed_pdfs = StreamedPdfStore()
+    # Límites compartidos por todos los lotes en curso de este proceso
+    app.state.batch_stage_limits = {
+        "assemblyai": asyncio.Semaphore(BATCH_ASSEMBLYAI_CONCURRENCY),
+        "gemini": asyncio.Semaphore(BATCH_GEMINI_CONCURRENCY),
+    }
+    app.state.job_store = JobStore(JOBS_DATA_DIR, lease_seconds=JOB_LEASE_SECONDS, max_attempts=JOB_MAX_ATTEMPTS)
+    app.state.job_worker_pool = JobWorkerPool(app.state.job_store, JOB_WORKERS, app.state.http_client, ASSEMBLYAI_API_KEY, GEMINI_API_KEY,
+                                              cache=app.state.result_cache, poll_scheduler=app.state.poll_scheduler,
+                                              stage_limits=app.state.admission.background_limits,
+                                              records=app.state.record_store, retry_base_seconds=JOB_RETRY_BASE_SECONDS,
+                                              retry_max_seconds=JOB_RETRY_MAX_SECONDS)
+    app.state.job_worker_pool.start()
+    try:
+        yield
+    finally:
+        await app.state.job_worker_pool.stop()
+        await app.state.poll_scheduler.stop()
+        await app.state.http_client.aclose()
+        shutdown_gemini()
+        shutdown_pdf_executor()
+
 app = FastAPI(
     title="Mi API de Dictado Dental IA con Odontograma",
     description="API para transcribir audio dental, analizarlo con IA, generar un JSON estructurado y un PDF.",
-    version="0.4.0" # Versión actualizada por refactorización
+    version="0.5.0", # Versión con API de trabajos asíncronos
+    lifespan=lifespan
 )
+# Los lotes llevan varios audios por petición; el límite se aplica por archivo al recibirlos.
+app.add_middleware(MaxBodySizeMiddleware, max_bytes=MAX_AUDIO_UPLOAD_BYTES, exempt_paths=("/lotes/",))
+
+def _resolve_preprocess(preprocesar: bool | None) -> bool:
+    # El parámetro de la petición manda; si no viene, se usa la configuración del servidor.
+    return AUDIO_PREPROCESS_ENABLED if preprocesar is None else preprocesar
+
+def _pipeline_headers(result: dict) -> dict:
+    headers = {
+        "Content-Disposition": f"attachment; filename=\"{result['pdf_filename']}\"",
+        "X-Cache": "HIT" if result["cache_hit"] else "MISS",
+        "X-Transcript-Id": result["transcript_id"],
+        "Server-Timing": server_timing_header(result["timings"]),
+    }
+    if result.get("preprocessing"):
+        headers["X-Audio-Bytes-Saved"] = str(result["preprocessing"]["bytes_saved"])
+    if result.get("chunking"):
+        headers["X-Transcription-Segments"] = str(result["chunking"]["segments"])
+        headers["X-Transcription-Seconds-Saved"] = f"{result['chunking']['seconds_saved']:.1f}"
+    return headers
 
 @app.post("/dictado-a-pdf/")
-async def dictado_a_pdf_endpoint(audio_file: UploadFile = File(...)):
+async def dictado_a_pdf_endpoint(audio_file: UploadFile = File(...), preprocesar: bool | None = None):
     if not ASSEMBLYAI_API_KEY or not GEMINI_API_KEY:
          raise HTTPException(status_code=500, detail="Una o más API Keys no están configuradas en el servidor.")
     if not audio_file:
         raise HTTPException(status_code=400, detail="No se proporcionó ningún archivo de audio.")
 
     print(f"Archivo recibido: {audio_file.filename}, tipo: {audio_file.content_type}")
-    file_content = await audio_file.read()
-    await audio_file.close()
-
-    async with httpx.AsyncClient(timeout=httpx.Timeout(120.0, connect=20.0)) as client:
-        try:
-            print("--- Iniciando Transcripción con AssemblyAI ---")
-            uploaded_audio_url = await upload_audio_to_assemblyai(client, file_content, ASSEMBLYAI_API_KEY)
-            transcript_id = await request_transcription(client, uploaded_audio_url, ASSEMBLYAI_API_KEY)
-            transcription_result = await poll_for_transcription_result(client, transcript_id, ASSEMBLYAI_API_KEY)
-            transcribed_text = transcription_result.get('text')
-            if not transcribed_text:
-                raise HTTPException(status_code=500, detail="La transcripción no produjo texto.")
-            
-            print(f"--- Texto Transcrito (primeros 200 chars): {transcribed_text[:200]}... ---")
-
-            print("--- Iniciando Análisis con Gemini para extraer JSON ---")
-            extracted_json_data = await analyze_text_with_gemini(transcribed_text, transcript_id, GEMINI_API_KEY)
-            
-            if not isinstance(extracted_json_data, dict):
-                print(f"Error: Gemini no devolvió un diccionario JSON válido. Recibido: {type(extracted_json_data)}")
-                raise HTTPException(status_code=500, detail="La IA no generó una estructura de datos válida.")
-
-            if "texto_transcrito_original" not in extracted_json_data or not extracted_json_data["texto_transcrito_original"]:
-                extracted_json_data["texto_transcrito_original"] = transcribed_text
-
-            print("--- JSON Estructurado por Gemini (parcial): ---")
-            print(json.dumps(extracted_json_data, indent=2, ensure_ascii=False)[:500])
-
-            print("--- Generando PDF ---")
-            loop = asyncio.get_event_loop()
-            pdf_bytes = await loop.run_in_executor(None, create_pdf_from_json, extracted_json_data)
-            print(f"PDF generado en memoria ({len(pdf_bytes)} bytes).")
-            if not pdf_bytes:
-                raise HTTPException(status_code=500, detail="La generación del PDF resultó en un archivo vacío.")
-
-            paciente_id_raw = extracted_json_data.get("paciente_identificador_mencionado_opcional", "desconocido")
-            paciente_id = str(paciente_id_raw).replace(" ", "_").replace("/", "_").replace("\\", "_") if paciente_id_raw else "desconocido"
-            
-            fecha_consulta_raw = extracted_json_data.get("fecha_hora_dictado_aproximada", datetime.utcnow().isoformat())
+
+    work_dir = None
+    try:
+        app.state.admission.ensure_capacity()
+        preprocess = _resolve_preprocess(preprocesar)
+        if preprocess or CHUNKED_TRANSCRIPTION_ENABLED:
+            # ffmpeg (preprocesado y troceado) necesita el audio en disco
+            work_dir = tempfile.mkdtemp(prefix="dictado_")
+            audio_path = os.path.join(work_dir, "original")
+            _, audio_sha256 = await save_upload_file(audio_file, audio_path)
+            result = await run_dictation_pipeline(app.state.http_client, None, ASSEMBLYAI_API_KEY, GEMINI_API_KEY,
+                                                  cache=app.state.result_cache, audio_sha256=audio_sha256,
+                                                  stage_limits=app.state.admission.request_limits,
+                                                  poll_scheduler=app.state.poll_scheduler, audio_path=audio_path,
+                                                  preprocess=preprocess, records=app.state.record_store)
+        else:
+            audio_sha256 = await hash_upload_file(audio_file) if app.state.result_cache is not None else None
+            audio_stream = functools.partial(iter_upload_file, audio_file)
+            result = await run_dictation_pipeline(app.state.http_client, audio_stream, ASSEMBLYAI_API_KEY, GEMINI_API_KEY,
+                                                  cache=app.state.result_cache, audio_sha256=audio_sha256,
+                                                  stage_limits=app.state.admission.request_limits,
+                                                  poll_scheduler=app.state.poll_scheduler, records=app.state.record_store)
+        return StreamingResponse(
+            io.BytesIO(result["pdf_bytes"]),
+            media_type="application/pdf",
+            headers=_pipeline_headers(result)
+        )
+    except HTTPException as e:
+        raise e
+    except RuntimeError as e: 
+        print(f"Error de Runtime durante la generación del PDF o flujo: {str(e)}")
+        import traceback; traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Error al procesar la solicitud: {str(e)}")
+    except Exception as e:
+        print(f"Error general en /dictado-a-pdf/: {str(e)}")
+        import traceback; traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Ocurrió un error interno inesperado en el servidor: {str(e)}")
+    finally:
+        await audio_file.close()
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+# --- Dictado con progreso por Server-Sent Events ---
+@app.post("/dictado-a-pdf/eventos/")
+async def dictado_a_pdf_eventos_endpoint(audio_file: UploadFile = File(...), preprocesar: bool | None = None):
+    # Igual que /dictado-a-pdf/ pero la respuesta es text/event-stream: eventos
+    # "estado" ({"etapa"}), "seccion" ({"campo", "valor"}), "odontograma" (una
+    # pieza) y "procedimiento" según los va generando Gemini, antes del PDF, y
+    # al final "resultado" con el enlace y el PDF en base64 (o "error").
+    if not ASSEMBLYAI_API_KEY or not GEMINI_API_KEY:
+         raise HTTPException(status_code=500, detail="Una o más API Keys no están configuradas en el servidor.")
+    if not audio_file:
+        raise HTTPException(status_code=400, detail="No se proporcionó ningún archivo de audio.")
+
+    print(f"Archivo recibido con progreso SSE: {audio_file.filename}, tipo: {audio_file.content_type}")
+    # El audio se vuelca a disco: el flujo sigue después de devolver la respuesta,
+    # cuando el UploadFile ya está cerrado.
+    work_dir = tempfile.mkdtemp(prefix="dictado_sse_")
+    try:
+        app.state.admission.ensure_capacity()
+        audio_path = os.path.join(work_dir, "original")
+        audio_size, audio_sha256 = await save_upload_file(audio_file, audio_path)
+        if not audio_size:
+            raise HTTPException(status_code=400, detail="El archivo de audio está vacío.")
+    except BaseException:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+    finally:
+        await audio_file.close()
+
+    return StreamingResponse(
+        _dictation_event_stream(work_dir, audio_path, audio_sha256 if app.state.result_cache is not None else None,
+                                _resolve_preprocess(preprocesar)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def _dictation_event_stream(work_dir: str, audio_path: str, audio_sha256: str | None, preprocess: bool):
+    events: asyncio.Queue = asyncio.Queue()
+
+    async def on_stage(stage: str) -> None:
+        await events.put(("estado", {"etapa": stage}))
+
+    async def on_section(kind: str, data: dict) -> None:
+        await events.put((kind, data))
+
+    pipeline_task = asyncio.create_task(run_dictation_pipeline(
+        app.state.http_client, None, ASSEMBLYAI_API_KEY, GEMINI_API_KEY, on_stage=on_stage, cache=app.state.result_cache,
+        audio_sha256=audio_sha256, stage_limits=app.state.admission.request_limits, poll_scheduler=app.state.poll_scheduler,
+        audio_path=audio_path, preprocess=preprocess, on_section=on_section, records=app.state.record_store,
+    ))
+    try:
+        yield format_sse_event("estado", {"etapa": "recibido"})
+        while True:
+            next_event = asyncio.ensure_future(events.get())
+            done, _ = await asyncio.wait({next_event, pipeline_task}, timeout=SSE_KEEPALIVE_SECONDS,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if next_event in done:
+                yield format_sse_event(*next_event.result())
+                continue
+            next_event.cancel()
+            if pipeline_task in done:
+                break
+            # Comentario SSE para que los proxies no corten la conexión durante la transcripción
+            yield SSE_KEEPALIVE_COMMENT
+        while not events.empty():
+            yield format_sse_event(*events.get_nowait())
+
+        result = pipeline_task.result()
+        result_id = app.state.streamed_pdfs.put(result["pdf_filename"], result["pdf_bytes"])
+        yield format_sse_event("resultado", {
+            "transcript_id": result["transcript_id"],
+            "pdf_filename": result["pdf_filename"],
+            "pdf_url": f"/dictado-a-pdf/resultados/{result_id}",
+            "pdf_bytes": len(result["pdf_bytes"]),
+            "pdf_base64": base64.b64encode(result["pdf_bytes"]).decode("ascii"),
+            "cache": "HIT" if result["cache_hit"] else "MISS",
+            "server_timing": server_timing_header(result["timings"]),
+        })
+    except HTTPException as e:
+        yield format_sse_event("error", {"status_code": e.status_code, "detalle": str(e.detail)})
+    except Exception as e:
+        print(f"Error en /dictado-a-pdf/eventos/: {type(e).__name__} - {e}")
+        import traceback; traceback.print_exc()
+        yield format_sse_event("error", {"status_code": 500, "detalle": f"Ocurrió un error interno inesperado en el servidor: {str(e)}"})
+    finally:
+        # Si el cliente se desconecta, se cancela el flujo
+        if not pipeline_task.done():
+            pipeline_task.cancel()
+            await asyncio.gather(pipeline_task, return_exceptions=True)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+@app.get("/dictado-a-pdf/resultados/{result_id}")
+async def resultado_dictado_eventos_endpoint(result_id: str):
+    stored = app.state.streamed_pdfs.get(result_id)
+    if stored is None:
+        raise HTTPException(status_code=404, detail=f"Resultado '{result_id}' no encontrado o caducado.")
+    pdf_filename, pdf_bytes = stored
+    return Response(content=pdf_bytes, media_type="application/pdf",
+                    headers={"Content-Disposition": f"attachment; filename=\"{pdf_filename}\""})
+
+# --- API de trabajos asíncronos ---
+def _job_status_payload(job: dict) -> dict:
+    payload = {
+        "job_id": job["id"],
+        "status": job["status"],
+        "stage": job["stage"],
+        "attempts": job["attempts"],
+        "original_filename": job["original_filename"],
+        "created_at": datetime.utcfromtimestamp(job["created_at"]).isoformat() + "Z",
+        "updated_at": datetime.utcfromtimestamp(job["updated_at"]).isoformat() + "Z",
+        "status_url": f"/trabajos/{job['id']}",
+    }
+    if job["status"] == JOB_STATUS_COMPLETED:
+        payload["transcript_id"] = job["transcript_id"]
+        payload["pdf_filename"] = job["pdf_filename"]
+        payload["result_url"] = f"/trabajos/{job['id']}/pdf"
+    elif job["status"] == JOB_STATUS_FAILED:
+        payload["error"] = {"status_code": job["error_status_code"], "detail": job["error_detail"]}
+    elif job["available_at"] and job["available_at"] > time.time():
+        # En cola esperando un reintento tras un error transitorio
+        payload["next_attempt_at"] = datetime.utcfromtimestamp(job["available_at"]).isoformat() + "Z"
+        payload["last_error"] = {"status_code": job["error_status_code"], "detail": job["error_detail"]}
+    return payload
+
+@app.post("/trabajos/dictado-a-pdf/", status_code=202)
+async def crear_trabajo_dictado_endpoint(audio_file: UploadFile = File(...), preprocesar: bool | None = None):
+    if not ASSEMBLYAI_API_KEY or not GEMINI_API_KEY:
+         raise HTTPException(status_code=500, detail="Una o más API Keys no están configuradas en el servidor.")
+    if not audio_file:
+        raise HTTPException(status_code=400, detail="No se proporcionó ningún archivo de audio.")
+
+    print(f"Archivo recibido para trabajo asíncrono: {audio_file.filename}, tipo: {audio_file.content_type}")
+    loop = asyncio.get_event_loop()
+    job_store = app.state.job_store
+    job_id = job_store.new_job_id()
+    try:
+        audio_size, audio_sha256 = await save_upload_file(audio_file, job_store.audio_path_for(job_id))
+    finally:
+        await audio_file.close()
+    if not audio_size:
+        os.remove(job_store.audio_path_for(job_id))
+        raise HTTPException(status_code=400, detail="El archivo de audio está vacío.")
+
+    job_id = await loop.run_in_executor(None, job_store.create_job, job_id, audio_file.filename, audio_file.content_type, audio_sha256,
+                                        _resolve_preprocess(preprocesar))
+    app.state.job_worker_pool.notify_new_job()
+    print(f"Trabajo {job_id} encolado.")
+    job = await loop.run_in_executor(None, job_store.get_job, job_id)
+    return _job_status_payload(job)
+
+@app.get("/trabajos/{job_id}")
+async def estado_trabajo_endpoint(job_id: str):
+    loop = asyncio.get_event_loop()
+    job = await loop.run_in_executor(None, app.state.job_store.get_job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Trabajo '{job_id}' no encontrado.")
+    return _job_status_payload(job)
+
+@app.get("/trabajos/{job_id}/pdf")
+async def resultado_trabajo_endpoint(job_id: str):
+    loop = asyncio.get_event_loop()
+    job = await loop.run_in_executor(None, app.state.job_store.get_job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Trabajo '{job_id}' no encontrado.")
+    if job["status"] == JOB_STATUS_FAILED:
+        raise HTTPException(status_code=job["error_status_code"] or 500, detail=job["error_detail"])
+    if job["status"] != JOB_STATUS_COMPLETED:
+        raise HTTPException(status_code=409, detail=f"El trabajo '{job_id}' aún no ha terminado (estado: {job['status']}).")
+    if not job["pdf_path"] or not os.path.exists(job["pdf_path"]):
+        raise HTTPException(status_code=410, detail=f"El PDF del trabajo '{job_id}' ya no está disponible.")
+    return FileResponse(
+        job["pdf_path"],
+        media_type="application/pdf",
+        filename=job["pdf_filename"],
+    )
+
+# --- Registros editables ---
+def _etag_matches(header_value: str | None, etag: str) -> bool:
+    # If-Match / If-None-Match: "*" o lista de ETags (se ignora el prefijo débil W/)
+    if not header_value:
+        return False
+    candidates = [candidate.strip() for candidate in header_value.split(",")]
+    return "*" in candidates or etag in (candidate.removeprefix("W/") for candidate in candidates)
+
+def _pdf_etag(record: dict) -> str:
+    return record["etag"][:-1] + '-pdf"'
+
+def _record_payload(record: dict) -> dict:
+    return {
+        "transcript_id": record["transcript_id"],
+        "version": record["version"],
+        "pdf_filename": record["pdf_filename"],
+        "updated_at": datetime.utcfromtimestamp(record["updated_at"]).isoformat() + "Z",
+        "pdf_url": f"/registros/{record['transcript_id']}/pdf",
+        "datos": record["data"],
+    }
+
+def _record_headers(record: dict, timings: dict | None = None) -> dict:
+    # no-cache: el cliente puede guardar la respuesta pero la revalida con If-None-Match
+    headers = {"ETag": record["etag"], "Cache-Control": "no-cache"}
+    if timings:
+        headers["Server-Timing"] = server_timing_header(timings)
+    return headers
+
+async def _get_record(transcript_id: str) -> dict:
+    if app.state.record_store is None:
+        raise HTTPException(status_code=404, detail="Los registros editables no están activados.")
+    loop = asyncio.get_event_loop()
+    record = await loop.run_in_executor(None, app.state.record_store.get, transcript_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"Registro '{transcript_id}' no encontrado.")
+    return record
+
+@app.get("/registros/{transcript_id}")
+async def registro_endpoint(transcript_id: str, request: Request):
+    record = await _get_record(transcript_id)
+    if _etag_matches(request.headers.get("if-none-match"), record["etag"]):
+        return Response(status_code=304, headers=_record_headers(record))
+    return JSONResponse(_record_payload(record), headers=_record_headers(record))
+
+@app.patch("/registros/{transcript_id}")
+async def corregir_registro_endpoint(transcript_id: str, request: Request):
+    # Corrige campos del registro (JSON Merge Patch, ver apply_record_edits) y
+    # vuelve a generar solo el PDF: sin AssemblyAI ni Gemini, milisegundos.
+    # Con If-Match, la corrección solo se aplica sobre esa versión (412 si no).
+    timings: dict = {}
+    started = time.perf_counter()
+    record = await _get_record(transcript_id)
+    if_match = request.headers.get("if-match")
+    if if_match and not _etag_matches(if_match, record["etag"]):
+        RECORD_EDITS.inc(outcome="conflicto")
+        raise HTTPException(status_code=412, detail="El registro ha cambiado desde la versión indicada en If-Match.",
+                            headers=_record_headers(record))
+    try:
+        edits = await request.json()
+        data = apply_record_edits(record["data"], edits)
+    except (RecordEditError, ValueError) as e:
+        RECORD_EDITS.inc(outcome="invalida")
+        detail = str(e) if isinstance(e, RecordEditError) else "El cuerpo de la corrección debe ser JSON."
+        raise HTTPException(status_code=422 if isinstance(e, RecordEditError) else 400, detail=detail)
+    if data == record["data"]:
+        RECORD_EDITS.inc(outcome="sin_cambios")
+        return JSONResponse(_record_payload(record), headers=_record_headers(record))
+
+    with stage_timer(timings, "pdf_render"):
+        pdf_bytes = await render_pdf(data)
+    if not pdf_bytes:
+        raise HTTPException(status_code=500, detail="La generación del PDF resultó en un archivo vacío.")
+    loop = asyncio.get_event_loop()
+    with stage_timer(timings, "record_save"):
+        updated = await loop.run_in_executor(None, app.state.record_store.update, record, data, pdf_bytes,
+                                             build_pdf_filename(data, transcript_id))
+    if updated is None:
+        # Otra corrección se guardó mientras se generaba este PDF
+        RECORD_EDITS.inc(outcome="conflicto")
+        raise HTTPException(status_code=412 if if_match else 409,
+                            detail="El registro se modificó durante la corrección; vuelva a leerlo y repita el cambio.")
+    timings["total"] = time.perf_counter() - started
+    RECORD_EDITS.inc(outcome="ok")
+    print(f"Registro {transcript_id} corregido (versión {updated['version']}) en {timings['total'] * 1000:.0f} ms.")
+    return JSONResponse(_record_payload(updated), headers=_record_headers(updated, timings))
+
+@app.get("/registros/{transcript_id}/pdf")
+async def pdf_registro_endpoint(transcript_id: str, request: Request):
+    record = await _get_record(transcript_id)
+    headers = {"ETag": _pdf_etag(record), "Cache-Control": "no-cache"}
+    if _etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    loop = asyncio.get_event_loop()
+    pdf_bytes = await loop.run_in_executor(None, app.state.record_store.read_pdf, record)
+    if pdf_bytes is None:
+        # Una corrección simultánea acaba de sustituir el archivo: se sirve la versión nueva
+        record = await _get_record(transcript_id)
+        headers["ETag"] = _pdf_etag(record)
+        pdf_bytes = await loop.run_in_executor(None, app.state.record_store.read_pdf, record)
+        if pdf_bytes is None:
+            raise HTTPException(status_code=410, detail=f"El PDF del registro '{transcript_id}' ya no está disponible.")
+    headers["Content-Disposition"] = f"attachment; filename=\"{record['pdf_filename']}\""
+    return Response(content=pdf_bytes, media_type="application/pdf", headers=headers)
+
+# --- Procesamiento por lotes ---
+@app.post("/lotes/dictado-a-pdf/")
+async def lote_dictado_a_pdf_endpoint(audio_files: list[UploadFile] = File(...), preprocesar: bool | None = None):
+    if not ASSEMBLYAI_API_KEY or not GEMINI_API_KEY:
+         raise HTTPException(status_code=500, detail="Una o más API Keys no están configuradas en el servidor.")
+    if not audio_files:
+        raise HTTPException(status_code=400, detail="No se proporcionó ningún archivo de audio.")
+    if len(audio_files) > BATCH_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"El lote supera el máximo de {BATCH_MAX_FILES} archivos.")
+
+    print(f"Lote recibido con {len(audio_files)} archivos.")
+    # Los audios se vuelcan a un directorio temporal porque el ZIP se genera
+    # después de devolver la respuesta, cuando los UploadFile ya están cerrados.
+    work_dir = tempfile.mkdtemp(prefix="lote_")
+    items = []
+    try:
+        for i, audio_file in enumerate(audio_files):
+            audio_path = os.path.join(work_dir, f"{i:03d}")
             try:
-                if fecha_consulta_raw.endswith('Z'):
-                    dt_obj = datetime.fromisoformat(fecha_consulta_raw.replace("Z", "+00:00"))
-                else:
-                    dt_obj = datetime.fromisoformat(fecha_consulta_raw)
-                    if dt_obj.tzinfo is None: 
-                        dt_obj = dt_obj.replace(tzinfo=datetime.timezone.utc)
-                fecha_consulta_clean = dt_obj.strftime("%Y%m%d_%H%M")
-            except Exception as date_e:
-                print(f"Error parseando fecha '{fecha_consulta_raw}': {date_e}")
-                fecha_consulta_clean = "fecha_invalida"
-
-            pdf_filename_base = f"HistoriaDental_{paciente_id}_{fecha_consulta_clean}_{transcript_id[:6]}"
-            pdf_filename_safe = "".join(c if c.isalnum() or c in ['_', '-'] else '_' for c in pdf_filename_base) + ".pdf"
-            
-            return StreamingResponse(
-                io.BytesIO(pdf_bytes),
-                media_type="application/pdf",
-                headers={"Content-Disposition": f"attachment; filename=\"{pdf_filename_safe}\""}
-            )
-        except HTTPException as e:
-            raise e
-        except RuntimeError as e: 
-            print(f"Error de Runtime durante la generación del PDF o flujo: {str(e)}")
-            import traceback; traceback.print_exc()
-            raise HTTPException(status_code=500, detail=f"Error al procesar la solicitud: {str(e)}")
-        except Exception as e:
-            print(f"Error general en /dictado-a-pdf/: {str(e)}")
-            import traceback; traceback.print_exc()
-            raise HTTPException(status_code=500, detail=f"Ocurrió un error interno inesperado en el servidor: {str(e)}")
+                audio_size, audio_sha256 = await save_upload_file(audio_file, audio_path)
+            finally:
+                await audio_file.close()
+            if not audio_size:
+                raise HTTPException(status_code=400, detail=f"El archivo de audio '{audio_file.filename}' está vacío.")
+            items.append({"original_filename": audio_file.filename or f"audio_{i + 1}", "audio_path": audio_path,
+                          "audio_sha256": audio_sha256 if app.state.result_cache is not None else None})
+    except BaseException:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+
+    batch_name = f"Lote_HistoriasDentales_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.zip"
+    return StreamingResponse(
+        stream_batch_zip(items, work_dir, app.state.http_client, ASSEMBLYAI_API_KEY, GEMINI_API_KEY,
+                         merge_stage_limits(app.state.batch_stage_limits, app.state.admission.background_limits),
+                         cache=app.state.result_cache,
+                         poll_scheduler=app.state.poll_scheduler, preprocess=_resolve_preprocess(preprocesar),
+                         records=app.state.record_store),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename=\"{batch_name}\""}
+    )
+
+# --- Dictado en tiempo real ---
+@app.websocket("/ws/dictado-a-pdf")
+async def dictado_tiempo_real_endpoint(websocket: WebSocket, sample_rate: int = REALTIME_SAMPLE_RATE):
+    # Protocolo: el cliente envía tramas binarias de audio PCM 16 bits mono a
+    # sample_rate Hz mientras dicta y {"type": "fin"} al terminar. El servidor
+    # envía {"type": "parcial"|"final", "texto": ...} según llega la
+    # transcripción y, al cerrar, {"type": "resultado", ...} seguido del PDF en
+    # una trama binaria (o {"type": "error", ...}).
+    await websocket.accept()
+    if not realtime_available():
+        await websocket.send_json({"type": "error", "status_code": 501, "detalle": REALTIME_UNAVAILABLE_DETAIL})
+        await websocket.close(code=1011)
+        return
+    if not ASSEMBLYAI_API_KEY or not GEMINI_API_KEY:
+        await websocket.send_json({"type": "error", "status_code": 500, "detalle": "Una o más API Keys no están configuradas en el servidor."})
+        await websocket.close(code=1011)
+        return
+    if app.state.realtime_sessions >= REALTIME_MAX_SESSIONS:
+        await websocket.send_json({"type": "error", "status_code": 429, "detalle": "Demasiadas sesiones de dictado en tiempo real."})
+        await websocket.close(code=1013)
+        return
+
+    send_lock = asyncio.Lock()
+
+    async def send_json(payload: dict) -> None:
+        async with send_lock:
+            await websocket.send_json(payload)
+
+    async def on_update(kind: str, text: str) -> None:
+        await send_json({"type": kind, "texto": text})
+
+    async def on_stage(stage: str) -> None:
+        await send_json({"type": "estado", "etapa": stage})
+
+    app.state.realtime_sessions += 1
+    transcriber = RealtimeTranscriber(ASSEMBLYAI_API_KEY, sample_rate=sample_rate, on_update=on_update)
+    try:
+        await transcriber.connect()
+        await send_json({"type": "sesion_iniciada", "sample_rate": sample_rate})
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                print("El cliente cerró el dictado en tiempo real antes de terminar; se descarta la sesión.")
+                return
+            if message.get("bytes"):
+                await transcriber.send_audio(message["bytes"])
+            elif message.get("text") and json.loads(message["text"]).get("type") == "fin":
+                break
+
+        await on_stage("cerrando_transcripcion")
+        transcribed_text = await transcriber.finish()
+        transcript_id = transcriber.session_id or f"rt{int(transcriber.started)}"
+        print(f"Dictado en tiempo real {transcript_id}: {transcriber.audio_bytes} bytes de audio, {len(transcriber.final_turns)} turnos.")
+        result = await run_transcript_pipeline(transcript_id, transcribed_text, GEMINI_API_KEY, on_stage=on_stage,
+                                               stage_limits=app.state.admission.request_limits, records=app.state.record_store)
+        await send_json({"type": "resultado", "transcript_id": result["transcript_id"], "pdf_filename": result["pdf_filename"],
+                         "pdf_bytes": len(result["pdf_bytes"]), "texto": result["transcribed_text"],
+                         "server_timing": server_timing_header(result["timings"])})
+        async with send_lock:
+            await websocket.send_bytes(result["pdf_bytes"])
+        await websocket.close()
+    except WebSocketDisconnect:
+        print("El cliente se desconectó durante el dictado en tiempo real.")
+    except HTTPException as e:
+        await _send_realtime_error(websocket, send_lock, e.status_code, str(e.detail))
+    except Exception as e:
+        print(f"Error en el dictado en tiempo real: {type(e).__name__} - {e}")
+        import traceback; traceback.print_exc()
+        await _send_realtime_error(websocket, send_lock, 500, f"Ocurrió un error interno inesperado en el servidor: {str(e)}")
+    finally:
+        app.state.realtime_sessions -= 1
+        await transcriber.close()
+
+async def _send_realtime_error(websocket: WebSocket, send_lock: asyncio.Lock, status_code: int, detail: str) -> None:
+    try:
+        async with send_lock:
+            await websocket.send_json({"type": "error", "status_code": status_code, "detalle": detail})
+        await websocket.close(code=1011)
+    except Exception:
+        pass  # el cliente ya no está
+
+# --- Webhook de AssemblyAI ---
+@app.post("/webhooks/assemblyai")
+async def assemblyai_webhook_endpoint(request: Request):
+    if not ASSEMBLYAI_WEBHOOK_URL:
+        raise HTTPException(status_code=404, detail="El modo webhook no está activado.")
+    if ASSEMBLYAI_WEBHOOK_SECRET:
+        provided_secret = request.headers.get(ASSEMBLYAI_WEBHOOK_AUTH_HEADER, "")
+        if not hmac.compare_digest(provided_secret.encode("utf-8"), ASSEMBLYAI_WEBHOOK_SECRET.encode("utf-8")):
+            print("Webhook de AssemblyAI rechazado: secreto inválido.")
+            raise HTTPException(status_code=401, detail="Secreto de webhook inválido.")
+    try:
+        payload = await request.json()
+        transcript_id = str(payload["transcript_id"])
+        status = str(payload.get("status", ""))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cuerpo de webhook inválido.")
+
+    if app.state.poll_scheduler.notify_webhook(transcript_id, status):
+        WEBHOOKS_RECEIVED.inc(target="local")
+    else:
+        # Puede pertenecer a otro proceso de uvicorn: se deja en el buzón compartido.
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, app.state.webhook_inbox.record, transcript_id, status)
+        WEBHOOKS_RECEIVED.inc(target="buzon")
+    return {"received": True}
+
+@app.get("/cache/estadisticas")
+async def estadisticas_cache_endpoint():
+    if app.state.result_cache is None:
+        return {"enabled": False}
+    return dict(app.state.result_cache.snapshot(), enabled=True)
+
+@app.get("/admision/estado")
+async def estado_admision_endpoint():
+    # Profundidad de cola y peticiones en curso por etapa (para autoescalado)
+    return dict(app.state.admission.snapshot(), transcripciones_pendientes=app.state.poll_scheduler.pending_count())
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return Response(content=render_prometheus(), media_type=PROMETHEUS_CONTENT_TYPE)
 
 # Punto de entrada para ejecutar la aplicación directamente
 if __name__ == "__main__":
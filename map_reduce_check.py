@@ -0,0 +1,191 @@
+# E:\PROJECTS\voice_test\map_reduce_check.py
+#
+# Comprobación de la extracción map-reduce de punta a punta: llama a
+# analyze_text_with_gemini de gemini_service.py con un modelo Gemini simulado
+# en proceso (sin llamadas externas ni claves), que responde a cada prompt con
+# el JSON crudo del esquema completo (odontograma como lista, igual que
+# mock_gemini.py) según el texto del fragmento recibido. Cubre el umbral entre
+# una sola llamada y map-reduce, los prompts por fragmento, la normalización,
+# los tiempos, el streaming con on_section y su repetición tras combinar.
+# Termina con código 1 si alguna comprobación falla. Uso:
+#   python map_reduce_check.py
+
+import os
+
+# Umbral y fragmentos pequeños para no necesitar transcripciones enormes
+os.environ["GEMINI_EXTRACTION_MODE"] = "completo"
+os.environ["GEMINI_MAP_REDUCE_ENABLED"] = "true"
+os.environ["GEMINI_MAP_REDUCE_THRESHOLD_CHARS"] = "1500"
+os.environ["GEMINI_MAP_REDUCE_SEGMENT_CHARS"] = "600"
+os.environ["GEMINI_CONTEXT_CACHE_ENABLED"] = "false"
+os.environ["GEMINI_USE_ASYNC"] = "true"
+os.environ["GEMINI_HEDGE_AFTER_SECONDS"] = "0"
+os.environ.pop("GEMINI_API_ENDPOINT", None)
+
+import re
+import sys
+import json
+import asyncio
+from types import SimpleNamespace
+
+import gemini_service
+from extraction_schema import sections_from_extraction
+from map_reduce_extraction import split_transcript, GEMINI_MAP_REDUCE_THRESHOLD_CHARS, GEMINI_MAP_REDUCE_CONCURRENCY
+
+SENTENCES = [
+    "Paciente Carlos López, acude por dolor en la pieza dieciséis.",
+    "Caries mesial profunda en la dieciséis, se planifica endodoncia.",
+    "La cuarenta y ocho está retenida.",
+    "Antecedentes de hipertensión controlada.",
+    "En la dieciséis además se observa una fractura de la cúspide.",
+    "Se realiza profilaxis completa.",
+    "Indicaciones: ibuprofeno si hay dolor.",
+    "Próxima cita en dos semanas para la endodoncia.",
+]
+# Frase sin datos clínicos que separa el principio y el final del dictado largo
+FILLER = "Se revisa la oclusión y no hay cambios relevantes."
+_TRANSCRIPT_RE = re.compile(r"--- INICIO TEXTO TRANSCRITO ---\n(.*)\n--- FIN TEXTO TRANSCRITO ---", re.S)
+_SEGMENT_RE = re.compile(r"Fragmento (\d+) de (\d+)")
+
+def gemini_response(segment: str) -> dict:
+    # JSON crudo (sin normalizar) que daría Gemini para el texto recibido
+    odontogram = []
+    if "Caries" in segment:
+        odontogram.append({"pieza": "16", "diagnostico_hallazgo": "Caries mesial profunda",
+                           "plan_tratamiento_sugerido": "Endodoncia", "notas_adicionales": ""})
+    elif "fractura" in segment:
+        odontogram.append({"pieza": "16", "diagnostico_hallazgo": "Fractura de cúspide",
+                           "plan_tratamiento_sugerido": "Endodoncia", "notas_adicionales": ""})
+    if "cuarenta y ocho" in segment:
+        odontogram.append({"pieza": "48", "diagnostico_hallazgo": "Retenida", "plan_tratamiento_sugerido": "",
+                           "notas_adicionales": ""})
+    return {
+        "paciente_identificador_mencionado_opcional": "Carlos López" if "Carlos" in segment else "",
+        "queja_principal_detectada": "Dolor en la pieza 16" if "acude" in segment else "",
+        "antecedentes_medicos_relevantes_detectados": ["Hipertensión controlada"] if "hipertensión" in segment else [],
+        "odontograma_completo": odontogram,
+        "diagnosticos_sugeridos_ia": ["Pulpitis en 16"] if "dieciséis" in segment else [],
+        "procedimientos_realizados_sesion_detectados": (
+            [{"pieza_o_region_tratada": "Boca completa", "descripcion_procedimiento": "Profilaxis"}]
+            if "profilaxis" in segment else []),
+        "indicaciones_postoperatorias_detectadas": "Ibuprofeno si hay dolor" if "ibuprofeno" in segment else "",
+        "plan_proxima_cita_detectado": "Control en dos semanas" if "Próxima" in segment else "",
+        "observaciones_generales_dictadas": "",
+    }
+
+class StubResponse:
+    # Lo que lee gemini_service de una respuesta del SDK, también en streaming
+    def __init__(self, text: str, prompt: str):
+        self.text = text
+        self.parts = [SimpleNamespace(text=text)]
+        self.prompt_feedback = None
+        self.usage_metadata = SimpleNamespace(prompt_token_count=len(prompt) // 4, cached_content_token_count=0,
+                                              candidates_token_count=len(text) // 4)
+
+    async def __aiter__(self):
+        for i in range(0, len(self.text), 40):
+            await asyncio.sleep(0)
+            yield SimpleNamespace(text=self.text[i:i + 40])
+
+class StubGeminiModel:
+    def __init__(self):
+        self.prompts: list[str] = []
+        self.running = 0
+        self.max_running = 0
+        self.last_first = True  # los últimos fragmentos terminan antes
+
+    async def generate_content_async(self, prompt: str, stream: bool = False) -> StubResponse:
+        self.prompts.append(prompt)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            match = _SEGMENT_RE.search(prompt)
+            if match:
+                index, total = int(match.group(1)), int(match.group(2))
+                await asyncio.sleep(0.01 * ((total - index) if self.last_first else index))
+            text = json.dumps(gemini_response(_TRANSCRIPT_RE.search(prompt).group(1)), ensure_ascii=False)
+        finally:
+            self.running -= 1
+        return StubResponse(text, prompt)
+
+def without_date(data: dict) -> dict:
+    return {key: value for key, value in data.items() if key != "fecha_hora_dictado_aproximada"}
+
+async def main() -> list[str]:
+    failures = []
+
+    def check(condition: bool, message: str) -> None:
+        print(f"[{'ok' if condition else 'FALLO'}] {message}")
+        if not condition:
+            failures.append(message)
+
+    model = StubGeminiModel()
+
+    async def get_stub_model(api_key: str) -> StubGeminiModel:
+        return model
+
+    gemini_service.get_gemini_model = get_stub_model
+
+    # Transcripción corta: una sola llamada, sin fragmentos
+    short = " ".join(SENTENCES)
+    check(len(short) <= GEMINI_MAP_REDUCE_THRESHOLD_CHARS, f"la transcripción corta no supera el umbral ({len(short)})")
+    timings: dict = {}
+    single = await gemini_service.analyze_text_with_gemini(short, "corto", "clave", timings)
+    check(len(model.prompts) == 1 and "Fragmento" not in model.prompts[0], "por debajo del umbral se hace una sola llamada")
+    check(short in model.prompts[0], "el prompt lleva la transcripción completa")
+    check(set(single["odontograma_completo"]) == {"16", "48"}, "el odontograma en lista se normaliza a objeto por pieza")
+    check("gemini" in timings and "json_parse" in timings, "se registran los tiempos de Gemini y del parseo")
+
+    # La misma transcripción en streaming: secciones según llegan y el mismo resultado
+    sections = []
+
+    async def on_section(kind: str, payload: dict) -> None:
+        sections.append((kind, payload))
+
+    timings = {}
+    streamed = await gemini_service.analyze_text_with_gemini(short, "corto", "clave", timings, on_section=on_section)
+    check(without_date(streamed) == without_date(single), "el streaming devuelve el mismo diccionario")
+    check(sum(kind == "odontograma" for kind, _ in sections) == 2, "en streaming cada pieza llega como sección")
+    check("gemini_first_section" in timings, "se registra el tiempo hasta la primera sección")
+
+    # Transcripción larga: map-reduce con un prompt por fragmento. La caries se
+    # dicta al principio y la fractura al final, en fragmentos distintos.
+    transcript = " ".join([s for s in SENTENCES if "fractura" not in s] + [FILLER] * 25
+                          + [s for s in SENTENCES if "Caries" not in s])
+    segments = split_transcript(transcript)
+    check(len(transcript) > GEMINI_MAP_REDUCE_THRESHOLD_CHARS and len(segments) > 1,
+          f"la transcripción larga supera el umbral y se divide ({len(segments)} fragmentos)")
+    model.prompts.clear()
+    model.max_running = 0
+    sections.clear()
+    timings = {}
+    merged = await gemini_service.analyze_text_with_gemini(transcript, "largo", "clave", timings, on_section=on_section)
+    check(len(model.prompts) == len(segments), "se hace una llamada por fragmento")
+    check(sorted(_TRANSCRIPT_RE.search(p).group(1) for p in model.prompts) == sorted(segments),
+          "cada prompt lleva exactamente su fragmento")
+    check(sorted(_SEGMENT_RE.search(p).groups() for p in model.prompts) ==
+          sorted((str(i + 1), str(len(segments))) for i in range(len(segments))), "cada prompt indica 'Fragmento n de total'")
+    check(1 < model.max_running <= GEMINI_MAP_REDUCE_CONCURRENCY,
+          f"los fragmentos se extraen en paralelo con el límite de concurrencia ({model.max_running})")
+    check(set(merged["odontograma_completo"]) == {"16", "48"}, "el odontograma une las piezas de todos los fragmentos")
+    check(merged["odontograma_completo"]["16"]["diagnostico_hallazgo"] == "Caries mesial profunda; Fractura de cúspide",
+          "los hallazgos distintos de una pieza se combinan en orden")
+    check(merged["odontograma_completo"]["16"]["plan_tratamiento_sugerido"] == "Endodoncia",
+          "los valores repetidos de una pieza no se duplican")
+    check(merged["antecedentes_medicos_relevantes_detectados"] == ["Hipertensión controlada"], "las listas no tienen duplicados")
+    check(len(merged["procedimientos_realizados_sesion_detectados"]) == 1, "los procedimientos repetidos se eliminan")
+    check(merged["paciente_identificador_mencionado_opcional"] == "Carlos López", "el paciente es el primero mencionado")
+    check(merged["plan_proxima_cita_detectado"] == "Control en dos semanas", "la próxima cita es la última mencionada")
+    check(merged["texto_transcrito_original"] == transcript, "el texto original es la transcripción completa")
+    check("gemini" in timings and "json_parse" in timings, "se registran los tiempos del map-reduce")
+    check(sections == sections_from_extraction(merged), "on_section recibe las secciones del resultado combinado")
+
+    model.last_first = False
+    again = await gemini_service.analyze_text_with_gemini(transcript, "largo", "clave")
+    check(without_date(again) == without_date(merged), "la combinación es determinista (no depende del orden de llegada)")
+    return failures
+
+if __name__ == "__main__":
+    failures = asyncio.run(main())
+    print(f"\n{len(failures)} comprobaciones fallidas." if failures else "\nTodas las comprobaciones han pasado.")
+    sys.exit(1 if failures else 0)
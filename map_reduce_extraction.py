@@ -0,0 +1,137 @@
+# E:\PROJECTS\voice_test\map_reduce_extraction.py
+
+import os
+import re
+import json
+import asyncio
+from typing import Awaitable, Callable
+
+from metrics import Histogram
+
+# Extracción map-reduce para transcripciones muy largas: el texto se divide en
+# fragmentos por frases, cada fragmento se extrae con Gemini en paralelo y los
+# resultados (ya normalizados al diccionario completo) se combinan de forma
+# determinista, en el orden de los fragmentos.
+GEMINI_MAP_REDUCE_ENABLED = os.getenv("GEMINI_MAP_REDUCE_ENABLED", "true").lower() in ("1", "true", "yes")
+GEMINI_MAP_REDUCE_THRESHOLD_CHARS = int(os.getenv("GEMINI_MAP_REDUCE_THRESHOLD_CHARS", "12000"))
+GEMINI_MAP_REDUCE_SEGMENT_CHARS = int(os.getenv("GEMINI_MAP_REDUCE_SEGMENT_CHARS", "6000"))
+GEMINI_MAP_REDUCE_CONCURRENCY = int(os.getenv("GEMINI_MAP_REDUCE_CONCURRENCY", "4"))
+
+GEMINI_MAP_REDUCE_SEGMENTS = Histogram("gemini_map_reduce_segments", "Fragmentos por transcripción extraída en map-reduce.",
+                                       buckets=(2, 3, 4, 6, 8, 12, 16))
+
+# Campos de texto: cómo resolver valores distintos entre fragmentos.
+# "primero": el primero no vacío (se dicta al principio: paciente, motivo).
+# "ultimo": el último no vacío (se dicta al final de la sesión: indicaciones, próxima cita).
+# "concatenar": todos los valores distintos, en orden.
+_SCALAR_MERGE = {
+    "paciente_identificador_mencionado_opcional": "primero",
+    "fecha_hora_dictado_aproximada": "primero",
+    "texto_transcrito_original": "primero",
+    "queja_principal_detectada": "primero",
+    "historia_enfermedad_actual_detectada": "concatenar",
+    "hallazgos_examen_extraoral_detectados": "concatenar",
+    "hallazgos_examen_intraoral_general_detectados": "concatenar",
+    "indicaciones_postoperatorias_detectadas": "ultimo",
+    "medicacion_recetada_detectada": "concatenar",
+    "plan_proxima_cita_detectado": "ultimo",
+    "observaciones_generales_dictadas": "concatenar",
+}
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+")
+
+def should_map_reduce(transcribed_text: str) -> bool:
+    return GEMINI_MAP_REDUCE_ENABLED and len(transcribed_text) > GEMINI_MAP_REDUCE_THRESHOLD_CHARS
+
+def split_transcript(transcribed_text: str, segment_chars: int = GEMINI_MAP_REDUCE_SEGMENT_CHARS) -> list[str]:
+    # Agrupa frases completas hasta segment_chars por fragmento. Una frase más
+    # larga que el límite (transcripción sin puntuación) se corta por palabras.
+    sentences = []
+    for sentence in _SENTENCE_END_RE.split(transcribed_text.strip()):
+        while len(sentence) > segment_chars:
+            cut = sentence.rfind(" ", 0, segment_chars)
+            cut = cut if cut > 0 else segment_chars
+            sentences.append(sentence[:cut])
+            sentence = sentence[cut:].lstrip()
+        if sentence:
+            sentences.append(sentence)
+
+    segments, current = [], ""
+    for sentence in sentences:
+        if current and len(current) + 1 + len(sentence) > segment_chars:
+            segments.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        segments.append(current)
+    return segments
+
+def _dedupe_key(value) -> str:
+    if isinstance(value, str):
+        return " ".join(value.casefold().split())
+    return json.dumps(value, sort_keys=True, ensure_ascii=False)
+
+def _distinct(values: list) -> list:
+    seen, result = set(), []
+    for value in values:
+        key = _dedupe_key(value)
+        if key and key not in seen:
+            seen.add(key)
+            result.append(value)
+    return result
+
+def merge_extractions(parts: list[dict]) -> dict:
+    # Combina los diccionarios de cada fragmento (en orden) en uno solo con la
+    # misma forma: odontograma unido por pieza (los valores distintos de una
+    # misma pieza se juntan con "; "), listas concatenadas sin duplicados y
+    # campos de texto según _SCALAR_MERGE (por defecto, concatenar).
+    merged: dict = {}
+    keys = list(dict.fromkeys(key for part in parts for key in part))
+    for key in keys:
+        values = [part[key] for part in parts if key in part]
+        if key == "odontograma_completo":
+            odontogram: dict = {}
+            for value in values:
+                for tooth, entry in (value or {}).items():
+                    if not isinstance(entry, dict):
+                        continue
+                    target = odontogram.setdefault(str(tooth), {})
+                    for field, text in entry.items():
+                        target.setdefault(field, []).append(text)
+            merged[key] = {tooth: {field: "; ".join(_distinct([t for t in texts if t])) for field, texts in entry.items()}
+                           for tooth, entry in odontogram.items()}
+        elif all(isinstance(value, list) for value in values):
+            merged[key] = _distinct([item for value in values for item in value])
+        else:
+            non_empty = [value for value in values if value not in ("", None)]
+            strategy = _SCALAR_MERGE.get(key, "concatenar")
+            if not non_empty:
+                merged[key] = values[0] if values else ""
+            elif strategy == "primero":
+                merged[key] = non_empty[0]
+            elif strategy == "ultimo":
+                merged[key] = non_empty[-1]
+            else:
+                merged[key] = " ".join(str(value) for value in _distinct(non_empty))
+    return merged
+
+async def run_map_reduce(segments: list[str], extract_segment: Callable[[str, int, int], Awaitable[dict]],
+                         concurrency: int = GEMINI_MAP_REDUCE_CONCURRENCY) -> dict:
+    # extract_segment(texto, índice, total) devuelve el diccionario normalizado
+    # de un fragmento. Si uno falla se cancelan los demás.
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def extract(index: int, segment: str) -> dict:
+        async with semaphore:
+            return await extract_segment(segment, index, len(segments))
+
+    tasks = [asyncio.create_task(extract(i, segment)) for i, segment in enumerate(segments)]
+    try:
+        parts = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    GEMINI_MAP_REDUCE_SEGMENTS.observe(len(segments))
+    return merge_extractions(list(parts))
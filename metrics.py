@@ -0,0 +1,218 @@
+# E:\PROJECTS\voice_test\metrics.py
+
+import time
+import threading
+import contextlib
+
+# Registro mínimo de métricas en formato de exposición de Prometheus (texto).
+# Las métricas son por proceso: con varios workers de uvicorn cada uno expone
+# las suyas y Prometheus las agrega por instancia.
+
+_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def _format_labels(labelnames: tuple, labelvalues: tuple, extra: dict | None = None) -> str:
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.extend(extra.items())
+    if not pairs:
+        return ""
+    escaped = []
+    for k, v in pairs:
+        v = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append(f'{k}="{v}"')
+    return "{" + ",".join(escaped) + "}"
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class _Metric:
+    metric_type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+
+class Counter(_Metric):
+    metric_type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+class Gauge(_Metric):
+    metric_type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    @contextlib.contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+class Histogram(_Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = _DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._counts: dict[tuple, list[int]] = {}
+        self._sums: dict[tuple, float] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._sums[key] = self._sums.get(key, 0.0) + value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        with self._lock:
+            for key in sorted(self._counts):
+                counts = self._counts[key]
+                for bound, count in zip(self.buckets, counts):
+                    labels = _format_labels(self.labelnames, key, {"le": _format_value(bound)})
+                    lines.append(f"{self.name}_bucket{labels} {count}")
+                plain = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{plain} {_format_value(self._sums[key])}")
+                lines.append(f"{self.name}_count{plain} {counts[-1]}")
+        return lines
+
+REGISTRY: list[_Metric] = []
+
+def render_prometheus() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# --- Métricas del flujo de dictado ---
+STAGE_SECONDS = Histogram(
+    "dictado_stage_seconds", "Duración de cada etapa del flujo de dictado a PDF.", ("stage",),
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300, 600),
+)
+ASSEMBLYAI_POLLS = Histogram(
+    "assemblyai_polls_per_transcript", "Número de consultas de estado por transcripción.",
+    buckets=(1, 2, 3, 5, 8, 12, 20, 40, 80),
+)
+PDF_RESPONSE_BYTES = Histogram(
+    "dictado_pdf_bytes", "Tamaño del PDF devuelto.",
+    buckets=(10_000, 25_000, 50_000, 100_000, 250_000, 500_000, 1_000_000, 5_000_000),
+)
+PIPELINE_RESULTS = Counter(
+    "dictado_pipeline_total", "Ejecuciones del flujo por resultado (ok, cache_hit, error) y etapa en la que terminó.",
+    ("outcome", "stage"),
+)
+
+# Orden y nombres cortos para la cabecera Server-Timing
+_SERVER_TIMING_NAMES = {
+    "cache_lookup": "cache",
+    "record_lookup": "record-get",
+    "preprocess": "preproc",
+    "segment_split": "split",
+    "upload": "upload",
+    "transcript_request": "tx-req",
+    "assemblyai_queued": "aai-queued",
+    "assemblyai_processing": "aai-proc",
+    "transcription_segments": "aai-segments",
+    "local_extraction": "local",
+    "gemini_first_section": "gemini-first",
+    "gemini": "gemini",
+    "json_parse": "json",
+    "pdf_render": "pdf",
+    "record_save": "record",
+    "total": "total",
+}
+
+@contextlib.contextmanager
+def stage_timer(timings: dict, stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + (time.perf_counter() - started)
+
+def record_pipeline_timings(timings: dict) -> None:
+    for stage, seconds in timings.items():
+        if stage in _SERVER_TIMING_NAMES:
+            STAGE_SECONDS.observe(seconds, stage=stage)
+    if "poll_count" in timings:
+        ASSEMBLYAI_POLLS.observe(timings["poll_count"])
+    if "pdf_bytes" in timings:
+        PDF_RESPONSE_BYTES.observe(timings["pdf_bytes"])
+
+def server_timing_header(timings: dict) -> str:
+    parts = []
+    for stage, short_name in _SERVER_TIMING_NAMES.items():
+        if stage in timings:
+            parts.append(f"{short_name};dur={timings[stage] * 1000:.1f}")
+    if "poll_count" in timings:
+        parts.append(f'polls;desc="{timings["poll_count"]}"')
+    return ", ".join(parts)
\ No newline at end of file
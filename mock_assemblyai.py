@@ -0,0 +1,127 @@
+# E:\PROJECTS\voice_test\mock_assemblyai.py
+#
+# Servidor simulado de AssemblyAI para probar el flujo de punta a punta sin
+# gastar créditos (sondeo, webhooks y streaming en tiempo real). Uso:
+#   uvicorn mock_assemblyai:app --port 8001
+#   ASSEMBLYAI_BASE_URL=http://localhost:8001/v2 \
+#   ASSEMBLYAI_STREAMING_URL=ws://localhost:8001/v3/ws uvicorn main:app
+# Los fallos se inyectan con MOCK_FAILURE_RATE, MOCK_OUTAGE, etc. o con PUT /mock/fallos
+# (ver mock_faults.py).
+
+import os
+import re
+import json
+import uuid
+import asyncio
+import httpx
+from fastapi import FastAPI, Request, HTTPException, WebSocket, WebSocketDisconnect
+
+from mock_faults import install_fault_injection
+
+MOCK_QUEUE_SECONDS = float(os.getenv("MOCK_QUEUE_SECONDS", "1"))
+MOCK_PROCESSING_SECONDS = float(os.getenv("MOCK_PROCESSING_SECONDS", "2"))
+MOCK_STREAMING_SECONDS_PER_TURN = float(os.getenv("MOCK_STREAMING_SECONDS_PER_TURN", "2"))
+MOCK_TRANSCRIPT_TEXT = os.getenv(
+    "MOCK_TRANSCRIPT_TEXT",
+    "Paciente Carlos López. Acude por dolor en la pieza dieciséis al masticar. "
+    "Caries mesial profunda en la dieciséis, se planifica endodoncia y corona. "
+    "La cuarenta y ocho está retenida, se indica exodoncia profiláctica. "
+    "Se realiza profilaxis completa. Control en dos semanas.",
+)
+
+app = FastAPI(title="AssemblyAI simulado")
+faults = install_fault_injection(app, "/v2/")
+_uploads: dict[str, int] = {}
+_transcripts: dict[str, dict] = {}
+
+@app.post("/v2/upload")
+async def mock_upload(request: Request):
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+    upload_id = uuid.uuid4().hex
+    _uploads[upload_id] = size
+    print(f"[mock] Subida {upload_id}: {size} bytes")
+    return {"upload_url": f"https://mock.assemblyai.local/uploads/{upload_id}"}
+
+@app.post("/v2/transcript")
+async def mock_request_transcript(request: Request):
+    data = await request.json()
+    if not data.get("audio_url"):
+        raise HTTPException(status_code=400, detail="audio_url es obligatorio")
+    transcript_id = uuid.uuid4().hex
+    _transcripts[transcript_id] = {"id": transcript_id, "status": "queued", "audio_url": data["audio_url"], "text": None,
+                                   "audio_duration": None}
+    asyncio.create_task(_simulate_transcription(transcript_id, data))
+    return _transcripts[transcript_id]
+
+@app.get("/v2/transcript/{transcript_id}")
+async def mock_get_transcript(transcript_id: str):
+    transcript = _transcripts.get(transcript_id)
+    if transcript is None:
+        raise HTTPException(status_code=404, detail="Transcript not found")
+    return transcript
+
+@app.websocket("/v3/ws")
+async def mock_streaming(websocket: WebSocket, sample_rate: int = 16000):
+    # Streaming v3 simulado: una frase del texto de ejemplo por cada
+    # MOCK_STREAMING_SECONDS_PER_TURN segundos de audio recibido (PCM 16 bits mono).
+    if not websocket.headers.get("authorization"):
+        await websocket.close(code=4001)
+        return
+    await websocket.accept()
+    session_id = uuid.uuid4().hex
+    sentences = [s for s in re.split(r"(?<=\.)\s+", MOCK_TRANSCRIPT_TEXT) if s]
+    bytes_per_turn = int(sample_rate * 2 * MOCK_STREAMING_SECONDS_PER_TURN)
+    received = 0
+    turn_order = 0
+    await websocket.send_json({"type": "Begin", "id": session_id})
+
+    async def emit_turn(sentence: str) -> None:
+        nonlocal turn_order
+        words = sentence.split()
+        partial = " ".join(words[:max(1, len(words) // 2)]).lower().strip(".,")
+        await websocket.send_json({"type": "Turn", "turn_order": turn_order, "transcript": partial, "end_of_turn": False,
+                                   "turn_is_formatted": False})
+        await websocket.send_json({"type": "Turn", "turn_order": turn_order, "transcript": sentence, "end_of_turn": True,
+                                   "turn_is_formatted": True})
+        turn_order += 1
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            if message.get("bytes"):
+                received += len(message["bytes"])
+                while sentences and received >= bytes_per_turn * (turn_order + 1):
+                    await emit_turn(sentences.pop(0))
+            elif message.get("text") and json.loads(message["text"]).get("type") == "Terminate":
+                for sentence in sentences:
+                    await emit_turn(sentence)
+                await websocket.send_json({"type": "Termination", "audio_duration_seconds": received / (sample_rate * 2)})
+                await websocket.close()
+                print(f"[mock] Sesión de streaming {session_id} cerrada: {received} bytes de audio, {turn_order} turnos")
+                return
+    except WebSocketDisconnect:
+        pass
+
+async def _simulate_transcription(transcript_id: str, data: dict) -> None:
+    await asyncio.sleep(MOCK_QUEUE_SECONDS)
+    _transcripts[transcript_id]["status"] = "processing"
+    await asyncio.sleep(MOCK_PROCESSING_SECONDS)
+    _transcripts[transcript_id].update({"status": "completed", "text": MOCK_TRANSCRIPT_TEXT,
+                                        "audio_duration": len(MOCK_TRANSCRIPT_TEXT.split()) / 2.5})
+    print(f"[mock] Transcripción {transcript_id} completada")
+
+    webhook_url = data.get("webhook_url")
+    if webhook_url:
+        headers = {}
+        if data.get("webhook_auth_header_name"):
+            headers[data["webhook_auth_header_name"]] = data.get("webhook_auth_header_value", "")
+        try:
+            async with httpx.AsyncClient(timeout=10.0) as client:
+                response = await client.post(webhook_url, json={"transcript_id": transcript_id, "status": "completed"}, headers=headers)
+            print(f"[mock] Webhook enviado a {webhook_url}: {response.status_code}")
+        except Exception as e:
+            print(f"[mock] No se pudo enviar el webhook a {webhook_url}: {e}")
\ No newline at end of file
@@ -0,0 +1,66 @@
+# E:\PROJECTS\voice_test\mock_faults.py
+#
+# Inyección de fallos para los servicios simulados (mock_assemblyai, mock_gemini):
+# permite comprobar reintentos, circuit breakers y peticiones hedged en local.
+
+import os
+import random
+import asyncio
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+class FaultInjector:
+    # failure_rate: fracción de peticiones que fallan con failure_status.
+    # latency_seconds / slow_rate: retardo añadido a una fracción de peticiones (colas largas).
+    # outage: todas las peticiones fallan (simula una caída).
+
+    def __init__(self):
+        self.failure_rate = float(os.getenv("MOCK_FAILURE_RATE", "0"))
+        self.failure_status = int(os.getenv("MOCK_FAILURE_STATUS", "503"))
+        self.latency_seconds = float(os.getenv("MOCK_EXTRA_LATENCY", "0"))
+        self.slow_rate = float(os.getenv("MOCK_SLOW_RATE", "1"))
+        self.outage = os.getenv("MOCK_OUTAGE", "false").lower() in ("1", "true", "yes")
+        self.injected_failures = 0
+
+    def snapshot(self) -> dict:
+        return {"failure_rate": self.failure_rate, "failure_status": self.failure_status,
+                "latency_seconds": self.latency_seconds, "slow_rate": self.slow_rate, "outage": self.outage,
+                "injected_failures": self.injected_failures}
+
+    def update(self, changes: dict) -> None:
+        for field in ("failure_rate", "latency_seconds", "slow_rate"):
+            if field in changes:
+                setattr(self, field, float(changes[field]))
+        if "failure_status" in changes:
+            self.failure_status = int(changes["failure_status"])
+        if "outage" in changes:
+            self.outage = bool(changes["outage"])
+
+def install_fault_injection(app: FastAPI, path_prefix: str) -> FaultInjector:
+    # Añade el middleware de fallos para las rutas bajo path_prefix y los
+    # endpoints GET/PUT /mock/fallos para cambiar la configuración en caliente.
+    faults = FaultInjector()
+
+    @app.middleware("http")
+    async def inject_faults(request: Request, call_next):
+        if request.url.path.startswith(path_prefix):
+            if faults.latency_seconds > 0 and random.random() < faults.slow_rate:
+                await asyncio.sleep(faults.latency_seconds)
+            if faults.outage or random.random() < faults.failure_rate:
+                faults.injected_failures += 1
+                print(f"[mock] Fallo inyectado {faults.failure_status} en {request.method} {request.url.path}")
+                headers = {"Retry-After": "1"} if faults.failure_status == 429 else None
+                return JSONResponse(status_code=faults.failure_status, content={"error": "Fallo inyectado por el servidor simulado"},
+                                    headers=headers)
+        return await call_next(request)
+
+    @app.get("/mock/fallos")
+    async def get_faults():
+        return faults.snapshot()
+
+    @app.put("/mock/fallos")
+    async def put_faults(request: Request):
+        faults.update(await request.json())
+        return faults.snapshot()
+
+    return faults
@@ -0,0 +1,97 @@
+# E:\PROJECTS\voice_test\mock_gemini.py
+#
+# Servidor simulado de la API REST de Gemini (generateContent) para probar el
+# flujo y la capa de resiliencia sin gastar cuota. Uso:
+#   uvicorn mock_gemini:app --port 8002
+#   GEMINI_API_ENDPOINT=http://localhost:8002 uvicorn main:app
+# Los fallos se inyectan igual que en mock_assemblyai (ver mock_faults.py).
+
+import os
+import json
+import asyncio
+from datetime import datetime
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import StreamingResponse
+
+from mock_faults import install_fault_injection
+
+MOCK_GEMINI_RESPONSE = os.getenv("MOCK_GEMINI_RESPONSE")
+# Caracteres por fragmento y pausa entre fragmentos en streamGenerateContent
+MOCK_GEMINI_STREAM_CHUNK_CHARS = int(os.getenv("MOCK_GEMINI_STREAM_CHUNK_CHARS", "40"))
+MOCK_GEMINI_STREAM_DELAY = float(os.getenv("MOCK_GEMINI_STREAM_DELAY", "0.05"))
+
+app = FastAPI(title="Gemini simulado")
+faults = install_fault_injection(app, "/v1beta/")
+
+def _default_response() -> dict:
+    return {
+        "paciente_identificador_mencionado_opcional": "Carlos López",
+        "fecha_hora_dictado_aproximada": datetime.utcnow().isoformat() + "Z",
+        "texto_transcrito_original": "",
+        "queja_principal_detectada": "Dolor en la pieza 16 al masticar",
+        "historia_enfermedad_actual_detectada": "",
+        "antecedentes_medicos_relevantes_detectados": [],
+        "hallazgos_examen_extraoral_detectados": "",
+        "hallazgos_examen_intraoral_general_detectados": "",
+        "odontograma_completo": [
+            {"pieza": "16", "diagnostico_hallazgo": "Caries mesial profunda", "plan_tratamiento_sugerido": "Endodoncia y corona",
+             "notas_adicionales": ""},
+            {"pieza": "48", "diagnostico_hallazgo": "Retenida", "plan_tratamiento_sugerido": "Exodoncia profiláctica",
+             "notas_adicionales": ""},
+        ],
+        "diagnosticos_sugeridos_ia": ["Pulpitis en 16"],
+        "procedimientos_realizados_sesion_detectados": [
+            {"pieza_o_region_tratada": "Boca completa", "descripcion_procedimiento": "Profilaxis", "anestesia_mencionada": "",
+             "materiales_mencionados": "", "complicaciones_mencionadas": ""},
+        ],
+        "indicaciones_postoperatorias_detectadas": "",
+        "medicacion_recetada_detectada": "",
+        "plan_proxima_cita_detectado": "Control en dos semanas",
+        "observaciones_generales_dictadas": "",
+    }
+
+def _compact_response() -> dict:
+    # Salida del modo compacto: claves cortas, sin transcripción ni campos vacíos
+    return {
+        "p": "Carlos López",
+        "q": "Dolor en la pieza 16 al masticar",
+        "o": [
+            {"n": "16", "d": "Caries mesial profunda", "t": "Endodoncia y corona"},
+            {"n": "48", "d": "Retenida", "t": "Exodoncia profiláctica"},
+        ],
+        "dx": ["Pulpitis en 16"],
+        "pr": [{"r": "Boca completa", "d": "Profilaxis"}],
+        "pc": "Control en dos semanas",
+    }
+
+@app.post("/v1beta/models/{model_action}")
+async def mock_generate_content(model_action: str, request: Request):
+    model, _, action = model_action.partition(":")
+    if action not in ("generateContent", "streamGenerateContent"):
+        raise HTTPException(status_code=404, detail=f"Acción no soportada: {action}")
+    body = await request.json()
+    contents = body.get("contents", []) + ([body["systemInstruction"]] if body.get("systemInstruction") else [])
+    prompt_chars = sum(len(part.get("text", "")) for content in contents for part in content.get("parts", []))
+    schema_keys = body.get("generationConfig", {}).get("responseSchema", {}).get("properties", {})
+    response = _compact_response() if "q" in schema_keys else _default_response()
+    text = MOCK_GEMINI_RESPONSE or json.dumps(response, ensure_ascii=False)
+    print(f"[mock] {action} {model}: {prompt_chars} caracteres de prompt")
+    usage = {"promptTokenCount": prompt_chars // 4, "candidatesTokenCount": len(text) // 4,
+             "totalTokenCount": (prompt_chars + len(text)) // 4}
+    if action == "streamGenerateContent":
+        return StreamingResponse(_stream_chunks(text, usage), media_type="text/event-stream")
+    return {
+        "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP", "index": 0}],
+        "usageMetadata": usage,
+    }
+
+async def _stream_chunks(text: str, usage: dict):
+    # Formato de streamGenerateContent?alt=sse: un GenerateContentResponse por evento
+    pieces = [text[i:i + MOCK_GEMINI_STREAM_CHUNK_CHARS] for i in range(0, len(text), MOCK_GEMINI_STREAM_CHUNK_CHARS)]
+    for i, piece in enumerate(pieces):
+        chunk = {"candidates": [{"content": {"parts": [{"text": piece}], "role": "model"}, "index": 0}]}
+        if i == len(pieces) - 1:
+            chunk["candidates"][0]["finishReason"] = "STOP"
+            chunk["usageMetadata"] = usage
+        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\r\n\r\n"
+        await asyncio.sleep(MOCK_GEMINI_STREAM_DELAY)
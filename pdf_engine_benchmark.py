@@ -0,0 +1,91 @@
+# E:\PROJECTS\voice_test\pdf_engine_benchmark.py
+#
+# Rendimiento del motor de PDF en procesos (pdf_render_engine.py) frente al
+# executor de hilos: PDF por segundo y latencia p50/p95 con la misma carga, y
+# tamaño del diccionario que viaja a los procesos (pickle frente al formato
+# compacto). Conviene ejecutarlo en la máquina de producción. Uso:
+#   python pdf_engine_benchmark.py [--pdfs 200] [--procesos 8] [--hilos 4]
+
+import os
+import io
+import time
+import pickle
+import random
+import asyncio
+import argparse
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+from pdf_generator import create_pdf_from_json
+from pdf_render_engine import PdfRenderEngine, encode_payload
+from local_extraction_benchmark import synthetic_dictation
+
+def sample_extraction(rng: random.Random) -> dict:
+    # Un diccionario con la forma del de Gemini y una transcripción de ~15 dictados
+    text = " ".join(synthetic_dictation(rng)[0] for _ in range(15))
+    teeth = rng.sample([11, 14, 16, 21, 26, 36, 37, 46, 47, 48], 5)
+    return {
+        "paciente_identificador_mencionado_opcional": "Paciente de prueba",
+        "queja_principal_detectada": "Dolor al masticar en la zona inferior izquierda desde hace una semana.",
+        "antecedentes_medicos_relevantes_mencionados": ["Hipertensión controlada", "Alergia a la penicilina"],
+        "odontograma_completo": {str(t): {"diagnostico_hallazgo": "Caries mesial profunda", "plan_tratamiento_sugerido": "Endodoncia",
+                                          "notas_adicionales": "Sensibilidad al frío"} for t in teeth},
+        "texto_transcrito_original": text,
+    }
+
+def _percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def _run(render, corpus: list[dict], concurrency: int) -> tuple[float, list[float]]:
+    # Mantiene "concurrency" PDF en curso, como haría el control de admisión
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(data: dict) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            await render(data)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(data) for data in corpus))
+    return time.perf_counter() - started, latencies
+
+async def run_benchmark(pdf_count: int, processes: int, threads: int, seed: int) -> None:
+    rng = random.Random(seed)
+    corpus = [sample_extraction(rng) for _ in range(pdf_count)]
+    pickled = sum(len(pickle.dumps(data)) for data in corpus) / pdf_count
+    compact = sum(len(encode_payload(data)) for data in corpus) / pdf_count
+    print(f"{pdf_count} PDF, {os.cpu_count()} núcleos. Diccionario por PDF: pickle {pickled:.0f} B, compacto {compact:.0f} B "
+          f"({pickled / compact:.1f}x menos)")
+
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="pdf")
+    with contextlib.redirect_stdout(io.StringIO()):
+        create_pdf_from_json(corpus[0])  # fuentes ya cargadas, como en el servidor
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        results[f"hilos ({threads})"] = await _run(lambda data: loop.run_in_executor(executor, create_pdf_from_json, data),
+                                                   corpus, threads)
+    executor.shutdown()
+
+    engine = PdfRenderEngine(workers=processes, max_pending=4 * processes)
+    with contextlib.redirect_stdout(io.StringIO()):
+        await engine.start()
+        results[f"procesos ({processes})"] = await _run(engine.render, corpus, engine.max_pending)
+    engine.shutdown()
+
+    print(f"{'Motor':<16}{'PDF/s':>8}{'p50 (ms)':>10}{'p95 (ms)':>10}")
+    for name, (elapsed, latencies) in results.items():
+        print(f"{name:<16}{pdf_count / elapsed:>8.1f}{_percentile(latencies, 0.5) * 1000:>10.0f}"
+              f"{_percentile(latencies, 0.95) * 1000:>10.0f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rendimiento del motor de PDF en procesos frente a hilos.")
+    parser.add_argument("--pdfs", type=int, default=200, help="PDF a generar con cada motor (200).")
+    parser.add_argument("--procesos", type=int, default=os.cpu_count() or 1, help="Procesos del motor (número de núcleos).")
+    parser.add_argument("--hilos", type=int, default=4, help="Hilos del executor de comparación (4).")
+    parser.add_argument("--semilla", type=int, default=7, help="Semilla del corpus (7).")
+    args = parser.parse_args()
+    asyncio.run(run_benchmark(args.pdfs, args.procesos, args.hilos, args.semilla))
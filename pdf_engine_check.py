@@ -0,0 +1,78 @@
+# E:\PROJECTS\voice_test\pdf_engine_check.py
+#
+# Comprobación del motor de PDF en procesos (pdf_render_engine.py) ante PDF
+# lentos y procesos caídos: el tiempo límite solo cuenta desde que un PDF
+# empieza a renderizarse, un reinicio por tiempo agotado no cancela los PDF
+# que esperan en cola y un proceso caído se reintenta en un pool nuevo. Tarda
+# unos segundos (arranca procesos reales). Termina con código 1 si alguna
+# comprobación falla. Uso:
+#   python pdf_engine_check.py
+
+import os
+import sys
+import signal
+import random
+import asyncio
+
+from fastapi import HTTPException
+
+from pdf_render_engine import PdfRenderEngine, PDF_ENGINE_RESTARTS
+from pdf_generator_benchmark import synthetic_record, _TYPICAL
+
+def record(words: int) -> dict:
+    return synthetic_record(random.Random(f"motor-{words}"), **dict(_TYPICAL, palabras=words))
+
+async def outcome(awaitable) -> str:
+    try:
+        await awaitable
+        return "ok"
+    except HTTPException as e:
+        return str(e.status_code)
+    except asyncio.CancelledError:
+        return "CancelledError"
+
+async def run_checks() -> list[str]:
+    failures = []
+
+    def check(condition: bool, message: str) -> None:
+        print(f"[{'ok' if condition else 'FALLO'}] {message}")
+        if not condition:
+            failures.append(message)
+
+    small, large = record(300), record(60000)
+
+    # Un PDF que supera el límite y cinco pequeños en cola detrás de él
+    engine = PdfRenderEngine(workers=1, max_pending=10, timeout_seconds=1.5, recycle_after=0)
+    await engine.start()
+    restarts_before = PDF_ENGINE_RESTARTS.value(reason="tiempo_agotado")
+    first = asyncio.create_task(outcome(engine.render(large)))
+    await asyncio.sleep(0.1)
+    queued = [asyncio.create_task(outcome(engine.render(small))) for _ in range(5)]
+    results = [await first] + list(await asyncio.gather(*queued))
+    check(results == ["504"] + ["ok"] * 5, f"solo el PDF lento agota el tiempo; los de la cola terminan ({results})")
+    check(PDF_ENGINE_RESTARTS.value(reason="tiempo_agotado") - restarts_before == 1,
+          "un único reinicio del pool por el PDF lento")
+
+    # Un proceso que muere con un PDF en curso: se reintenta en un pool nuevo
+    render = asyncio.create_task(outcome(engine.render(record(3000))))
+    await asyncio.sleep(0.15)
+    for process in list((engine._executor._processes or {}).values()):
+        os.kill(process.pid, signal.SIGKILL)
+    result = await render
+    check(result == "ok", f"un PDF cuyo proceso muere se reintenta y termina ({result})")
+
+    # Cancelar a un llamante no afecta a los demás
+    cancelled = asyncio.create_task(engine.render(small))
+    others = [asyncio.create_task(outcome(engine.render(small))) for _ in range(3)]
+    await asyncio.sleep(0.05)
+    cancelled.cancel()
+    results = list(await asyncio.gather(*others))
+    check(cancelled.cancelled() and results == ["ok"] * 3, f"cancelar un PDF no cancela los demás ({results})")
+    check(engine.pending == 0, "no quedan PDF pendientes")
+    engine.shutdown()
+    return failures
+
+if __name__ == "__main__":
+    failures = asyncio.run(run_checks())
+    print(f"\n{len(failures)} comprobaciones fallidas." if failures else "\nTodas las comprobaciones han pasado.")
+    sys.exit(1 if failures else 0)
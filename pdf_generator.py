@@ -1,8 +1,78 @@
 # E:\PROJECTS\voice_test\pdf_generator.py
 
 import os
-from fpdf import FPDF
 import io
+import copy
+import threading
+import functools
+from collections import defaultdict
+import fpdf
+from fpdf import FPDF
+from fpdf.fonts import TTFFont, SubsetMap
+from fontTools import ttLib
+
+def fdi_sort_key(pieza_str):
+    try:
+        num_str = str(pieza_str).split('.')[0] 
+        num = int(num_str)
+        cuadrante = num // 10
+        diente = num % 10
+        cuadrante_orden = {1:1, 2:2, 4:3, 3:4} 
+        return (cuadrante_orden.get(cuadrante, 9), diente if cuadrante in [1,4] else -diente)
+    except ValueError: return (99, pieza_str)
+
+# Gráfico FDI de las 32 piezas permanentes, como en la boca vista de frente:
+# arcada superior 18-11 | 21-28 y arcada inferior 48-41 | 31-38 (medidas en mm)
+CHART_ROWS = ([18, 17, 16, 15, 14, 13, 12, 11, 21, 22, 23, 24, 25, 26, 27, 28],
+              [48, 47, 46, 45, 44, 43, 42, 41, 31, 32, 33, 34, 35, 36, 37, 38])
+CHART_TOOTH_W = 11
+CHART_TOOTH_H = 8
+CHART_LABEL_H = 3.5
+CHART_ARCH_GAP = 2
+CHART_LEGEND_H = 5
+CHART_HEIGHT = 2 * (CHART_LABEL_H + CHART_TOOTH_H) + CHART_ARCH_GAP + CHART_LEGEND_H
+CHART_FILL_FINDING = (244, 187, 187)
+CHART_FILL_PLAN = (255, 224, 160)
+
+def _chart_tooth_box(row: int, col: int) -> tuple[float, float]:
+    # Esquina superior izquierda de la pieza, relativa a la del gráfico
+    y = CHART_LABEL_H if row == 0 else CHART_LABEL_H + CHART_TOOTH_H + CHART_ARCH_GAP
+    return col * CHART_TOOTH_W, y
+
+CHART_POSITIONS = {str(tooth): _chart_tooth_box(row, col) for row, teeth in enumerate(CHART_ROWS) for col, tooth in enumerate(teeth)}
+# Posición de cada número (encima de la arcada superior, debajo de la inferior)
+# y de cada muestra de la leyenda, relativas a la esquina del gráfico
+CHART_LABELS = tuple((tooth, x + CHART_TOOTH_W / 2 - 1.6, y - 0.8 if y == CHART_LABEL_H else y + CHART_TOOTH_H + CHART_LABEL_H - 0.5)
+                     for tooth, (x, y) in CHART_POSITIONS.items())
+CHART_LEGEND = tuple((i * 35, CHART_HEIGHT - CHART_LEGEND_H + 1.5, color, text)
+                     for i, (color, text) in enumerate(((CHART_FILL_FINDING, "Con hallazgo"), (CHART_FILL_PLAN, "Solo plan o notas"))))
+
+@functools.lru_cache(maxsize=4)
+def chart_skeleton_ops(k: float) -> str:
+    # Esqueleto vectorial del gráfico (contorno de cada pieza con sus cinco
+    # superficies y la línea media) como operadores de contenido PDF, en puntos
+    # y relativos a la esquina superior izquierda. Se construye una vez por
+    # proceso y escala (k) y cada documento copia la cadena en línea en su
+    # página: es una caché de operadores, no una plantilla ni un form XObject.
+    # Los números y la leyenda no entran aquí porque su texto depende de la
+    # fuente (y del subconjunto de glifos) de cada documento.
+    def pt(value: float) -> str:
+        return f"{value * k:.2f}"
+
+    ops = ["q", "0.25 w", "0.35 0.35 0.35 RG"]
+    inset = CHART_TOOTH_W * 0.3
+    for x, y in CHART_POSITIONS.values():
+        w, h = CHART_TOOTH_W, CHART_TOOTH_H
+        ix, iy, iw, ih = x + inset, y + h * 0.3, w - 2 * inset, h * 0.4
+        ops.append(f"{pt(x)} -{pt(y + h)} {pt(w)} {pt(h)} re S")
+        ops.append(f"{pt(ix)} -{pt(iy + ih)} {pt(iw)} {pt(ih)} re S")
+        for (ax, ay), (bx, by) in (((x, y), (ix, iy)), ((x + w, y), (ix + iw, iy)),
+                                   ((x, y + h), (ix, iy + ih)), ((x + w, y + h), (ix + iw, iy + ih))):
+            ops.append(f"{pt(ax)} -{pt(ay)} m {pt(bx)} -{pt(by)} l S")
+    mid_x = 8 * CHART_TOOTH_W
+    ops.append(f"0.8 w 0 0 0 RG {pt(mid_x)} -{pt(CHART_LABEL_H - 1)} m {pt(mid_x)} -{pt(CHART_HEIGHT - CHART_LEGEND_H - CHART_LABEL_H + 1)} l S")
+    ops.append("Q")
+    return "\n".join(ops)
 
 class PDF(FPDF):
     font_name = 'Arial' 
@@ -48,6 +118,7 @@ class PDF(FPDF):
 
     def chapter_body_field(self, label, value, indent_px=0, is_list_item_dict=False):
         if label.lower() == "odontograma completo" and isinstance(value, dict):
+            self.render_odontograma_grafico(value, indent_px_for_chart=indent_px)
             if value: 
                 self.render_odontograma_completo(value, indent_px_for_table=indent_px)
             else: 
@@ -124,6 +195,47 @@ class PDF(FPDF):
         y_after_value = self.get_y()
         self.set_y(max(y_after_multicell_label, y_after_value))
 
+    def render_odontograma_grafico(self, odontograma_data: dict, indent_px_for_chart: float = 0):
+        # Gráfico FDI: el esqueleto se copia en línea desde chart_skeleton_ops
+        # (en caché) y el documento solo añade el relleno de las piezas con
+        # hallazgo, plan o notas y escribe los números y la leyenda en las
+        # posiciones ya calculadas (CHART_LABELS y CHART_LEGEND).
+        chart_width = len(CHART_ROWS[0]) * CHART_TOOTH_W
+        available = self.w - self.r_margin - self.l_margin - indent_px_for_chart
+        chart_x = self.l_margin + indent_px_for_chart + max(0, (available - chart_width) / 2)
+        if self.get_y() + CHART_HEIGHT > self.h - self.b_margin:
+            self.add_page()
+        chart_y = self.get_y() + 1
+
+        for pieza_num_str in sorted(odontograma_data.keys(), key=fdi_sort_key):
+            position = CHART_POSITIONS.get(str(pieza_num_str).split('.')[0])
+            pieza_info = odontograma_data[pieza_num_str]
+            if position is None or not pieza_info or not isinstance(pieza_info, dict):
+                continue
+            def has_text(field: str) -> bool:
+                return (str(pieza_info.get(field) or "").strip() or "-") != "-"
+
+            if has_text("diagnostico_hallazgo"):
+                self.set_fill_color(*CHART_FILL_FINDING)
+            elif has_text("plan_tratamiento_sugerido") or has_text("notas_adicionales"):
+                self.set_fill_color(*CHART_FILL_PLAN)
+            else:
+                continue  # mencionada sin datos: se dibuja sin relleno
+            self.rect(chart_x + position[0], chart_y + position[1], CHART_TOOTH_W, CHART_TOOTH_H, 'F')
+
+        self._out(f"q 1 0 0 1 {chart_x * self.k:.2f} {(self.h - chart_y) * self.k:.2f} cm\n"
+                  f"{chart_skeleton_ops(self.k)}\nQ")
+
+        self.set_font(self.font_name, '', self.font_size_odontogram_tooth - 1)
+        for tooth, x, y in CHART_LABELS:
+            self.text(chart_x + x, chart_y + y, tooth)
+
+        for x, y, color, text in CHART_LEGEND:
+            self.set_fill_color(*color)
+            self.rect(chart_x + x, chart_y + y, 3, 3, 'DF')
+            self.text(chart_x + x + 4, chart_y + y + 2.5, text)
+        self.set_y(chart_y + CHART_HEIGHT + 1)
+
     def render_odontograma_completo(self, odontograma_data: dict, indent_px_for_table: float):
         if not odontograma_data:
             return
@@ -156,16 +268,6 @@ class PDF(FPDF):
 
         self.set_font(self.font_name, '', self.font_size_odontogram_tooth)
         
-        def fdi_sort_key(pieza_str):
-            try:
-                num_str = str(pieza_str).split('.')[0] 
-                num = int(num_str)
-                cuadrante = num // 10
-                diente = num % 10
-                cuadrante_orden = {1:1, 2:2, 4:3, 3:4} 
-                return (cuadrante_orden.get(cuadrante, 9), diente if cuadrante in [1,4] else -diente)
-            except ValueError: return (99, pieza_str)
-
         sorted_piezas = sorted(odontograma_data.keys(), key=fdi_sort_key)
 
         for pieza_num_str in sorted_piezas:
@@ -209,43 +311,92 @@ class PDF(FPDF):
             self.set_y(y_start_row + max_h_in_row)
 
 
-def create_pdf_from_json(data: dict) -> bytes:
+# Caché de fuentes del proceso: cada cara DejaVu se lee y se analiza una sola vez
+# (tabla cmap, anchos por carácter y métricas, lo más caro de cada PDF). Cada
+# documento recibe una copia ligera que comparte esos datos y lleva su propio
+# subconjunto de glifos y su propio TTFont "lazy" sobre los bytes ya leídos: al
+# guardar el PDF, fpdf2 recorta el TTFont del documento a los glifos usados, por
+# eso no se puede compartir entre documentos.
+# La copia rellena a mano atributos internos de TTFFont, así que solo se usa con
+# la versión de fpdf2 con la que se escribió (fijada en el README) y si la
+# fuente tiene esos atributos; si no, cada documento llama a pdf.add_font.
+FONT_CACHE_FPDF_VERSION = "2.8.9"
+_FONT_COPY_ATTRIBUTES = ("i", "fontkey", "ttfont", "cw", "missing_glyphs", "biggest_size_pt", "_hbfont", "subset")
+_font_cache: dict[tuple[str, str], tuple[bytes, TTFFont]] = {}
+_font_cache_lock = threading.Lock()
+
+def _font_copy_supported(template: TTFFont) -> bool:
+    return (fpdf.__version__ == FONT_CACHE_FPDF_VERSION and isinstance(template, TTFFont)
+            and all(hasattr(template, name) for name in _FONT_COPY_ATTRIBUTES) and isinstance(template.cw, defaultdict))
+
+def _parsed_font(path: str, style: str) -> tuple[bytes, TTFFont, bool]:
+    # Devuelve (bytes del archivo, fuente analizada, True si se acaba de analizar)
+    key = (path, style)
+    with _font_cache_lock:
+        cached = _font_cache.get(key)
+        if cached is not None:
+            return cached[0], cached[1], False
+        with open(path, "rb") as f:
+            font_bytes = f.read()
+        template_pdf = FPDF()
+        template_pdf.add_font('DejaVu', style, path)
+        template = next(iter(template_pdf.fonts.values()))
+        _font_cache[key] = (font_bytes, template)
+        if not _font_copy_supported(template):
+            print(f"Advertencia: fpdf2 {fpdf.__version__} no coincide con la versión probada ({FONT_CACHE_FPDF_VERSION}) "
+                  f"o su TTFFont cambió; las fuentes se cargarán en cada PDF sin la caché.")
+        return font_bytes, template, True
+
+def _add_cached_font(pdf: FPDF, family: str, style: str, path: str) -> bool:
+    # Equivale a pdf.add_font(family, style, path) usando la caché del proceso.
+    # Devuelve True si la cara se analizó en esta llamada (primer uso).
+    font_bytes, template, parsed_now = _parsed_font(path, style)
+    if not _font_copy_supported(template):
+        pdf.add_font(family, style, path)
+        return parsed_now
+    font = copy.copy(template)
+    font.i = len(pdf.fonts) + 1
+    font.fontkey = f"{family.lower()}{style}"
+    font.ttfont = ttLib.TTFont(io.BytesIO(font_bytes), recalcTimestamp=False, lazy=True)
+    font.cw = defaultdict(template.cw.default_factory, template.cw)
+    font.missing_glyphs = []
+    font.biggest_size_pt = 0
+    font._hbfont = None
+    font.subset = SubsetMap(font)
+    pdf.fonts[font.fontkey] = font
+    return parsed_now
+
+def _register_fonts(pdf: PDF) -> None:
     font_dir = os.path.dirname(os.path.abspath(__file__))
     dejavu_regular_path = os.path.join(font_dir, "DejaVuSans.ttf")
     dejavu_bold_path = os.path.join(font_dir, "DejaVuSans-Bold.ttf")
     dejavu_italic_path = os.path.join(font_dir, "DejaVuSans-Oblique.ttf")
 
-    active_font_name = 'Arial'
-    pdf = PDF(font_name=active_font_name)
-    
+    # Los mensajes se imprimen solo cuando la cara se analiza (una vez por proceso)
     if os.path.exists(dejavu_regular_path):
         try:
-            pdf.add_font('DejaVu', '', dejavu_regular_path, uni=True)
-            active_font_name = 'DejaVu'
-            pdf.font_name = active_font_name
-            print("Fuente DejaVu (Regular) registrada.")
+            if _add_cached_font(pdf, 'DejaVu', '', dejavu_regular_path):
+                print("Fuente DejaVu (Regular) registrada.")
+            pdf.font_name = 'DejaVu'
 
             pdf.has_bold_variant = False
             if os.path.exists(dejavu_bold_path):
-                pdf.add_font('DejaVu', 'B', dejavu_bold_path, uni=True)
+                if _add_cached_font(pdf, 'DejaVu', 'B', dejavu_bold_path):
+                    print("Fuente DejaVu (Bold) registrada.")
                 pdf.has_bold_variant = True
-                print("Fuente DejaVu (Bold) registrada.")
-            else:
-                pdf.add_font('DejaVu', 'B', dejavu_regular_path, uni=True)
+            elif _add_cached_font(pdf, 'DejaVu', 'B', dejavu_regular_path):
                 print("Advertencia: DejaVuSans-Bold.ttf no encontrada, usando regular para Bold.")
 
             pdf.has_italic_variant = False
             if os.path.exists(dejavu_italic_path):
-                pdf.add_font('DejaVu', 'I', dejavu_italic_path, uni=True)
+                if _add_cached_font(pdf, 'DejaVu', 'I', dejavu_italic_path):
+                    print("Fuente DejaVu (Italic) registrada.")
                 pdf.has_italic_variant = True
-                print("Fuente DejaVu (Italic) registrada.")
-            else:
-                pdf.add_font('DejaVu', 'I', dejavu_regular_path, uni=True)
+            elif _add_cached_font(pdf, 'DejaVu', 'I', dejavu_regular_path):
                 print("Advertencia: DejaVuSans-Oblique.ttf no encontrada, usando regular para Italic.")
         except Exception as e:
             print(f"Error al registrar fuentes DejaVu: {e}. Usando Arial.")
-            active_font_name = 'Arial'
-            pdf.font_name = active_font_name
+            pdf.font_name = 'Arial'
             pdf.has_bold_variant = True 
             pdf.has_italic_variant = True
     else:
@@ -253,6 +404,14 @@ def create_pdf_from_json(data: dict) -> bytes:
         pdf.has_bold_variant = True
         pdf.has_italic_variant = True
 
+def preload_pdf_fonts() -> None:
+    # Analiza las fuentes al arrancar para que el primer PDF no pague ese coste
+    _register_fonts(PDF(font_name='Arial'))
+
+def create_pdf_from_json(data: dict) -> bytes:
+    pdf = PDF(font_name='Arial')
+    _register_fonts(pdf)
+
     pdf.add_page() 
     pdf.set_font(pdf.font_name, '', pdf.font_size_body_value) 
     pdf.set_auto_page_break(auto=True, margin=15)
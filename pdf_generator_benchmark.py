@@ -0,0 +1,234 @@
+# E:\PROJECTS\voice_test\pdf_generator_benchmark.py
+#
+# Micro-benchmark de create_pdf_from_json (pdf_generator.py) con registros
+# sintéticos con la forma del diccionario de Gemini. Parte de un dictado
+# típico y varía un eje cada vez: piezas del odontograma (0-32),
+# procedimientos (0-50), palabras de la transcripción (100-20.000) y
+# diccionarios anidados que recorre chapter_body_field. Por caso mide el
+# tiempo (mínimo, p50 y p95), la memoria pico (tracemalloc), el tamaño y las páginas.
+# Compara con una línea base en JSON y termina con código 1 si algún caso la
+# supera más allá de los umbrales. Uso:
+#   python pdf_generator_benchmark.py [--repeticiones 5] [--casos piezas_32,palabras_20000]
+#   python pdf_generator_benchmark.py --guardar-baseline   # tras un cambio aceptado, en la máquina de referencia
+
+import gc
+import io
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import contextlib
+import tracemalloc
+from datetime import datetime
+
+import fpdf
+
+from pdf_generator import create_pdf_from_json, preload_pdf_fonts
+from local_extraction import is_valid_fdi
+from local_extraction_benchmark import synthetic_dictation
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pdf_generator_baseline.json")
+# Aumento relativo tolerado sobre la línea base. El tiempo se compara con el
+# mínimo de las repeticiones, el valor menos sensible a otros procesos de la
+# máquina, y además necesita superar MIN_TIME_DELTA_MS.
+DEFAULT_THRESHOLDS = {"tiempo": 0.25, "memoria": 0.15, "bytes": 0.05}
+MIN_TIME_DELTA_MS = 5.0
+
+_TYPICAL = {"piezas": 4, "procedimientos": 2, "palabras": 600, "anidado": 0}
+# (nombre, cambios sobre el dictado típico)
+CASES = [("tipico", {})]
+CASES += [(f"piezas_{n}", {"piezas": n}) for n in (0, 8, 32)]
+CASES += [(f"procedimientos_{n}", {"procedimientos": n}) for n in (0, 10, 50)]
+CASES += [(f"palabras_{n}", {"palabras": n}) for n in (100, 2000, 20000)]
+CASES += [(f"anidado_{n}", {"anidado": n}) for n in (2, 4, 8)]
+
+_PERMANENT_TEETH = [code for code in range(11, 49) if is_valid_fdi(code)]
+_FINDINGS = ["Caries mesial profunda", "Caries oclusal", "Fractura coronal", "Movilidad grado II", "Pulpitis irreversible",
+             "Lesión periapical", "Resto radicular", "Obturación defectuosa", "Sano, retenido"]
+_PLANS = ["Endodoncia y corona", "Obturación con resina", "Exodoncia", "Implante", "Incrustación", "Sellante", "Control"]
+_NOTES = ["", "", "Evaluar pronóstico", "Sensibilidad al frío", "Cercano a nervio dentario"]
+_PROCEDURES = ["Obturación con resina compuesta", "Tartrectomía supragingival", "Apertura cameral y pulpectomía",
+               "Exodoncia simple", "Aplicación de flúor barniz", "Cementado de corona provisional"]
+_MATERIALS = ["Resina A2", "Ionómero de vidrio", "Hidróxido de calcio", "Cemento de policarboxilato", ""]
+
+def _transcript(rng: random.Random, words: int) -> str:
+    # Dictados sintéticos encadenados y recortados al número exacto de palabras
+    tokens: list[str] = []
+    while len(tokens) < words:
+        tokens.extend(synthetic_dictation(rng, filler_probability=0.8)[0].split())
+    return " ".join(tokens[:words])
+
+def _nested(rng: random.Random, depth: int) -> dict | str:
+    # Árbol binario de profundidad "depth" con textos en las hojas (2^depth hojas)
+    if depth == 0:
+        return rng.choice(_FINDINGS)
+    return {f"region_{i + 1}": _nested(rng, depth - 1) for i in range(2)}
+
+def synthetic_record(rng: random.Random, piezas: int, procedimientos: int, palabras: int, anidado: int) -> dict:
+    teeth = rng.sample(_PERMANENT_TEETH, piezas)
+    record = {
+        "paciente_identificador_mencionado_opcional": "Paciente sintético",
+        "fecha_hora_dictado_aproximada": "2024-05-14T10:30:00Z",
+        "texto_transcrito_original": _transcript(rng, palabras),
+        "queja_principal_detectada": "Dolor al masticar en la zona inferior izquierda desde hace una semana.",
+        "historia_enfermedad_actual_detectada": "Dolor espontáneo nocturno que cede parcialmente con ibuprofeno.",
+        "antecedentes_medicos_relevantes_detectados": ["Hipertensión controlada", "Alergia a la penicilina"],
+        "hallazgos_examen_extraoral_detectados": "Sin adenopatías palpables. ATM sin ruidos.",
+        "hallazgos_examen_intraoral_general_detectados": "Encía inflamada en el sector posterior. Higiene deficiente.",
+        "odontograma_completo": {str(code): {"diagnostico_hallazgo": rng.choice(_FINDINGS),
+                                             "plan_tratamiento_sugerido": rng.choice(_PLANS),
+                                             "notas_adicionales": rng.choice(_NOTES)} for code in teeth},
+        "diagnosticos_sugeridos_ia": ["Pulpitis irreversible sintomática", "Gingivitis asociada a placa"],
+        "procedimientos_realizados_sesion_detectados": [
+            {"pieza_o_region_tratada": str(rng.choice(_PERMANENT_TEETH)), "descripcion_procedimiento": rng.choice(_PROCEDURES),
+             "anestesia_mencionada": rng.choice(["Lidocaína 2% con epinefrina", ""]), "materiales_mencionados": rng.choice(_MATERIALS),
+             "complicaciones_mencionadas": ""} for _ in range(procedimientos)],
+        "indicaciones_postoperatorias_detectadas": "No comer durante dos horas. Evitar alimentos duros.",
+        "medicacion_recetada_detectada": "Ibuprofeno 600 mg cada 8 horas durante 3 días.",
+        "plan_proxima_cita_detectado": "Control en dos semanas y cementado de corona definitiva.",
+        "observaciones_generales_dictadas": "Paciente colaborador.",
+    }
+    if anidado:
+        # Gemini a veces devuelve objetos en campos de texto; chapter_body_field los recorre recursivamente
+        record["hallazgos_examen_intraoral_general_detectados"] = _nested(rng, anidado)
+    return record
+
+def build_cases(seed: int, selected: list[str] | None = None) -> dict[str, dict]:
+    cases = {}
+    for name, overrides in CASES:
+        if selected and name not in selected:
+            continue
+        # Misma semilla por caso: cada registro es el mismo entre ejecuciones
+        cases[name] = synthetic_record(random.Random(f"{seed}-{name}"), **dict(_TYPICAL, **overrides))
+    return cases
+
+def _render(data: dict) -> bytes:
+    with contextlib.redirect_stdout(io.StringIO()):
+        return create_pdf_from_json(data)
+
+def _percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def measure_case(data: dict, repetitions: int) -> dict:
+    pdf_bytes = _render(data)  # calentamiento: cachés del generador y de fpdf
+    times = []
+    for _ in range(repetitions):
+        # Como timeit: sin pausas del recolector, que dependen del historial del proceso
+        gc.collect()
+        gc.disable()
+        try:
+            started = time.perf_counter()
+            _render(data)
+            times.append((time.perf_counter() - started) * 1000)
+        finally:
+            gc.enable()
+    # Memoria en una pasada aparte: tracemalloc ralentiza las asignaciones
+    tracemalloc.start()
+    try:
+        _render(data)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        "ms_min": round(min(times), 2),
+        "ms_p50": round(_percentile(times, 0.5), 2),
+        "ms_p95": round(_percentile(times, 0.95), 2),
+        "memoria_pico_kib": round(peak / 1024),
+        "bytes": len(pdf_bytes),
+        "paginas": len(re.findall(rb"/Type\s*/Page\b", pdf_bytes)),
+    }
+
+def environment() -> dict:
+    # Los tiempos solo son comparables en el mismo entorno
+    return {"python": platform.python_version(), "fpdf2": fpdf.__version__, "plataforma": platform.platform(),
+            "procesador": platform.processor() or platform.machine(), "nucleos": os.cpu_count()}
+
+def compare(results: dict, baseline: dict, thresholds: dict, compare_times: bool) -> list[str]:
+    regressions = []
+    for name, current in results.items():
+        base = baseline["casos"].get(name)
+        if base is None:
+            continue
+        checks = [("memoria_pico_kib", "memoria", 0.0), ("bytes", "bytes", 0.0)]
+        if compare_times:
+            checks.insert(0, ("ms_min", "tiempo", MIN_TIME_DELTA_MS))
+        for metric, threshold_name, min_delta in checks:
+            limit = base[metric] * (1 + thresholds[threshold_name])
+            if current[metric] > limit and current[metric] - base[metric] > min_delta:
+                regressions.append(f"{name}: {metric} {current[metric]} > {base[metric]} "
+                                   f"(+{(current[metric] / base[metric] - 1):.0%}, umbral +{thresholds[threshold_name]:.0%})")
+    return regressions
+
+def print_table(results: dict, baseline: dict | None) -> None:
+    print(f"{'Caso':<20}{'mín (ms)':>10}{'base mín':>10}{'p50 (ms)':>10}{'p95 (ms)':>10}{'memoria (KiB)':>15}{'bytes':>10}"
+          f"{'páginas':>9}")
+    for name, r in results.items():
+        base = baseline["casos"].get(name) if baseline else None
+        base_min = f"{base['ms_min']:.1f}" if base else "-"
+        print(f"{name:<20}{r['ms_min']:>10.1f}{base_min:>10}{r['ms_p50']:>10.1f}{r['ms_p95']:>10.1f}{r['memoria_pico_kib']:>15}"
+              f"{r['bytes']:>10}{r['paginas']:>9}")
+
+def run_benchmark(args) -> int:
+    selected = args.casos.split(",") if args.casos else None
+    with contextlib.redirect_stdout(io.StringIO()):
+        preload_pdf_fonts()  # como en el servidor: las fuentes no cuentan en ningún caso
+    results = {name: measure_case(data, args.repeticiones) for name, data in build_cases(args.semilla, selected).items()}
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_table(results, baseline)
+
+    if args.guardar_baseline:
+        merged = dict(baseline["casos"]) if baseline and selected else {}
+        merged.update(results)
+        thresholds = baseline["umbrales"] if baseline else DEFAULT_THRESHOLDS
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"generado": datetime.utcnow().isoformat() + "Z", "entorno": environment(), "semilla": args.semilla,
+                       "repeticiones": args.repeticiones, "umbrales": thresholds, "casos": merged},
+                      f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"Línea base guardada en {args.baseline} ({len(merged)} casos).")
+        return 0
+    if baseline is None:
+        print(f"No hay línea base en {args.baseline}; créala con --guardar-baseline.")
+        return 0
+
+    thresholds = dict(baseline.get("umbrales", DEFAULT_THRESHOLDS))
+    for name in ("tiempo", "memoria", "bytes"):
+        override = getattr(args, f"umbral_{name}")
+        if override is not None:
+            thresholds[name] = override
+    compare_times = args.forzar_tiempos or baseline.get("entorno") == environment()
+    if not compare_times:
+        print("Aviso: la línea base se generó en otro entorno; solo se comparan memoria y tamaño "
+              "(--forzar-tiempos para comparar también los tiempos).")
+    if baseline.get("semilla") != args.semilla:
+        print("Aviso: la semilla no coincide con la de la línea base; los registros no son los mismos.")
+    regressions = compare(results, baseline, thresholds, compare_times)
+    for line in regressions:
+        print(f"[regresión] {line}")
+    print("Sin regresiones." if not regressions else f"{len(regressions)} regresiones.")
+    return 1 if regressions else 0
+
+def parse_args(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description="Micro-benchmark de create_pdf_from_json con registros sintéticos.")
+    parser.add_argument("--repeticiones", type=int, default=5, help="PDF medidos por caso, tras uno de calentamiento (5).")
+    parser.add_argument("--casos", help=f"Casos separados por comas (todos): {', '.join(name for name, _ in CASES)}.")
+    parser.add_argument("--semilla", type=int, default=7, help="Semilla de los registros sintéticos (7).")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Archivo JSON de la línea base (pdf_generator_baseline.json).")
+    parser.add_argument("--guardar-baseline", action="store_true", help="Guardar los resultados como nueva línea base.")
+    parser.add_argument("--forzar-tiempos", action="store_true", help="Comparar tiempos aunque el entorno sea otro.")
+    parser.add_argument("--umbral-tiempo", type=float, help="Aumento relativo tolerado del tiempo mínimo (0.25).")
+    parser.add_argument("--umbral-memoria", type=float, help="Aumento relativo tolerado de la memoria pico (0.15).")
+    parser.add_argument("--umbral-bytes", type=float, help="Aumento relativo tolerado del tamaño del PDF (0.05).")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    sys.exit(run_benchmark(parse_args()))
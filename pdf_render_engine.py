@@ -0,0 +1,187 @@
+# E:\PROJECTS\voice_test\pdf_render_engine.py
+
+import os
+import json
+import time
+import zlib
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fastapi import HTTPException
+
+from metrics import Counter, Gauge, Histogram
+
+# Motor de renderizado de PDF en procesos: fpdf es CPU puro y retiene el GIL,
+# así que en hilos no escala con los núcleos y compite con el resto del
+# servidor. Los procesos arrancan precalentados (imports, fuentes y un PDF de
+# prueba), la cola de envíos está acotada y se mantiene en el motor (al pool
+# solo llegan tantos PDF como procesos), cada PDF tiene un tiempo límite que
+# cuenta desde que empieza a renderizarse y cada proceso se recicla tras PDF_ENGINE_RECYCLE_AFTER PDF para acotar la
+# memoria. El diccionario viaja como JSON compacto comprimido con zlib.
+PDF_ENGINE_ENABLED = os.getenv("PDF_ENGINE_ENABLED", "true").lower() in ("1", "true", "yes")
+PDF_ENGINE_WORKERS = int(os.getenv("PDF_ENGINE_WORKERS", str(os.cpu_count() or 1)))
+PDF_ENGINE_MAX_PENDING = int(os.getenv("PDF_ENGINE_MAX_PENDING", "0"))  # 0: 4 por proceso
+PDF_ENGINE_TIMEOUT_SECONDS = float(os.getenv("PDF_ENGINE_TIMEOUT_SECONDS", "60"))
+PDF_ENGINE_RECYCLE_AFTER = int(os.getenv("PDF_ENGINE_RECYCLE_AFTER", "500"))
+# "spawn" funciona igual en Windows y Linux y no hereda los hilos del servidor
+PDF_ENGINE_START_METHOD = os.getenv("PDF_ENGINE_START_METHOD", "spawn")
+
+PDF_ENGINE_RENDERS = Counter("pdf_engine_renders_total", "PDF del motor de procesos por resultado (ok, rechazado, tiempo_agotado, error).",
+                             ("outcome",))
+PDF_ENGINE_PENDING = Gauge("pdf_engine_pending", "PDF enviados al motor de procesos y aún sin terminar.")
+PDF_ENGINE_RESTARTS = Counter("pdf_engine_pool_restarts_total", "Reinicios del pool de procesos de PDF por motivo.", ("reason",))
+PDF_ENGINE_PAYLOAD_BYTES = Histogram("pdf_engine_payload_bytes", "Tamaño del diccionario serializado que se envía a cada proceso.",
+                                     buckets=(512, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072))
+
+_WARMUP_DATA = {
+    "paciente_identificador_mencionado_opcional": "Calentamiento",
+    "queja_principal_detectada": "Prueba de arranque del proceso de PDF: áéíóú ñ.",
+    "odontograma_completo": {"16": {"diagnostico_hallazgo": "Caries oclusal", "plan_tratamiento_sugerido": "Obturación",
+                                    "notas_adicionales": ""}},
+    "texto_transcrito_original": "Pieza dieciséis con caries oclusal, se planifica obturación.",
+}
+
+def encode_payload(data: dict) -> bytes:
+    # JSON sin espacios + zlib rápido: unas 3-4 veces menos que el pickle del diccionario
+    return zlib.compress(json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 1)
+
+def decode_payload(payload: bytes) -> dict:
+    return json.loads(zlib.decompress(payload).decode("utf-8"))
+
+# --- Funciones que se ejecutan dentro de los procesos del pool ---
+
+def _init_worker() -> None:
+    from pdf_generator import create_pdf_from_json, preload_pdf_fonts
+    preload_pdf_fonts()
+    # Un PDF completo para cargar el resto de módulos (subconjuntos de fuente, zlib...)
+    create_pdf_from_json(dict(_WARMUP_DATA))
+    print(f"Proceso de PDF {os.getpid()} listo.")
+
+def _warm_worker() -> int:
+    return os.getpid()
+
+def render_payload(payload: bytes) -> bytes:
+    from pdf_generator import create_pdf_from_json
+    return create_pdf_from_json(decode_payload(payload))
+
+class PdfRenderEngine:
+    # Uso desde el bucle de eventos: await engine.start() (opcional, precalienta
+    # todos los procesos), await engine.render(datos) y engine.shutdown().
+
+    def __init__(self, workers: int = PDF_ENGINE_WORKERS, max_pending: int = PDF_ENGINE_MAX_PENDING,
+                 timeout_seconds: float = PDF_ENGINE_TIMEOUT_SECONDS, recycle_after: int = PDF_ENGINE_RECYCLE_AFTER,
+                 start_method: str = PDF_ENGINE_START_METHOD):
+        self.workers = max(1, workers)
+        self.max_pending = max_pending if max_pending > 0 else 4 * self.workers
+        self.timeout_seconds = timeout_seconds
+        self.recycle_after = recycle_after
+        self.start_method = start_method
+        self.pending = 0
+        # PDF en los procesos; el resto espera aquí, fuera del tiempo límite
+        self._running = asyncio.Semaphore(self.workers)
+        self._executor: ProcessPoolExecutor | None = None
+        self._submitted = 0
+        self._warmup: list = []
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # Reciclado por generaciones: tras recycle_after PDF por proceso se crea
+        # un pool nuevo (precalentado en segundo plano) y el anterior termina lo
+        # que tenga en curso y se cierra. No se usa max_tasks_per_child: en
+        # Python 3.11 puede dejar el pool bloqueado al reemplazar procesos.
+        if self._executor is not None and self.recycle_after > 0 and self._submitted >= self.recycle_after * self.workers:
+            old, self._executor = self._executor, None
+            old.shutdown(wait=False)
+            PDF_ENGINE_RESTARTS.inc(reason="reciclado")
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(self.start_method),
+                                                 initializer=_init_worker)
+            self._submitted = 0
+            # Los procesos se crean bajo demanda: un envío por proceso los arranca todos
+            self._warmup = [self._executor.submit(_warm_worker) for _ in range(self.workers)]
+        return self._executor
+
+    async def start(self) -> None:
+        started = time.perf_counter()
+        self._get_executor()
+        await asyncio.gather(*(asyncio.wrap_future(future) for future in self._warmup))
+        print(f"Motor de PDF: {self.workers} procesos precalentados en {time.perf_counter() - started:.1f} s "
+              f"(cola máx. {self.max_pending}, límite {self.timeout_seconds:.0f} s, reciclado cada {self.recycle_after} PDF).")
+
+    def _restart(self, reason: str) -> None:
+        # Un PDF colgado o un proceso caído: se descartan los procesos actuales
+        # (terminándolos, no hay otra forma de cancelar un render en curso) y
+        # el siguiente envío crea un pool nuevo. Sin cancel_futures: los PDF
+        # que estaban en otros procesos reciben BrokenProcessPool y se
+        # reintentan en el pool nuevo, no una cancelación.
+        old, self._executor = self._executor, None
+        if old is None:
+            return
+        PDF_ENGINE_RESTARTS.inc(reason=reason)
+        for process in list((old._processes or {}).values()):
+            process.terminate()
+        old.shutdown(wait=False)
+
+    async def _render_once(self, payload: bytes) -> bytes:
+        # Un envío al pool actual, ya con un proceso libre para él. Espera al
+        # precalentamiento del pool (p. ej. tras un reinicio) antes de empezar
+        # a contar el tiempo límite.
+        executor = self._get_executor()
+        warmup = self._warmup
+        wrapped = None
+        try:
+            await asyncio.gather(*(asyncio.wrap_future(future) for future in warmup))
+            future = executor.submit(render_payload, payload)
+            self._submitted += 1
+            wrapped = asyncio.wrap_future(future)
+            # Tras un tiempo agotado nadie espera ya el resultado
+            wrapped.add_done_callback(lambda f: f.cancelled() or f.exception())
+            # shield: si cancelan al llamante no se cancela el futuro, y así un
+            # futuro cancelado solo puede venir del cierre del pool
+            return await asyncio.wait_for(asyncio.shield(wrapped), timeout=self.timeout_seconds)
+        except asyncio.TimeoutError:
+            PDF_ENGINE_RENDERS.inc(outcome="tiempo_agotado")
+            if self._executor is executor:
+                self._restart("tiempo_agotado")
+            raise HTTPException(status_code=504, detail=f"La generación del PDF superó {self.timeout_seconds:.0f} s.")
+        except asyncio.CancelledError:
+            if wrapped is None or not wrapped.cancelled():
+                raise
+            raise BrokenProcessPool("El pool de PDF se cerró con el PDF en cola.")
+        except BrokenProcessPool:
+            if self._executor is executor:
+                self._restart("pool_roto")
+            raise
+
+    async def render(self, data: dict) -> bytes:
+        if self.pending >= self.max_pending:
+            PDF_ENGINE_RENDERS.inc(outcome="rechazado")
+            retry_after = max(1, int(self.pending / self.workers + 1))
+            raise HTTPException(status_code=429, detail="Servidor saturado: la cola de generación de PDF está llena.",
+                                headers={"Retry-After": str(retry_after)})
+        payload = encode_payload(data)
+        PDF_ENGINE_PAYLOAD_BYTES.observe(len(payload))
+        self.pending += 1
+        PDF_ENGINE_PENDING.set(self.pending)
+        try:
+            # Si el pool se rompe (proceso caído, o reiniciado por el tiempo
+            # límite de otro PDF) se reintenta una vez en un pool nuevo.
+            async with self._running:
+                for attempt in range(2):
+                    try:
+                        pdf_bytes = await self._render_once(payload)
+                    except BrokenProcessPool:
+                        if attempt == 0:
+                            continue
+                        PDF_ENGINE_RENDERS.inc(outcome="error")
+                        raise HTTPException(status_code=500, detail="El proceso de generación del PDF terminó de forma inesperada.")
+                    PDF_ENGINE_RENDERS.inc(outcome="ok")
+                    return pdf_bytes
+        finally:
+            self.pending -= 1
+            PDF_ENGINE_PENDING.set(self.pending)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,404 @@
+# E:\PROJECTS\voice_test\pipeline.py
+
+import os
+import json
+import time
+import shutil
+import asyncio
+import functools
+import contextlib
+from typing import AsyncIterable, Awaitable, Callable
+from concurrent.futures import Executor, ThreadPoolExecutor
+from datetime import datetime
+import httpx
+from fastapi import HTTPException
+
+from assemblyai_service import upload_audio_to_assemblyai, request_transcription, poll_for_transcription_result
+from gemini_service import analyze_text_with_gemini
+from extraction_schema import sections_from_extraction
+from local_extraction import (extract_dental_findings, should_skip_llm, local_result_to_extraction, merge_local_findings,
+    LOCAL_EXTRACTION_ENABLED, LOCAL_EXTRACTION_RESULTS)
+from pdf_generator import create_pdf_from_json
+from pdf_render_engine import PdfRenderEngine, PDF_ENGINE_WORKERS
+from result_cache import ResultCache
+from record_store import RecordStore
+from transcription_scheduler import TranscriptionPollScheduler
+from metrics import stage_timer, record_pipeline_timings, PIPELINE_RESULTS
+from upload_streaming import iter_file_chunks
+from audio_preprocessing import preprocess_audio_file, AUDIO_PREPROCESS_SETTINGS
+from chunked_transcription import (prepare_segments, stitch_transcripts, estimate_time_saved, CHUNKED_TRANSCRIPTION_ENABLED,
+    CHUNKED_TRANSCRIPTION_SETTINGS, CHUNKED_SEGMENTS, CHUNKED_SECONDS_SAVED, CHUNKED_RESULTS)
+
+# Hilos dedicados al renderizado de PDF (fpdf es síncrono y usa CPU); separados
+# del executor por defecto y del de Gemini para que no se bloqueen entre sí.
+# Con el motor de procesos activo (use_pdf_process_pool) no se usan.
+PDF_RENDER_WORKERS = int(os.getenv("PDF_RENDER_WORKERS", str(min(4, os.cpu_count() or 1))))
+_pdf_executor: Executor | None = None
+
+_pdf_engine: PdfRenderEngine | None = None
+
+def use_pdf_process_pool(workers: int | None = None) -> PdfRenderEngine:
+    # Renderiza los PDF en el motor de procesos (pdf_render_engine.py) en lugar
+    # de hilos. Hay que llamarla antes del primer PDF; await engine.start()
+    # precalienta los procesos.
+    global _pdf_engine
+    shutdown_pdf_executor()
+    _pdf_engine = PdfRenderEngine(workers=workers or PDF_ENGINE_WORKERS)
+    return _pdf_engine
+
+def _pdf_render_executor() -> Executor:
+    global _pdf_executor
+    if _pdf_executor is None:
+        _pdf_executor = ThreadPoolExecutor(max_workers=max(1, PDF_RENDER_WORKERS), thread_name_prefix="pdf")
+    return _pdf_executor
+
+async def render_pdf(extracted_json_data: dict) -> bytes:
+    # Solo el PDF, con el motor activo; lo usan el flujo completo y las correcciones
+    if _pdf_engine is not None:
+        return await _pdf_engine.render(extracted_json_data)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pdf_render_executor(), create_pdf_from_json, extracted_json_data)
+
+def shutdown_pdf_executor() -> None:
+    global _pdf_executor, _pdf_engine
+    if _pdf_executor is not None:
+        _pdf_executor.shutdown(wait=False, cancel_futures=True)
+        _pdf_executor = None
+    if _pdf_engine is not None:
+        _pdf_engine.shutdown()
+        _pdf_engine = None
+
+# bytes, generador de bloques o función que crea un generador nuevo (permite reintentar la subida)
+AudioSource = bytes | AsyncIterable[bytes] | Callable[[], AsyncIterable[bytes]]
+# on_section(tipo, datos): secciones del análisis según llegan de Gemini en streaming
+SectionCallback = Callable[[str, dict], Awaitable[None]]
+
+def build_pdf_filename(extracted_json_data: dict, transcript_id: str) -> str:
+    paciente_id_raw = extracted_json_data.get("paciente_identificador_mencionado_opcional", "desconocido")
+    paciente_id = str(paciente_id_raw).replace(" ", "_").replace("/", "_").replace("\\", "_") if paciente_id_raw else "desconocido"
+
+    fecha_consulta_raw = extracted_json_data.get("fecha_hora_dictado_aproximada", datetime.utcnow().isoformat())
+    try:
+        if fecha_consulta_raw.endswith('Z'):
+            dt_obj = datetime.fromisoformat(fecha_consulta_raw.replace("Z", "+00:00"))
+        else:
+            dt_obj = datetime.fromisoformat(fecha_consulta_raw)
+            if dt_obj.tzinfo is None:
+                dt_obj = dt_obj.replace(tzinfo=datetime.timezone.utc)
+        fecha_consulta_clean = dt_obj.strftime("%Y%m%d_%H%M")
+    except Exception as date_e:
+        print(f"Error parseando fecha '{fecha_consulta_raw}': {date_e}")
+        fecha_consulta_clean = "fecha_invalida"
+
+    pdf_filename_base = f"HistoriaDental_{paciente_id}_{fecha_consulta_clean}_{transcript_id[:6]}"
+    return "".join(c if c.isalnum() or c in ['_', '-'] else '_' for c in pdf_filename_base) + ".pdf"
+
+async def _enter_stage(progress: dict, on_stage: Callable[[str], Awaitable[None]] | None, stage: str) -> None:
+    progress["stage"] = stage
+    if on_stage is not None:
+        await on_stage(stage)
+
+@contextlib.asynccontextmanager
+async def _stage_limit(stage_limits: dict | None, stage: str):
+    # Límite opcional por etapa ("assemblyai" por archivo de un lote, "upload",
+    # "transcription", "gemini", "pdf"): un semáforo/StageLimiter o una lista que
+    # se adquiere en orden. Sin límite si no se configura.
+    limits = stage_limits.get(stage) if stage_limits else None
+    if limits is None:
+        yield
+        return
+    if not isinstance(limits, (list, tuple)):
+        limits = (limits,)
+    async with contextlib.AsyncExitStack() as stack:
+        for limit in limits:
+            await stack.enter_async_context(limit)
+        yield
+
+async def run_dictation_pipeline(client: httpx.AsyncClient, audio_content: AudioSource | None, assemblyai_api_key: str,
+                                 gemini_api_key: str, on_stage: Callable[[str], Awaitable[None]] | None = None,
+                                 cache: ResultCache | None = None, audio_sha256: str | None = None,
+                                 stage_limits: dict | None = None, poll_scheduler: TranscriptionPollScheduler | None = None,
+                                 audio_path: str | None = None, preprocess: bool = False,
+                                 on_section: SectionCallback | None = None, records: RecordStore | None = None) -> dict:
+    # Flujo completo: subida -> transcripción -> análisis con Gemini -> PDF.
+    # Lo comparten el endpoint síncrono, los workers de trabajos y los lotes.
+    # El audio llega como AudioSource (audio_content) o como fichero
+    # (audio_path); el preprocesado con ffmpeg y el troceado de dictados largos
+    # solo son posibles en el segundo caso.
+    # Con on_section, Gemini responde en streaming y las secciones se notifican
+    # antes de generar el PDF (en un acierto de caché, todas de golpe).
+    # El resultado incluye "timings" (segundos por etapa) para Server-Timing.
+    # Con records, el diccionario final y el PDF quedan guardados como registro
+    # editable (PATCH /registros/{transcript_id}).
+    return await _run_with_metrics(lambda timings, progress: _run_pipeline_stages(
+        client, audio_content, assemblyai_api_key, gemini_api_key, timings, progress,
+        on_stage=on_stage, cache=cache, audio_sha256=audio_sha256, stage_limits=stage_limits,
+        poll_scheduler=poll_scheduler, audio_path=audio_path, preprocess=preprocess, on_section=on_section,
+        records=records,
+    ), records=records)
+
+async def run_transcript_pipeline(transcript_id: str, transcribed_text: str, gemini_api_key: str,
+                                  on_stage: Callable[[str], Awaitable[None]] | None = None,
+                                  stage_limits: dict | None = None, on_section: SectionCallback | None = None,
+                                  records: RecordStore | None = None) -> dict:
+    # Segunda mitad del flujo (Gemini -> PDF) para un texto ya transcrito, p. ej.
+    # el acumulado por una sesión de dictado en tiempo real.
+    async def stages(timings: dict, progress: dict) -> dict:
+        if not transcribed_text:
+            raise HTTPException(status_code=500, detail="La transcripción no produjo texto.")
+        rendered = await _analyze_and_render(transcript_id, transcribed_text, gemini_api_key, timings, progress,
+                                             on_stage=on_stage, stage_limits=stage_limits, on_section=on_section)
+        return dict(rendered, transcript_id=transcript_id, transcribed_text=transcribed_text, cache_hit=False,
+                    preprocessing=None, chunking=None)
+
+    return await _run_with_metrics(stages, records=records)
+
+async def _run_with_metrics(run_stages: Callable[[dict, dict], Awaitable[dict]], records: RecordStore | None = None) -> dict:
+    timings: dict = {}
+    progress = {"stage": "inicio"}
+    started = time.perf_counter()
+    try:
+        result = await run_stages(timings, progress)
+        if records is not None:
+            # Un acierto de caché no sustituye un registro que ya puede estar corregido
+            with stage_timer(timings, "record_save"):
+                await asyncio.get_running_loop().run_in_executor(None, functools.partial(
+                    records.save, result["transcript_id"], result["extracted_json_data"], result["pdf_bytes"],
+                    result["pdf_filename"], replace=not result["cache_hit"]))
+    except Exception:
+        PIPELINE_RESULTS.inc(outcome="error", stage=progress["stage"])
+        raise
+    timings["total"] = time.perf_counter() - started
+    timings["pdf_bytes"] = len(result["pdf_bytes"])
+    record_pipeline_timings(timings)
+    PIPELINE_RESULTS.inc(outcome="cache_hit" if result["cache_hit"] else "ok", stage="completado")
+    result["timings"] = timings
+    return result
+
+async def _transcribe_audio(client: httpx.AsyncClient, audio_content: AudioSource, assemblyai_api_key: str,
+                            timings: dict, progress: dict, *, on_stage: Callable[[str], Awaitable[None]] | None,
+                            stage_limits: dict | None, poll_scheduler: TranscriptionPollScheduler | None,
+                            audio_duration_hint: float | None = None) -> dict:
+    async with _stage_limit(stage_limits, "assemblyai"):
+        print("--- Iniciando Transcripción con AssemblyAI ---")
+        await _enter_stage(progress, on_stage, "subiendo_audio")
+        async with _stage_limit(stage_limits, "upload"):
+            with stage_timer(timings, "upload"):
+                uploaded_audio_url = await upload_audio_to_assemblyai(client, audio_content, assemblyai_api_key)
+        await _enter_stage(progress, on_stage, "transcribiendo")
+        use_webhook = poll_scheduler is not None and poll_scheduler.webhook_enabled
+        async with _stage_limit(stage_limits, "transcription"):
+            with stage_timer(timings, "transcript_request"):
+                if use_webhook:
+                    transcript_id = await request_transcription(client, uploaded_audio_url, assemblyai_api_key,
+                                                                webhook_url=poll_scheduler.webhook_url,
+                                                                webhook_secret=poll_scheduler.webhook_secret)
+                else:
+                    transcript_id = await request_transcription(client, uploaded_audio_url, assemblyai_api_key)
+            if poll_scheduler is not None:
+                transcription_result = await poll_scheduler.wait_for(transcript_id, timings=timings, via_webhook=use_webhook,
+                                                                     audio_duration_hint=audio_duration_hint)
+            else:
+                transcription_result = await poll_for_transcription_result(client, transcript_id, assemblyai_api_key, timings=timings)
+    return transcription_result
+
+async def _transcribe_segments(client: httpx.AsyncClient, chunking: dict, assemblyai_api_key: str, timings: dict, *,
+                               stage_limits: dict | None, poll_scheduler: TranscriptionPollScheduler | None) -> dict:
+    # Transcribe los segmentos en paralelo (cada uno con su subida, solicitud y
+    # sondeo) y une los textos. Si un segmento falla se cancelan los demás.
+    async def transcribe_one(path: str, start: float, end: float) -> tuple[dict, dict]:
+        segment_timings: dict = {}
+        segment_started = time.perf_counter()
+        result = await _transcribe_audio(client, functools.partial(iter_file_chunks, path), assemblyai_api_key, segment_timings,
+                                         {"stage": "inicio"}, on_stage=None, stage_limits=stage_limits, poll_scheduler=poll_scheduler,
+                                         audio_duration_hint=end - start)
+        segment_timings["elapsed"] = time.perf_counter() - segment_started
+        return result, segment_timings
+
+    started = time.perf_counter()
+    tasks = [asyncio.create_task(transcribe_one(path, start, end))
+             for path, (start, end) in zip(chunking["paths"], chunking["segments"])]
+    try:
+        outcomes = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    wall_seconds = time.perf_counter() - started
+    timings["transcription_segments"] = wall_seconds
+    timings["poll_count"] = sum(segment_timings.get("poll_count", 0) for _, segment_timings in outcomes)
+
+    texts = [result.get("text") or "" for result, _ in outcomes]
+    saved = estimate_time_saved([end - start for start, end in chunking["segments"]],
+                                [segment_timings["elapsed"] for _, segment_timings in outcomes],
+                                chunking["duration_seconds"], wall_seconds)
+    CHUNKED_SEGMENTS.observe(len(outcomes))
+    CHUNKED_SECONDS_SAVED.inc(saved["seconds_saved"])
+    CHUNKED_RESULTS.inc(outcome="ok")
+    print(f"Transcripción en {len(outcomes)} segmentos: {wall_seconds:.1f} s frente a ~{saved['estimated_single_file_seconds']:.1f} s "
+          f"estimados con un solo archivo ({saved['seconds_saved']:.1f} s ahorrados).")
+    return {
+        "id": outcomes[0][0]["id"],
+        "text": stitch_transcripts(texts),
+        "chunking": {
+            "segments": len(outcomes),
+            "segment_ids": [result["id"] for result, _ in outcomes],
+            "audio_seconds": round(chunking["duration_seconds"], 3),
+            **saved,
+        },
+    }
+
+async def _run_pipeline_stages(client: httpx.AsyncClient, audio_content: AudioSource | None, assemblyai_api_key: str,
+                               gemini_api_key: str, timings: dict, progress: dict, *,
+                               on_stage: Callable[[str], Awaitable[None]] | None, cache: ResultCache | None,
+                               audio_sha256: str | None, stage_limits: dict | None,
+                               poll_scheduler: TranscriptionPollScheduler | None, audio_path: str | None, preprocess: bool,
+                               on_section: SectionCallback | None = None, records: RecordStore | None = None) -> dict:
+    loop = asyncio.get_event_loop()
+    # El preprocesado y el troceado cambian la transcripción: cada combinación
+    # (con sus ajustes) tiene su propia entrada en la caché
+    cache_variant = (f"p{AUDIO_PREPROCESS_SETTINGS if preprocess and audio_path else 0}"
+                     f"-c{CHUNKED_TRANSCRIPTION_SETTINGS if audio_path and CHUNKED_TRANSCRIPTION_ENABLED else 0}")
+    cache_key = cache.key_for(audio_sha256, cache_variant) if cache is not None and audio_sha256 else None
+    if cache_key:
+        with stage_timer(timings, "cache_lookup"):
+            cached = await loop.run_in_executor(None, cache.get, cache_key)
+        if cached is not None:
+            print(f"--- Resultado en caché para el audio {audio_sha256[:12]} (transcripción {cached['transcript_id']}) ---")
+            if records is not None:
+                # Si el registro se corrigió (PATCH /registros/{id}), se devuelve la
+                # versión corregida y no la que quedó en la caché
+                with stage_timer(timings, "record_lookup"):
+                    record = await loop.run_in_executor(None, records.get, cached["transcript_id"])
+                    record_pdf = await loop.run_in_executor(None, records.read_pdf, record) if record else None
+                if record_pdf is not None:
+                    cached = dict(cached, extracted_json_data=record["data"], pdf_bytes=record_pdf,
+                                  pdf_filename=record["pdf_filename"])
+            if on_section is not None:
+                for section in sections_from_extraction(cached["extracted_json_data"]):
+                    await on_section(*section)
+            return {
+                "transcript_id": cached["transcript_id"],
+                "transcribed_text": cached["transcribed_text"],
+                "extracted_json_data": cached["extracted_json_data"],
+                "pdf_bytes": cached["pdf_bytes"],
+                "pdf_filename": cached["pdf_filename"],
+                "cache_hit": True,
+                "preprocessing": None,
+                "chunking": None,
+            }
+
+    preprocessing = None
+    audio_duration_hint = None
+    if preprocess and audio_path:
+        await _enter_stage(progress, on_stage, "preprocesando_audio")
+        with stage_timer(timings, "preprocess"):
+            preprocessing = await preprocess_audio_file(audio_path)
+        if preprocessing is not None:
+            audio_content = functools.partial(iter_file_chunks, preprocessing["path"])
+            audio_duration_hint = preprocessing["duration_seconds"]
+    elif preprocess:
+        print("Advertencia: el preprocesado necesita el audio en disco; se omite para esta petición.")
+
+    chunking = None
+    try:
+        if audio_path and CHUNKED_TRANSCRIPTION_ENABLED:
+            # Dictados largos: troceado en silencios y transcripción en paralelo
+            with stage_timer(timings, "segment_split"):
+                chunking = await prepare_segments(preprocessing["path"] if preprocessing else audio_path, audio_duration_hint)
+        if chunking is not None:
+            await _enter_stage(progress, on_stage, "transcribiendo_segmentos")
+            transcription_result = await _transcribe_segments(client, chunking, assemblyai_api_key, timings,
+                                                              stage_limits=stage_limits, poll_scheduler=poll_scheduler)
+        else:
+            if audio_content is None:
+                audio_content = functools.partial(iter_file_chunks, audio_path)
+            transcription_result = await _transcribe_audio(
+                client, audio_content, assemblyai_api_key, timings, progress, on_stage=on_stage,
+                stage_limits=stage_limits, poll_scheduler=poll_scheduler, audio_duration_hint=audio_duration_hint,
+            )
+    finally:
+        if preprocessing is not None:
+            shutil.rmtree(preprocessing["work_dir"], ignore_errors=True)
+        if chunking is not None:
+            shutil.rmtree(chunking["work_dir"], ignore_errors=True)
+    transcript_id = transcription_result["id"]
+    transcribed_text = transcription_result.get('text')
+    if not transcribed_text:
+        raise HTTPException(status_code=500, detail="La transcripción no produjo texto.")
+
+    rendered = await _analyze_and_render(transcript_id, transcribed_text, gemini_api_key, timings, progress,
+                                         on_stage=on_stage, stage_limits=stage_limits, on_section=on_section)
+    extracted_json_data, pdf_bytes, pdf_filename = rendered["extracted_json_data"], rendered["pdf_bytes"], rendered["pdf_filename"]
+    if cache_key:
+        await loop.run_in_executor(None, cache.put, cache_key, transcript_id, transcribed_text,
+                                   extracted_json_data, pdf_bytes, pdf_filename)
+
+    return {
+        "transcript_id": transcript_id,
+        "transcribed_text": transcribed_text,
+        "extracted_json_data": extracted_json_data,
+        "pdf_bytes": pdf_bytes,
+        "pdf_filename": pdf_filename,
+        "cache_hit": False,
+        "preprocessing": preprocessing,
+        "chunking": transcription_result.get("chunking"),
+    }
+
+async def _analyze_and_render(transcript_id: str, transcribed_text: str, gemini_api_key: str, timings: dict, progress: dict, *,
+                              on_stage: Callable[[str], Awaitable[None]] | None, stage_limits: dict | None,
+                              on_section: SectionCallback | None = None) -> dict:
+    print(f"--- Texto Transcrito (primeros 200 chars): {transcribed_text[:200]}... ---")
+
+    # Reglas locales (piezas FDI, hallazgos y tratamientos): prerrellenan y
+    # contrastan el odontograma de Gemini, o lo sustituyen si son concluyentes.
+    local_result = None
+    if LOCAL_EXTRACTION_ENABLED:
+        with stage_timer(timings, "local_extraction"):
+            local_result = extract_dental_findings(transcribed_text)
+
+    await _enter_stage(progress, on_stage, "analizando")
+    if local_result is not None and should_skip_llm(local_result):
+        print(f"--- Dictado corto explicado por las reglas locales ({len(local_result['odontograma'])} piezas); se omite Gemini ---")
+        LOCAL_EXTRACTION_RESULTS.inc(outcome="sin_llm")
+        extracted_json_data = local_result_to_extraction(local_result, transcribed_text, datetime.utcnow().isoformat() + "Z")
+        if on_section is not None:
+            for section in sections_from_extraction(extracted_json_data):
+                await on_section(*section)
+    else:
+        print("--- Iniciando Análisis con Gemini para extraer JSON ---")
+        async with _stage_limit(stage_limits, "gemini"):
+            extracted_json_data = await analyze_text_with_gemini(transcribed_text, transcript_id, gemini_api_key, timings=timings,
+                                                                 on_section=on_section)
+        if local_result is not None and isinstance(extracted_json_data, dict):
+            LOCAL_EXTRACTION_RESULTS.inc(outcome="contrastado" if local_result["odontograma"] else "sin_piezas")
+            added_teeth = merge_local_findings(extracted_json_data, local_result, transcript_id)
+            if on_section is not None:
+                for tooth in added_teeth:
+                    await on_section("odontograma", dict({"pieza": tooth}, **extracted_json_data["odontograma_completo"][tooth]))
+
+    if not isinstance(extracted_json_data, dict):
+        print(f"Error: Gemini no devolvió un diccionario JSON válido. Recibido: {type(extracted_json_data)}")
+        raise HTTPException(status_code=500, detail="La IA no generó una estructura de datos válida.")
+
+    if "texto_transcrito_original" not in extracted_json_data or not extracted_json_data["texto_transcrito_original"]:
+        extracted_json_data["texto_transcrito_original"] = transcribed_text
+
+    print("--- JSON Estructurado por Gemini (parcial): ---")
+    print(json.dumps(extracted_json_data, indent=2, ensure_ascii=False)[:500])
+
+    print("--- Generando PDF ---")
+    await _enter_stage(progress, on_stage, "generando_pdf")
+    async with _stage_limit(stage_limits, "pdf"):
+        with stage_timer(timings, "pdf_render"):
+            pdf_bytes = await render_pdf(extracted_json_data)
+    print(f"PDF generado en memoria ({len(pdf_bytes)} bytes).")
+    if not pdf_bytes:
+        raise HTTPException(status_code=500, detail="La generación del PDF resultó en un archivo vacío.")
+
+    return {
+        "extracted_json_data": extracted_json_data,
+        "pdf_bytes": pdf_bytes,
+        "pdf_filename": build_pdf_filename(extracted_json_data, transcript_id),
+    }
@@ -0,0 +1,56 @@
+# E:\PROJECTS\voice_test\realtime_client.py
+#
+# Cliente de ejemplo del dictado en tiempo real: envía un WAV (PCM 16 bits mono)
+# a /ws/dictado-a-pdf al ritmo real de reproducción, muestra la transcripción
+# según llega y guarda el PDF resultante. Uso:
+#   python realtime_client.py dictado.wav [ws://localhost:8000/ws/dictado-a-pdf]
+
+import sys
+import json
+import wave
+import asyncio
+import websockets
+
+FRAME_SECONDS = 0.1
+
+async def stream_wav(path: str, url: str) -> None:
+    with wave.open(path, "rb") as wav:
+        if wav.getnchannels() != 1 or wav.getsampwidth() != 2:
+            raise SystemExit("El WAV debe ser PCM de 16 bits mono (ffmpeg -i entrada -ac 1 -ar 16000 -sample_fmt s16 salida.wav).")
+        sample_rate = wav.getframerate()
+        frames = wav.readframes(wav.getnframes())
+
+    async with websockets.connect(f"{url}?sample_rate={sample_rate}", max_size=None) as ws:
+        async def sender():
+            step = int(sample_rate * FRAME_SECONDS) * 2
+            for i in range(0, len(frames), step):
+                await ws.send(frames[i:i + step])
+                await asyncio.sleep(FRAME_SECONDS)
+            await ws.send(json.dumps({"type": "fin"}))
+
+        send_task = asyncio.create_task(sender())
+        try:
+            pdf_filename = "dictado.pdf"
+            async for message in ws:
+                if isinstance(message, bytes):
+                    with open(pdf_filename, "wb") as f:
+                        f.write(message)
+                    print(f"PDF guardado en {pdf_filename} ({len(message)} bytes)")
+                    continue
+                data = json.loads(message)
+                if data["type"] == "parcial":
+                    print(f"  ... {data['texto']}")
+                elif data["type"] == "final":
+                    print(f"  >>> {data['texto']}")
+                elif data["type"] == "resultado":
+                    pdf_filename = data["pdf_filename"]
+                    print(f"Resultado: {data['transcript_id']} ({data['server_timing']})")
+                else:
+                    print(data)
+        finally:
+            send_task.cancel()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        raise SystemExit("Uso: python realtime_client.py dictado.wav [url]")
+    asyncio.run(stream_wav(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else "ws://localhost:8000/ws/dictado-a-pdf"))
@@ -0,0 +1,141 @@
+# E:\PROJECTS\voice_test\realtime_transcription.py
+
+import os
+import json
+import time
+import asyncio
+from typing import Awaitable, Callable
+from urllib.parse import urlencode
+from fastapi import HTTPException
+
+try:
+    import websockets
+except ImportError:  # dependencia opcional: sin ella solo deja de funcionar /ws/dictado-a-pdf
+    websockets = None
+
+from metrics import Counter, Gauge
+
+# Transcripción en tiempo real con la API de streaming de AssemblyAI (v3).
+# El audio se envía en tramas binarias PCM de 16 bits mono; AssemblyAI devuelve
+# mensajes "Turn" con el texto parcial y, al cerrar cada turno, el definitivo.
+ASSEMBLYAI_STREAMING_URL = os.getenv("ASSEMBLYAI_STREAMING_URL", "wss://streaming.assemblyai.com/v3/ws")
+ASSEMBLYAI_STREAMING_MODEL = os.getenv("ASSEMBLYAI_STREAMING_MODEL", "universal-streaming-multilingual")
+REALTIME_SAMPLE_RATE = int(os.getenv("REALTIME_SAMPLE_RATE", "16000"))
+REALTIME_CLOSE_TIMEOUT = float(os.getenv("REALTIME_CLOSE_TIMEOUT", "15"))
+
+REALTIME_UNAVAILABLE_DETAIL = "El dictado en tiempo real necesita el paquete 'websockets' (pip install websockets)."
+
+def realtime_available() -> bool:
+    return websockets is not None
+
+REALTIME_SESSIONS = Gauge("realtime_sessions_active", "Sesiones de dictado en tiempo real abiertas.")
+REALTIME_AUDIO_BYTES = Counter("realtime_audio_bytes_total", "Bytes de audio reenviados a la API de streaming.")
+REALTIME_TURNS = Counter("realtime_final_turns_total", "Turnos definitivos recibidos de la API de streaming.")
+
+class RealtimeTranscriber:
+    # Una sesión de streaming: connect(), send_audio() por cada trama y finish()
+    # al terminar, que devuelve el texto completo (turnos definitivos unidos).
+    # on_update(tipo, texto) se llama con "parcial" y "final" según llegan.
+
+    def __init__(self, api_key: str, sample_rate: int = REALTIME_SAMPLE_RATE,
+                 on_update: Callable[[str, str], Awaitable[None]] | None = None):
+        self.api_key = api_key
+        self.sample_rate = sample_rate
+        self.on_update = on_update
+        self.session_id: str | None = None
+        self.final_turns: list[str] = []
+        self.audio_bytes = 0
+        self.started = time.perf_counter()
+        self._ws = None
+        self._receiver: asyncio.Task | None = None
+        self._terminated = asyncio.Event()
+        self._error: str | None = None
+
+    async def connect(self) -> None:
+        if not realtime_available():
+            raise HTTPException(status_code=501, detail=REALTIME_UNAVAILABLE_DETAIL)
+        params = {"sample_rate": self.sample_rate, "encoding": "pcm_s16le", "format_turns": "true",
+                  "speech_model": ASSEMBLYAI_STREAMING_MODEL}
+        url = f"{ASSEMBLYAI_STREAMING_URL}?{urlencode(params)}"
+        try:
+            self._ws = await websockets.connect(url, additional_headers={"Authorization": self.api_key})
+        except Exception as e:
+            print(f"No se pudo abrir la sesión de streaming con AssemblyAI: {type(e).__name__} - {e}")
+            raise HTTPException(status_code=502, detail=f"No se pudo conectar con el streaming de AssemblyAI: {e}")
+        REALTIME_SESSIONS.inc()
+        self._receiver = asyncio.create_task(self._receive_loop())
+
+    async def _receive_loop(self) -> None:
+        try:
+            async for raw in self._ws:
+                message = json.loads(raw)
+                message_type = message.get("type")
+                if message_type == "Begin":
+                    self.session_id = message.get("id")
+                    print(f"Sesión de streaming de AssemblyAI iniciada: {self.session_id}")
+                elif message_type == "Turn":
+                    text = message.get("transcript", "")
+                    # Con format_turns el turno se repite ya formateado; ese es el definitivo
+                    if message.get("end_of_turn") and message.get("turn_is_formatted"):
+                        if text:
+                            self.final_turns.append(text)
+                            REALTIME_TURNS.inc()
+                        await self._notify("final", text)
+                    elif text:
+                        await self._notify("parcial", text)
+                elif message_type == "Termination":
+                    break
+                elif message_type == "Error" or "error" in message:
+                    self._error = str(message.get("error", message))
+                    print(f"Error de la API de streaming de AssemblyAI: {self._error}")
+                    break
+        except websockets.ConnectionClosed as e:
+            if e.rcvd is not None and e.rcvd.code != 1000:
+                self._error = f"conexión cerrada ({e.rcvd.code}: {e.rcvd.reason})"
+        finally:
+            self._terminated.set()
+
+    async def _notify(self, kind: str, text: str) -> None:
+        if self.on_update is None:
+            return
+        try:
+            await self.on_update(kind, text)
+        except Exception as e:
+            # El cliente puede haberse ido; la transcripción sigue hasta el cierre
+            print(f"No se pudo notificar el texto {kind} al cliente: {e}")
+
+    async def send_audio(self, chunk: bytes) -> None:
+        if self._error:
+            raise HTTPException(status_code=502, detail=f"Error en el streaming de AssemblyAI: {self._error}")
+        if self._terminated.is_set():
+            raise HTTPException(status_code=502, detail="La sesión de streaming de AssemblyAI se cerró antes de tiempo.")
+        self.audio_bytes += len(chunk)
+        REALTIME_AUDIO_BYTES.inc(len(chunk))
+        await self._ws.send(chunk)
+
+    async def finish(self) -> str:
+        # Pide a AssemblyAI que cierre la sesión (emite los turnos pendientes) y
+        # devuelve el texto completo.
+        try:
+            if not self._terminated.is_set():
+                await self._ws.send(json.dumps({"type": "Terminate"}))
+            await asyncio.wait_for(self._terminated.wait(), timeout=REALTIME_CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"AssemblyAI no cerró la sesión {self.session_id} en {REALTIME_CLOSE_TIMEOUT} s; se usa el texto recibido.")
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            await self.close()
+        if self._error and not self.final_turns:
+            raise HTTPException(status_code=502, detail=f"Error en el streaming de AssemblyAI: {self._error}")
+        return " ".join(self.final_turns)
+
+    async def close(self) -> None:
+        if self._ws is None:
+            return
+        ws, self._ws = self._ws, None
+        REALTIME_SESSIONS.dec()
+        if self._receiver is not None and not self._receiver.done():
+            self._receiver.cancel()
+            await asyncio.gather(self._receiver, return_exceptions=True)
+        await ws.close()
@@ -0,0 +1,214 @@
+# E:\PROJECTS\voice_test\record_store.py
+
+import os
+import json
+import time
+import uuid
+import hashlib
+import sqlite3
+
+from extraction_schema import GEMINI_RESPONSE_SCHEMA, TOOTH_SCHEMA
+from local_extraction import is_valid_fdi
+from metrics import Counter
+
+# Registros editables: el diccionario final de cada dictado (tras Gemini y las
+# reglas locales) y su último PDF, por id de transcripción. Una corrección
+# (PATCH) aplica cambios campo a campo y vuelve a generar solo el PDF, sin
+# repetir la subida, la transcripción ni Gemini. Cada versión tiene un ETag
+# para GET condicionales (If-None-Match) y escrituras condicionales (If-Match).
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    transcript_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    etag TEXT NOT NULL,
+    pdf_path TEXT NOT NULL,
+    pdf_filename TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+# Campos editables y su tipo, sacados del esquema de respuesta de Gemini
+_FIELD_TYPES = {key: schema["type"] for key, schema in GEMINI_RESPONSE_SCHEMA["properties"].items()}
+_TOOTH_FIELDS = tuple(key for key in TOOTH_SCHEMA["properties"] if key != "pieza")
+
+RECORD_EDITS = Counter("record_edits_total", "Correcciones de registros por resultado (ok, sin_cambios, invalida, conflicto).",
+                       ("outcome",))
+
+class RecordEditError(ValueError):
+    pass
+
+def record_etag(data: dict, version: int) -> str:
+    digest = hashlib.sha256(json.dumps(data, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+    return f'"{version}-{digest[:16]}"'
+
+def _check_text(value, where: str) -> str:
+    if not isinstance(value, str):
+        raise RecordEditError(f"'{where}' debe ser texto.")
+    return value
+
+def apply_record_edits(data: dict, edits: dict) -> dict:
+    # Aplica una corrección con la semántica de JSON Merge Patch (RFC 7396):
+    # los campos presentes sustituyen a los actuales, null los vacía, y en
+    # odontograma_completo cada pieza se fusiona por separado (null la elimina).
+    # Para corregir un número de pieza: {"odontograma_completo": {"36": null, "46": {...}}}.
+    if not isinstance(edits, dict) or not edits:
+        raise RecordEditError("La corrección debe ser un objeto JSON con al menos un campo.")
+    updated = json.loads(json.dumps(data))
+    for field, value in edits.items():
+        field_type = _FIELD_TYPES.get(field)
+        if field_type is None:
+            raise RecordEditError(f"Campo desconocido: '{field}'.")
+        if field == "odontograma_completo":
+            if value is None:
+                updated[field] = {}
+                continue
+            if not isinstance(value, dict):
+                raise RecordEditError("'odontograma_completo' debe ser un objeto {pieza: {...}}.")
+            odontogram = updated.setdefault(field, {})
+            for tooth, entry in value.items():
+                if entry is None:
+                    odontogram.pop(tooth, None)
+                    continue
+                if not tooth.isdigit() or not is_valid_fdi(int(tooth)):
+                    raise RecordEditError(f"'{tooth}' no es un número de pieza FDI válido.")
+                if not isinstance(entry, dict):
+                    raise RecordEditError(f"La pieza '{tooth}' debe ser un objeto.")
+                target = odontogram.setdefault(tooth, {name: "" for name in _TOOTH_FIELDS})
+                for name, text in entry.items():
+                    if name not in _TOOTH_FIELDS:
+                        raise RecordEditError(f"Campo de pieza desconocido: '{name}'.")
+                    target[name] = "" if text is None else _check_text(text, f"{tooth}.{name}")
+        elif value is None:
+            updated[field] = [] if field_type == "ARRAY" else ""
+        elif field_type == "ARRAY":
+            if not isinstance(value, list):
+                raise RecordEditError(f"'{field}' debe ser una lista.")
+            for item in value:
+                if not isinstance(item, (str, dict)):
+                    raise RecordEditError(f"Los elementos de '{field}' deben ser texto u objetos.")
+            updated[field] = value
+        else:
+            updated[field] = _check_text(value, field)
+    return updated
+
+class RecordStore:
+    # SQLite (modo WAL) compartido por los procesos de uvicorn y los PDF en
+    # data_dir/pdf, con un archivo por versión: el registro apunta al PDF de
+    # su versión y el anterior se borra después de actualizarlo.
+
+    def __init__(self, data_dir: str):
+        self.data_dir = data_dir
+        self.pdf_dir = os.path.join(data_dir, "pdf")
+        self.db_path = os.path.join(data_dir, "registros.sqlite3")
+        os.makedirs(self.pdf_dir, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30.0, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _write_pdf(self, transcript_id: str, version: int, pdf_bytes: bytes) -> str:
+        safe_id = "".join(c if c.isalnum() or c in "-_" else "_" for c in transcript_id)
+        # Sufijo aleatorio: dos correcciones simultáneas no escriben el mismo archivo
+        pdf_path = os.path.join(self.pdf_dir, f"{safe_id}.v{version}.{uuid.uuid4().hex[:8]}.pdf")
+        tmp_path = f"{pdf_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(pdf_bytes)
+        os.replace(tmp_path, pdf_path)
+        return pdf_path
+
+    def _remove_pdf(self, pdf_path: str | None) -> None:
+        if not pdf_path:
+            return
+        try:
+            os.remove(pdf_path)
+        except FileNotFoundError:
+            pass
+
+    def save(self, transcript_id: str, data: dict, pdf_bytes: bytes, pdf_filename: str, replace: bool = True) -> dict | None:
+        # Guarda el resultado de un análisis. replace=False (p. ej. un acierto de
+        # caché) no toca un registro existente, que puede tener correcciones.
+        # Como update(), la escritura se condiciona a la versión leída: si una
+        # corrección (u otro análisis) la cambió entretanto, no se sobrescribe
+        # y devuelve None.
+        current = self.get(transcript_id)
+        if current is not None and not replace:
+            return None
+        version = current["version"] + 1 if current else 1
+        pdf_path = self._write_pdf(transcript_id, version, pdf_bytes)
+        etag = record_etag(data, version)
+        now = time.time()
+        conn = self._connect()
+        try:
+            if current is None:
+                cursor = conn.execute(
+                    "INSERT INTO records (transcript_id, data, version, etag, pdf_path, pdf_filename, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(transcript_id) DO NOTHING",
+                    (transcript_id, json.dumps(data, ensure_ascii=False), version, etag, pdf_path, pdf_filename, now, now),
+                )
+            else:
+                cursor = conn.execute(
+                    "UPDATE records SET data = ?, version = ?, etag = ?, pdf_path = ?, pdf_filename = ?, updated_at = ? "
+                    "WHERE transcript_id = ? AND version = ?",
+                    (json.dumps(data, ensure_ascii=False), version, etag, pdf_path, pdf_filename, now,
+                     transcript_id, current["version"]),
+                )
+        finally:
+            conn.close()
+        if cursor.rowcount == 0:
+            print(f"Registro {transcript_id}: cambió mientras se guardaba el análisis; se conserva la versión actual.")
+            self._remove_pdf(pdf_path)
+            return None
+        if current is not None:
+            self._remove_pdf(current["pdf_path"])
+        return {"transcript_id": transcript_id, "version": version, "etag": etag}
+
+    def update(self, current: dict, data: dict, pdf_bytes: bytes, pdf_filename: str) -> dict | None:
+        # Sustituye la versión "current" por una nueva. Devuelve None si otro
+        # proceso la cambió entretanto (comparación por versión).
+        version = current["version"] + 1
+        pdf_path = self._write_pdf(current["transcript_id"], version, pdf_bytes)
+        etag = record_etag(data, version)
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                "UPDATE records SET data = ?, version = ?, etag = ?, pdf_path = ?, pdf_filename = ?, updated_at = ? "
+                "WHERE transcript_id = ? AND version = ?",
+                (json.dumps(data, ensure_ascii=False), version, etag, pdf_path, pdf_filename, time.time(),
+                 current["transcript_id"], current["version"]),
+            )
+        finally:
+            conn.close()
+        if cursor.rowcount == 0:
+            self._remove_pdf(pdf_path)
+            return None
+        self._remove_pdf(current["pdf_path"])
+        return self.get(current["transcript_id"])
+
+    def get(self, transcript_id: str) -> dict | None:
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT * FROM records WHERE transcript_id = ?", (transcript_id,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        record = dict(row)
+        record["data"] = json.loads(record["data"])
+        return record
+
+    def read_pdf(self, record: dict) -> bytes | None:
+        try:
+            with open(record["pdf_path"], "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
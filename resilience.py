@@ -0,0 +1,213 @@
+# E:\PROJECTS\voice_test\resilience.py
+
+import os
+import time
+import random
+import asyncio
+from typing import Awaitable, Callable, TypeVar
+import httpx
+from fastapi import HTTPException
+
+from metrics import Counter, Gauge
+
+# Capa de resiliencia compartida para las llamadas a AssemblyAI y Gemini:
+# reintentos con backoff y jitter, un circuit breaker por servicio y
+# peticiones "hedged" (duplicadas tras un retardo) opcionales.
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "8"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+# Segundos tras los que se lanza una segunda petición idéntica a Gemini (0 = desactivado)
+GEMINI_HEDGE_AFTER_SECONDS = float(os.getenv("GEMINI_HEDGE_AFTER_SECONDS", "0"))
+
+# Códigos HTTP que indican un fallo transitorio del servicio
+RETRYABLE_STATUS_CODES = frozenset({408, 425, 429, 500, 502, 503, 504})
+# Con estos códigos (o sin conexión) la petición no llegó a procesarse y se
+# puede repetir aunque no sea idempotente
+_NOT_PROCESSED_STATUS_CODES = frozenset({429, 503})
+
+UPSTREAM_ATTEMPTS = Counter("upstream_attempts_total", "Intentos de llamada a servicios externos por resultado.",
+                            ("upstream", "operation", "outcome"))
+UPSTREAM_RETRIES = Counter("upstream_retries_total", "Reintentos de llamadas a servicios externos.", ("upstream", "operation"))
+CIRCUIT_STATE = Gauge("upstream_circuit_state", "Estado del circuit breaker (0 cerrado, 1 semiabierto, 2 abierto).", ("upstream",))
+CIRCUIT_REJECTIONS = Counter("upstream_circuit_rejections_total", "Llamadas rechazadas con el circuito abierto.", ("upstream",))
+HEDGED_REQUESTS = Counter("upstream_hedged_requests_total",
+                          "Peticiones duplicadas lanzadas y cuál respondió antes (primary/hedge).", ("upstream", "outcome"))
+
+T = TypeVar("T")
+
+class UpstreamUnavailable(HTTPException):
+    # El circuito del servicio está abierto: se falla rápido con 503 y Retry-After.
+
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(status_code=503,
+                         detail=f"El servicio {upstream} no está disponible temporalmente; se reintentará más tarde.",
+                         headers={"Retry-After": str(max(1, int(retry_after + 0.999)))})
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+def _status_code(exc: BaseException) -> int | None:
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code
+    # Las excepciones de google.api_core exponen el código HTTP en .code
+    code = getattr(exc, "code", None)
+    return code if isinstance(code, int) else None
+
+def is_transient_error(exc: BaseException) -> bool:
+    if isinstance(exc, httpx.TransportError):
+        return True
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    return _status_code(exc) in RETRYABLE_STATUS_CODES
+
+def _safe_to_repeat(exc: BaseException, idempotent: bool) -> bool:
+    if idempotent:
+        return is_transient_error(exc)
+    if isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True
+    return _status_code(exc) in _NOT_PROCESSED_STATUS_CODES
+
+def _retry_after_seconds(exc: BaseException) -> float | None:
+    if isinstance(exc, httpx.HTTPStatusError):
+        value = exc.response.headers.get("retry-after")
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            return None
+    return None
+
+class CircuitBreaker:
+    # Cerrado -> abierto tras failure_threshold fallos transitorios seguidos;
+    # abierto -> semiabierto pasados reset_seconds, donde se deja pasar una única
+    # llamada de prueba que vuelve a cerrar o abrir el circuito.
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, upstream: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_seconds: float = CIRCUIT_RESET_SECONDS):
+        self.upstream = upstream
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        CIRCUIT_STATE.set(self.state, upstream=upstream)
+
+    def _set_state(self, state: int) -> None:
+        if state != self.state:
+            print(f"Circuit breaker de {self.upstream}: {('cerrado', 'semiabierto', 'abierto')[self.state]} -> "
+                  f"{('cerrado', 'semiabierto', 'abierto')[state]}")
+        self.state = state
+        CIRCUIT_STATE.set(state, upstream=self.upstream)
+
+    def before_call(self) -> None:
+        if self.state == self.OPEN:
+            remaining = self.opened_at + self.reset_seconds - time.monotonic()
+            if remaining > 0:
+                CIRCUIT_REJECTIONS.inc(upstream=self.upstream)
+                raise UpstreamUnavailable(self.upstream, remaining)
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN:
+            if self._probe_in_flight:
+                CIRCUIT_REJECTIONS.inc(upstream=self.upstream)
+                raise UpstreamUnavailable(self.upstream, self.reset_seconds)
+            self._probe_in_flight = True
+
+    def record_success(self) -> None:
+        self._probe_in_flight = False
+        self.consecutive_failures = 0
+        self._set_state(self.CLOSED)
+
+    def record_failure(self) -> None:
+        self._probe_in_flight = False
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._set_state(self.OPEN)
+
+    def record_ignored(self) -> None:
+        # Error no atribuible al servicio (p. ej. 4xx): no cuenta como fallo.
+        self._probe_in_flight = False
+
+    def snapshot(self) -> dict:
+        return {"estado": ("cerrado", "semiabierto", "abierto")[self.state], "fallos_consecutivos": self.consecutive_failures}
+
+_breakers: dict[str, CircuitBreaker] = {}
+
+def get_circuit_breaker(upstream: str) -> CircuitBreaker:
+    breaker = _breakers.get(upstream)
+    if breaker is None:
+        breaker = _breakers[upstream] = CircuitBreaker(upstream)
+    return breaker
+
+def circuit_breakers_snapshot() -> dict:
+    return {name: breaker.snapshot() for name, breaker in _breakers.items()}
+
+def backoff_delay(attempt: int, base_delay: float = RETRY_BASE_DELAY, max_delay: float = RETRY_MAX_DELAY) -> float:
+    # Backoff exponencial con "full jitter"
+    return random.uniform(0, min(max_delay, base_delay * (2 ** (attempt - 1))))
+
+async def call_with_resilience(upstream: str, operation: str, func: Callable[[], Awaitable[T]], *, idempotent: bool = True,
+                               max_attempts: int = RETRY_MAX_ATTEMPTS) -> T:
+    # Ejecuta func() pasando por el circuit breaker del servicio y lo repite ante
+    # fallos transitorios. Si la operación no es idempotente solo se repite cuando
+    # consta que el servicio no la procesó (sin conexión, 429 o 503).
+    breaker = get_circuit_breaker(upstream)
+    attempt = 0
+    while True:
+        attempt += 1
+        breaker.before_call()
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            breaker.record_ignored()
+            raise
+        except Exception as e:
+            if not is_transient_error(e):
+                breaker.record_ignored()
+                UPSTREAM_ATTEMPTS.inc(upstream=upstream, operation=operation, outcome="error")
+                raise
+            breaker.record_failure()
+            UPSTREAM_ATTEMPTS.inc(upstream=upstream, operation=operation, outcome="transitorio")
+            if attempt >= max_attempts or not _safe_to_repeat(e, idempotent):
+                raise
+            delay = _retry_after_seconds(e)
+            delay = min(RETRY_MAX_DELAY, delay) if delay is not None else backoff_delay(attempt)
+            print(f"{upstream}/{operation}: fallo transitorio ({type(e).__name__}: {e}); reintento {attempt}/{max_attempts - 1} "
+                  f"en {delay:.2f} s")
+            UPSTREAM_RETRIES.inc(upstream=upstream, operation=operation)
+            await asyncio.sleep(delay)
+            continue
+        breaker.record_success()
+        UPSTREAM_ATTEMPTS.inc(upstream=upstream, operation=operation, outcome="ok")
+        return result
+
+async def hedged(upstream: str, func: Callable[[], Awaitable[T]], hedge_after: float) -> T:
+    # Lanza func(); si no ha terminado en hedge_after segundos lanza una segunda
+    # copia y devuelve la primera que termine bien. La otra se cancela (si corre
+    # en un hilo del executor, su resultado simplemente se descarta).
+    if hedge_after <= 0:
+        return await func()
+    primary = asyncio.ensure_future(func())
+    done, _ = await asyncio.wait({primary}, timeout=hedge_after)
+    if done:
+        return primary.result()
+
+    HEDGED_REQUESTS.inc(upstream=upstream, outcome="launched")
+    hedge = asyncio.ensure_future(func())
+    pending = {primary, hedge}
+    error: BaseException | None = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    HEDGED_REQUESTS.inc(upstream=upstream, outcome="primary" if task is primary else "hedge")
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in (primary, hedge):
+            if not task.done():
+                task.cancel()
@@ -0,0 +1,160 @@
+# E:\PROJECTS\voice_test\result_cache.py
+
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+class ResultCache:
+    # Caché direccionada por contenido: la clave es el SHA-256 del audio más la
+    # versión del prompt de Gemini y la variante de transcripción (preprocesado
+    # y troceado con sus ajustes). Un reintento del mismo audio devuelve la
+    # transcripción, el JSON extraído y el PDF sin llamar a AssemblyAI ni a Gemini.
+    #
+    # Dos niveles: LRU en memoria limitado por bytes y disco persistente con TTL
+    # (compartido entre procesos de uvicorn).
+
+    def __init__(self, disk_dir: str, prompt_version: str, memory_max_bytes: int = 64 * 1024 * 1024,
+                 ttl_seconds: float = 7 * 24 * 3600):
+        self.disk_dir = disk_dir
+        self.prompt_version = prompt_version
+        self.memory_max_bytes = memory_max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._memory: OrderedDict[str, dict] = OrderedDict()
+        self._memory_sizes: dict[str, int] = {}
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0}
+        os.makedirs(self.disk_dir, exist_ok=True)
+
+    def key_for(self, audio_sha256: str, variant: str = "") -> str:
+        return f"{audio_sha256}-{self.prompt_version}-{variant}" if variant else f"{audio_sha256}-{self.prompt_version}"
+
+    def get(self, key: str) -> dict | None:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if time.time() - entry["created_at"] <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return entry
+                self._evict_memory(key)
+                self.stats["expired"] += 1
+
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["disk_hits"] += 1
+            self._put_memory(key, entry)
+        return entry
+
+    def put(self, key: str, transcript_id: str, transcribed_text: str, extracted_json_data: dict,
+            pdf_bytes: bytes, pdf_filename: str) -> None:
+        entry = {
+            "transcript_id": transcript_id,
+            "transcribed_text": transcribed_text,
+            "extracted_json_data": extracted_json_data,
+            "pdf_bytes": bytes(pdf_bytes),
+            "pdf_filename": pdf_filename,
+            "prompt_version": self.prompt_version,
+            "created_at": time.time(),
+        }
+        self._write_disk(key, entry)
+        with self._lock:
+            self._put_memory(key, entry)
+            self.stats["stores"] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats, memory_entries=len(self._memory), memory_bytes=self._memory_bytes,
+                        memory_max_bytes=self.memory_max_bytes, prompt_version=self.prompt_version)
+
+    # --- Nivel en memoria (llamar con self._lock tomado) ---
+    def _put_memory(self, key: str, entry: dict) -> None:
+        size = len(entry["pdf_bytes"]) + len(entry["transcribed_text"].encode("utf-8")) + 1024
+        if size > self.memory_max_bytes:
+            return
+        if key in self._memory:
+            self._evict_memory(key)
+        self._memory[key] = entry
+        self._memory_sizes[key] = size
+        self._memory_bytes += size
+        while self._memory_bytes > self.memory_max_bytes and self._memory:
+            oldest_key = next(iter(self._memory))
+            self._evict_memory(oldest_key)
+            self.stats["evictions"] += 1
+
+    def _evict_memory(self, key: str) -> None:
+        self._memory.pop(key, None)
+        self._memory_bytes -= self._memory_sizes.pop(key, 0)
+
+    # --- Nivel en disco ---
+    def _paths(self, key: str) -> tuple[str, str]:
+        return os.path.join(self.disk_dir, f"{key}.json"), os.path.join(self.disk_dir, f"{key}.pdf")
+
+    def _read_disk(self, key: str) -> dict | None:
+        meta_path, pdf_path = self._paths(key)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("prompt_version") != self.prompt_version:
+                return None
+            if time.time() - meta.get("created_at", 0) > self.ttl_seconds:
+                self._remove_disk(key)
+                with self._lock:
+                    self.stats["expired"] += 1
+                return None
+            with open(pdf_path, "rb") as f:
+                meta["pdf_bytes"] = f.read()
+            return meta
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Advertencia: entrada de caché '{key}' ilegible, se descarta: {e}")
+            self._remove_disk(key)
+            return None
+
+    def _write_disk(self, key: str, entry: dict) -> None:
+        meta_path, pdf_path = self._paths(key)
+        meta = {k: v for k, v in entry.items() if k != "pdf_bytes"}
+        try:
+            # Escritura atómica: primero el PDF, después los metadatos que lo referencian.
+            tmp_pdf = f"{pdf_path}.{os.getpid()}.tmp"
+            with open(tmp_pdf, "wb") as f:
+                f.write(entry["pdf_bytes"])
+            os.replace(tmp_pdf, pdf_path)
+            tmp_meta = f"{meta_path}.{os.getpid()}.tmp"
+            with open(tmp_meta, "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(tmp_meta, meta_path)
+        except OSError as e:
+            print(f"Advertencia: no se pudo escribir la entrada de caché '{key}' en disco: {e}")
+
+    def _remove_disk(self, key: str) -> None:
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def purge_expired(self) -> int:
+        # Limpia del disco las entradas caducadas o de otra versión del prompt.
+        removed = 0
+        now = time.time()
+        for name in os.listdir(self.disk_dir):
+            if not name.endswith(".json"):
+                continue
+            key = name[:-len(".json")]
+            try:
+                with open(os.path.join(self.disk_dir, name), "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                stale = meta.get("prompt_version") != self.prompt_version or now - meta.get("created_at", 0) > self.ttl_seconds
+            except (OSError, ValueError):
+                stale = True
+            if stale:
+                self._remove_disk(key)
+                removed += 1
+        return removed
\ No newline at end of file
@@ -0,0 +1,54 @@
+# E:\PROJECTS\voice_test\sse_events.py
+
+import os
+import json
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+# Utilidades para el dictado con progreso por Server-Sent Events: formato de
+# los eventos y un almacén en memoria de los PDF generados, que se descargan
+# después por el enlace del evento "resultado".
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", "15"))
+SSE_RESULT_TTL_SECONDS = float(os.getenv("SSE_RESULT_TTL_SECONDS", "600"))
+SSE_RESULT_MAX_ENTRIES = int(os.getenv("SSE_RESULT_MAX_ENTRIES", "100"))
+
+def format_sse_event(event: str, data: dict) -> str:
+    # Un evento SSE con nombre y datos JSON en una sola línea
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+SSE_KEEPALIVE_COMMENT = ": ping\n\n"
+
+class StreamedPdfStore:
+    # PDF recientes por id aleatorio, con caducidad y número máximo de entradas
+    # (se descartan primero los más antiguos). Es local al proceso.
+
+    def __init__(self, ttl_seconds: float = SSE_RESULT_TTL_SECONDS, max_entries: int = SSE_RESULT_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, str, bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, pdf_filename: str, pdf_bytes: bytes) -> str:
+        result_id = uuid.uuid4().hex
+        with self._lock:
+            self._purge_expired()
+            self._entries[result_id] = (time.monotonic() + self.ttl_seconds, pdf_filename, pdf_bytes)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return result_id
+
+    def get(self, result_id: str) -> tuple[str, bytes] | None:
+        with self._lock:
+            self._purge_expired()
+            entry = self._entries.get(result_id)
+        return (entry[1], entry[2]) if entry else None
+
+    def _purge_expired(self) -> None:
+        now = time.monotonic()
+        while self._entries:
+            result_id, (expires_at, _, _) = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            self._entries.popitem(last=False)
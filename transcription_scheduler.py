@@ -0,0 +1,243 @@
+# E:\PROJECTS\voice_test\transcription_scheduler.py
+
+import time
+import random
+import asyncio
+import httpx
+from fastapi import HTTPException
+
+from assemblyai_service import fetch_transcription_status, is_transcription_complete, record_poll_timings
+from resilience import UpstreamUnavailable
+from metrics import Gauge, Counter
+from webhook_inbox import WebhookInbox
+
+TRANSCRIPTS_PENDING = Gauge("assemblyai_transcripts_pending", "Transcripciones que el planificador está esperando.")
+SCHEDULER_POLLS = Counter("assemblyai_scheduler_polls_total", "Consultas de estado hechas por el planificador, por resultado.", ("status",))
+WEBHOOKS_RECEIVED = Counter("assemblyai_webhooks_total", "Webhooks de AssemblyAI recibidos, por destino (local o buzon compartido).", ("target",))
+
+class _PendingTranscript:
+    __slots__ = ("transcript_id", "future", "timings", "started", "processing_since", "poll_count",
+                 "next_poll_at", "deadline_at", "audio_duration", "in_flight", "waiters", "via_webhook")
+
+    def __init__(self, transcript_id: str, future: asyncio.Future, timings: dict | None, deadline_at: float,
+                 audio_duration: float | None, via_webhook: bool = False):
+        self.transcript_id = transcript_id
+        self.future = future
+        self.timings = timings
+        self.started = time.perf_counter()
+        self.processing_since = None
+        self.poll_count = 0
+        self.next_poll_at = 0.0
+        self.deadline_at = deadline_at
+        self.audio_duration = audio_duration
+        self.in_flight = False
+        self.waiters = 0
+        self.via_webhook = via_webhook
+
+class TranscriptionPollScheduler:
+    # Un único bucle en segundo plano sondea todas las transcripciones pendientes.
+    # Cada petición espera en un future; el intervalo se adapta a la duración del
+    # audio y al tiempo transcurrido, con backoff exponencial y jitter, y hay un
+    # plazo máximo por transcripción.
+    #
+    # En modo webhook AssemblyAI avisa al terminar: el aviso adelanta la consulta
+    # de esa transcripción y el sondeo queda como respaldo lento por si se pierde.
+
+    def __init__(self, client: httpx.AsyncClient, api_key: str, min_interval: float = 1.0, max_interval: float = 15.0,
+                 backoff: float = 1.5, jitter: float = 0.2, deadline_seconds: float = 900.0, max_concurrent_polls: int = 20,
+                 processing_ratio: float = 0.25, webhook_url: str | None = None, webhook_secret: str | None = None,
+                 webhook_inbox: WebhookInbox | None = None, webhook_fallback_interval: float = 30.0,
+                 inbox_check_interval: float = 1.0):
+        self.client = client
+        self.api_key = api_key
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.deadline_seconds = deadline_seconds
+        # Fracción de la duración del audio que suele tardar AssemblyAI en procesarlo
+        self.processing_ratio = processing_ratio
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.webhook_inbox = webhook_inbox
+        self.webhook_fallback_interval = webhook_fallback_interval
+        self.inbox_check_interval = inbox_check_interval
+        self._next_inbox_check = 0.0
+        self._poll_slots = asyncio.Semaphore(max_concurrent_polls)
+        self._pending: dict[str, _PendingTranscript] = {}
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._poll_tasks: set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="transcription-poll-scheduler")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for task in list(self._poll_tasks):
+            task.cancel()
+        await asyncio.gather(*self._poll_tasks, return_exceptions=True)
+        for entry in list(self._pending.values()):
+            if not entry.future.done():
+                entry.future.set_exception(HTTPException(status_code=503, detail="El servidor se está deteniendo."))
+        self._pending.clear()
+        TRANSCRIPTS_PENDING.set(0)
+
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    @property
+    def webhook_enabled(self) -> bool:
+        return bool(self.webhook_url)
+
+    async def wait_for(self, transcript_id: str, timings: dict | None = None, audio_duration_hint: float | None = None,
+                       deadline_seconds: float | None = None, via_webhook: bool = False) -> dict:
+        loop = asyncio.get_event_loop()
+        entry = self._pending.get(transcript_id)
+        if entry is None:
+            deadline = time.monotonic() + (deadline_seconds or self.deadline_seconds)
+            entry = _PendingTranscript(transcript_id, loop.create_future(), timings, deadline, audio_duration_hint,
+                                       via_webhook=via_webhook)
+            entry.next_poll_at = time.monotonic() + self._next_interval(entry)
+            self._pending[transcript_id] = entry
+            TRANSCRIPTS_PENDING.set(len(self._pending))
+            self._wakeup.set()
+        entry.waiters += 1
+        try:
+            # shield: si se cancela esta espera (cliente desconectado) el future
+            # sigue vivo para otros que esperen la misma transcripción.
+            return await asyncio.shield(entry.future)
+        finally:
+            entry.waiters -= 1
+            if entry.waiters <= 0:
+                if not entry.future.done():
+                    entry.future.cancel()
+                self._discard(transcript_id, entry)
+
+    def notify_webhook(self, transcript_id: str, status: str) -> bool:
+        # Aviso de AssemblyAI: si la transcripción se espera en este proceso se
+        # consulta de inmediato (el webhook no trae el texto). Devuelve False si no
+        # es de este proceso, para que el receptor la deje en el buzón compartido.
+        entry = self._pending.get(transcript_id)
+        if entry is None:
+            return False
+        print(f"Webhook de AssemblyAI para {transcript_id} (estado: {status}); consultando resultado.")
+        entry.next_poll_at = 0.0
+        self._wakeup.set()
+        return True
+
+    def resolve(self, transcript_id: str, result: dict) -> bool:
+        # Completa una espera con un resultado obtenido por otra vía (p. ej. webhook).
+        entry = self._pending.get(transcript_id)
+        if entry is None or entry.future.done():
+            return False
+        self._finish(entry, result)
+        return True
+
+    def _discard(self, transcript_id: str, entry: _PendingTranscript) -> None:
+        if self._pending.get(transcript_id) is entry:
+            del self._pending[transcript_id]
+            TRANSCRIPTS_PENDING.set(len(self._pending))
+
+    def _finish(self, entry: _PendingTranscript, result: dict | None = None, error: Exception | None = None) -> None:
+        if entry.future.done():
+            return
+        if error is not None:
+            entry.future.set_exception(error)
+        else:
+            record_poll_timings(entry.timings, entry.started, entry.processing_since, entry.poll_count)
+            entry.future.set_result(result)
+        self._discard(entry.transcript_id, entry)
+
+    def _next_interval(self, entry: _PendingTranscript) -> float:
+        if entry.via_webhook:
+            # Sondeo lento de respaldo por si el webhook no llega
+            return self.webhook_fallback_interval * (1 + random.uniform(-self.jitter, self.jitter))
+        interval = min(self.max_interval, self.min_interval * (self.backoff ** entry.poll_count))
+        if entry.audio_duration:
+            # No tiene sentido sondear mucho antes de que el audio pueda estar listo:
+            # se espera hasta la mitad del tiempo restante estimado.
+            elapsed = time.perf_counter() - entry.started
+            expected_remaining = entry.audio_duration * self.processing_ratio - elapsed
+            if expected_remaining > 0:
+                interval = max(interval, min(self.max_interval, expected_remaining / 2))
+        interval *= 1 + random.uniform(-self.jitter, self.jitter)
+        return max(0.2, interval)
+
+    async def _check_inbox(self) -> None:
+        ids = [e.transcript_id for e in self._pending.values() if e.via_webhook and not e.in_flight]
+        if not ids:
+            return
+        loop = asyncio.get_event_loop()
+        try:
+            events = await loop.run_in_executor(None, self.webhook_inbox.take, ids)
+        except Exception as e:
+            print(f"Error al leer el buzón de webhooks: {type(e).__name__} - {e}")
+            return
+        for transcript_id, status in events.items():
+            self.notify_webhook(transcript_id, status)
+
+    async def _run(self) -> None:
+        while True:
+            if self.webhook_inbox is not None and time.monotonic() >= self._next_inbox_check:
+                await self._check_inbox()
+                self._next_inbox_check = time.monotonic() + self.inbox_check_interval
+            now = time.monotonic()
+            due = [e for e in self._pending.values() if not e.in_flight and e.next_poll_at <= now]
+            for entry in due:
+                if now >= entry.deadline_at:
+                    print(f"Plazo agotado esperando la transcripción {entry.transcript_id} ({entry.poll_count} consultas).")
+                    self._finish(entry, error=HTTPException(status_code=504, detail=f"AssemblyAI no completó la transcripción {entry.transcript_id} dentro del plazo."))
+                    continue
+                entry.in_flight = True
+                task = asyncio.create_task(self._poll_one(entry))
+                self._poll_tasks.add(task)
+                task.add_done_callback(self._poll_tasks.discard)
+
+            waiting = [e.next_poll_at for e in self._pending.values() if not e.in_flight]
+            if self.webhook_inbox is not None and any(e.via_webhook for e in self._pending.values()):
+                waiting.append(self._next_inbox_check)
+            timeout = max(0.0, min(waiting) - time.monotonic()) if waiting else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll_one(self, entry: _PendingTranscript) -> None:
+        try:
+            async with self._poll_slots:
+                if entry.future.done():
+                    return
+                result = await fetch_transcription_status(self.client, entry.transcript_id, self.api_key)
+            entry.poll_count += 1
+            SCHEDULER_POLLS.inc(status=result.get('status', 'desconocido'))
+            if result.get('status') == 'processing' and entry.processing_since is None:
+                entry.processing_since = time.perf_counter()
+            if result.get('audio_duration') and not entry.audio_duration:
+                entry.audio_duration = float(result['audio_duration'])
+            if is_transcription_complete(result):
+                print(f"Transcripción {entry.transcript_id} completada tras {entry.poll_count} consultas.")
+                self._finish(entry, result)
+                return
+            entry.next_poll_at = time.monotonic() + self._next_interval(entry)
+        except UpstreamUnavailable as e:
+            # Circuito abierto: la transcripción sigue pendiente en AssemblyAI, se
+            # vuelve a consultar cuando el circuito admita llamadas (o vence el plazo).
+            SCHEDULER_POLLS.inc(status="circuito_abierto")
+            entry.next_poll_at = time.monotonic() + max(self.min_interval, e.retry_after)
+        except HTTPException as e:
+            SCHEDULER_POLLS.inc(status="error")
+            self._finish(entry, error=e)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            SCHEDULER_POLLS.inc(status="error")
+            self._finish(entry, error=HTTPException(status_code=500, detail=f"Error interno al obtener resultado: {str(e)}"))
+        finally:
+            entry.in_flight = False
+            self._wakeup.set()
\ No newline at end of file
@@ -0,0 +1,98 @@
+# E:\PROJECTS\voice_test\upload_limit_check.py
+#
+# Comprobación del límite de tamaño de subida (MaxBodySizeMiddleware en
+# upload_streaming.py) con una aplicación FastAPI real y un endpoint con
+# UploadFile, llamada directamente por ASGI: sin servidor ni claves. Cubre la
+# subida por bloques sin Content-Length, donde el parser de formularios de
+# FastAPI convertiría cualquier excepción en un 400. Termina con código 1 si
+# alguna comprobación falla. Uso:
+#   python upload_limit_check.py
+
+import sys
+import json
+import asyncio
+
+from fastapi import FastAPI, File, UploadFile
+
+from upload_streaming import MaxBodySizeMiddleware
+
+MAX_BYTES = 64 * 1024
+BOUNDARY = "limite-de-prueba"
+
+def build_app() -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(MaxBodySizeMiddleware, max_bytes=MAX_BYTES, exempt_paths=("/lotes/",))
+
+    @app.post("/subida/")
+    async def subida(audio_file: UploadFile = File(...)):
+        return {"bytes": len(await audio_file.read())}
+
+    @app.post("/lotes/subida/")
+    async def subida_lote(audio_file: UploadFile = File(...)):
+        return {"bytes": len(await audio_file.read())}
+
+    return app
+
+def multipart_body(audio_size: int) -> bytes:
+    return (f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"audio_file\"; filename=\"a.mp3\"\r\n"
+            f"Content-Type: audio/mpeg\r\n\r\n").encode() + b"\x00" * audio_size + f"\r\n--{BOUNDARY}--\r\n".encode()
+
+async def post(app, path: str, body: bytes, with_content_length: bool, chunk_size: int = 8 * 1024) -> tuple[int, dict, int]:
+    # Devuelve (estado, cuerpo JSON, bytes del cuerpo que la aplicación llegó a leer)
+    headers = [(b"content-type", f"multipart/form-data; boundary={BOUNDARY}".encode())]
+    if with_content_length:
+        headers.append((b"content-length", str(len(body)).encode()))
+    else:
+        headers.append((b"transfer-encoding", b"chunked"))
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST", "scheme": "http",
+             "path": path, "raw_path": path.encode(), "root_path": "", "query_string": b"", "headers": headers,
+             "client": ("127.0.0.1", 1234), "server": ("127.0.0.1", 8000)}
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+    delivered = 0
+    messages = []
+
+    async def receive():
+        nonlocal delivered
+        if not chunks:
+            await asyncio.sleep(3600)  # el cliente sigue conectado sin enviar más
+        chunk = chunks.pop(0)
+        delivered += len(chunk)
+        return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+
+    async def send(message):
+        messages.append(message)
+
+    await asyncio.wait_for(app(scope, receive, send), timeout=10)
+    starts = [m for m in messages if m["type"] == "http.response.start"]
+    body_bytes = b"".join(m.get("body", b"") for m in messages if m["type"] == "http.response.body")
+    if len(starts) != 1:
+        raise AssertionError(f"se esperaba una sola respuesta y hubo {len(starts)}")
+    return starts[0]["status"], json.loads(body_bytes or b"{}"), delivered
+
+def check(name: str, condition: bool, detail: str = "") -> bool:
+    print(f"[{'ok' if condition else 'FALLO'}] {name}{f' ({detail})' if detail and not condition else ''}")
+    return condition
+
+async def run_checks() -> bool:
+    app = build_app()
+    results = []
+
+    status, payload, _ = await post(app, "/subida/", multipart_body(1000), with_content_length=False)
+    results.append(check("subida pequeña por bloques: 200", status == 200 and payload.get("bytes") == 1000, f"{status} {payload}"))
+
+    status, payload, delivered = await post(app, "/subida/", multipart_body(4 * MAX_BYTES), with_content_length=False)
+    results.append(check("subida grande por bloques sin Content-Length: 413", status == 413, f"{status} {payload}"))
+    results.append(check("el detalle menciona el límite", str(MAX_BYTES) in payload.get("detail", ""), str(payload)))
+    results.append(check("se deja de leer al superar el límite", delivered <= MAX_BYTES + 16 * 1024,
+                         f"{delivered} bytes leídos"))
+
+    status, payload, delivered = await post(app, "/subida/", multipart_body(4 * MAX_BYTES), with_content_length=True)
+    results.append(check("subida grande con Content-Length: 413 sin leer el cuerpo", status == 413 and delivered == 0,
+                         f"{status}, {delivered} bytes leídos"))
+
+    status, payload, _ = await post(app, "/lotes/subida/", multipart_body(2 * MAX_BYTES), with_content_length=False)
+    results.append(check("ruta exenta: 200", status == 200 and payload.get("bytes") == 2 * MAX_BYTES, f"{status} {payload}"))
+    return all(results)
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(run_checks()) else 1)
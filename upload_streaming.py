@@ -0,0 +1,140 @@
+# E:\PROJECTS\voice_test\upload_streaming.py
+
+import os
+import json
+import asyncio
+import hashlib
+from typing import AsyncIterator
+from fastapi import UploadFile, HTTPException
+
+# Tamaño fijo de cada bloque enviado a AssemblyAI
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(256 * 1024)))
+# Límite duro por archivo de audio (0 = sin límite)
+MAX_AUDIO_UPLOAD_BYTES = int(os.getenv("MAX_AUDIO_UPLOAD_BYTES", "0"))
+
+def _too_large_detail(max_bytes: int) -> str:
+    return f"El archivo de audio supera el tamaño máximo permitido ({max_bytes} bytes)."
+
+async def iter_upload_file(audio_file: UploadFile, chunk_size: int = UPLOAD_CHUNK_SIZE,
+                           max_bytes: int = MAX_AUDIO_UPLOAD_BYTES) -> AsyncIterator[bytes]:
+    # Recorre el UploadFile en bloques de tamaño fijo, de modo que nunca se
+    # mantiene la grabación completa en memoria.
+    total = 0
+    await audio_file.seek(0)
+    while True:
+        chunk = await audio_file.read(chunk_size)
+        if not chunk:
+            break
+        total += len(chunk)
+        if max_bytes and total > max_bytes:
+            raise HTTPException(status_code=413, detail=_too_large_detail(max_bytes))
+        yield chunk
+
+async def iter_file_chunks(path: str, chunk_size: int = UPLOAD_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    loop = asyncio.get_event_loop()
+    with open(path, "rb") as f:
+        while True:
+            chunk = await loop.run_in_executor(None, f.read, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+async def hash_upload_file(audio_file: UploadFile, chunk_size: int = UPLOAD_CHUNK_SIZE,
+                           max_bytes: int = MAX_AUDIO_UPLOAD_BYTES) -> str:
+    # SHA-256 del audio calculado bloque a bloque (clave de la caché de resultados).
+    digest = hashlib.sha256()
+    async for chunk in iter_upload_file(audio_file, chunk_size, max_bytes):
+        digest.update(chunk)
+    await audio_file.seek(0)
+    return digest.hexdigest()
+
+async def save_upload_file(audio_file: UploadFile, dest_path: str, chunk_size: int = UPLOAD_CHUNK_SIZE,
+                           max_bytes: int = MAX_AUDIO_UPLOAD_BYTES) -> tuple[int, str]:
+    # Vuelca el audio a disco por bloques y devuelve (tamaño, sha256).
+    loop = asyncio.get_event_loop()
+    total = 0
+    digest = hashlib.sha256()
+    try:
+        with open(dest_path, "wb") as f:
+            async for chunk in iter_upload_file(audio_file, chunk_size, max_bytes):
+                digest.update(chunk)
+                await loop.run_in_executor(None, f.write, chunk)
+                total += len(chunk)
+    except BaseException:
+        try: os.remove(dest_path)
+        except OSError: pass
+        raise
+    return total, digest.hexdigest()
+
+class MaxBodySizeMiddleware:
+    # Middleware ASGI que corta la petición en cuanto el cuerpo supera el límite,
+    # antes de que Starlette termine de recibir y volcar el multipart a disco.
+    # Sin Content-Length (subida por bloques) el 413 se envía desde aquí en
+    # cuanto se supera el límite: una excepción lanzada dentro de receive la
+    # capturaría el parser de formularios de FastAPI y respondería 400.
+
+    def __init__(self, app, max_bytes: int = MAX_AUDIO_UPLOAD_BYTES, exempt_paths: tuple = ()):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.exempt_paths = exempt_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.max_bytes or scope["method"] not in ("POST", "PUT", "PATCH") \
+                or scope["path"].startswith(self.exempt_paths):
+            await self.app(scope, receive, send)
+            return
+
+        for name, value in scope.get("headers", []):
+            if name == b"content-length":
+                try:
+                    declared = int(value)
+                except ValueError:
+                    declared = 0
+                if declared > self.max_bytes:
+                    print(f"Petición rechazada: Content-Length {declared} supera el límite de {self.max_bytes} bytes.")
+                    await self._send_413(send)
+                    return
+
+        received = 0
+        response_started = False
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, rejected
+            if rejected:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    print(f"Petición rechazada: el cuerpo superó el límite de {self.max_bytes} bytes durante la recepción.")
+                    if not response_started:
+                        await self._send_413(send)
+                        rejected = True
+                    # La aplicación ve una desconexión del cliente y deja de leer
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            if rejected:
+                return  # ya se respondió 413: se descarta la respuesta de la aplicación (400, 500...)
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not rejected:
+                raise
+
+    async def _send_413(self, send):
+        body = json.dumps({"detail": _too_large_detail(self.max_bytes)}, ensure_ascii=False).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+                        (b"connection", b"close")],
+        })
+        await send({"type": "http.response.body", "body": body})
\ No newline at end of file
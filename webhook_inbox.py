@@ -0,0 +1,61 @@
+# E:\PROJECTS\voice_test\webhook_inbox.py
+
+import os
+import time
+import sqlite3
+
+class WebhookInbox:
+    # Buzón compartido (SQLite, modo WAL) de avisos de AssemblyAI. El webhook puede
+    # llegar a un proceso de uvicorn distinto del que espera la transcripción; el
+    # proceso receptor lo anota aquí y el planificador del otro proceso lo recoge.
+
+    def __init__(self, data_dir: str, retention_seconds: float = 24 * 3600):
+        os.makedirs(data_dir, exist_ok=True)
+        self.db_path = os.path.join(data_dir, "webhooks.sqlite3")
+        self.retention_seconds = retention_seconds
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS webhook_events ("
+                " transcript_id TEXT PRIMARY KEY, status TEXT NOT NULL, received_at REAL NOT NULL)"
+            )
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30.0, isolation_level=None)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def record(self, transcript_id: str, status: str) -> None:
+        conn = self._connect()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO webhook_events (transcript_id, status, received_at) VALUES (?, ?, ?)",
+                (transcript_id, status, time.time()),
+            )
+        finally:
+            conn.close()
+
+    def take(self, transcript_ids: list[str]) -> dict[str, str]:
+        # Devuelve y elimina los avisos recibidos para los ids indicados.
+        if not transcript_ids:
+            return {}
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            placeholders = ",".join("?" for _ in transcript_ids)
+            rows = conn.execute(
+                f"SELECT transcript_id, status FROM webhook_events WHERE transcript_id IN ({placeholders})", transcript_ids
+            ).fetchall()
+            if rows:
+                conn.execute(f"DELETE FROM webhook_events WHERE transcript_id IN ({placeholders})", transcript_ids)
+            conn.execute("DELETE FROM webhook_events WHERE received_at < ?", (time.time() - self.retention_seconds,))
+            conn.execute("COMMIT")
+            return {tid: status for tid, status in rows}
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
\ No newline at end of file